@@ -0,0 +1,58 @@
+#! /usr/bin/env python3
+'''
+Compare ACL lookups against the previous implementation, which tested an
+IPv4Address against every network in turn, for ACLs of various sizes.
+
+Usage:
+    PYTHONPATH=src python3 benchmarks/acl_lookup.py [--lookups N]
+'''
+import argparse
+import ipaddress
+import random
+import time
+
+import acl
+
+
+def linear_allowed(networks, ip):
+    '''
+    The lookup that ACL.ip_allowed replaced.
+    '''
+    ip_address = ipaddress.IPv4Address(ip)
+    for net in networks:
+        if ip_address in net:
+            return True
+    return False
+
+
+def measure(lookup, peers):
+    start = time.perf_counter()
+    for peer in peers:
+        lookup(peer)
+    return (time.perf_counter() - start) / len(peers) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print('{0:>8} {1:>12} {2:>12} {3:>12}'.format('networks', 'linear µs', 'compiled µs',
+                                                 'cached µs'))
+    for count in (3, 100, 1000, 5000):
+        cidrs = ','.join('10.{0}.{1}.0/24'.format(i // 256, i % 256)
+                         for i in rng.sample(range(65536), count))
+        compiled = acl.ACL(cidrs, cache_size=args.lookups * 2)
+        # Many distinct peers, so most lookups miss the verdict cache
+        peers = ['10.{0}.{1}.{2}'.format(rng.randrange(256), rng.randrange(256),
+                                         rng.randrange(256))
+                 for i in range(args.lookups)]
+        linear = measure(lambda ip: linear_allowed(compiled.networks, ip), peers)
+        uncached = measure(compiled.ip_allowed, peers)
+        cached = measure(compiled.ip_allowed, peers)
+        print('{0:>8} {1:>12.2f} {2:>12.2f} {3:>12.2f}'.format(count, linear, uncached, cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#! /usr/bin/env python3
+'''
+Compare the memory footprint and lookup speed of the domain table used by
+ResourceList against the plain set of domain strings it replaced, and
+against the compiled table that workers memory map. The memory of the
+mapped table is the shared file in the page cache, not the process heap.
+
+Usage:
+    PYTHONPATH=src python3 benchmarks/domain_footprint.py [--domains N]
+'''
+import argparse
+import gc
+import json
+import os
+import random
+import string
+import tempfile
+import time
+import tracemalloc
+
+import resource
+
+
+TLDS = ['com', 'net', 'org', 'ru', 'de', 'info', 'io', 'co.uk', 'com.br', 'xyz']
+SUBDOMAINS = ['www', 'ads', 'cdn', 'track', 'static', 'pixel', 'media']
+
+
+def random_label(rng, low=4, high=14):
+    return ''.join(rng.choice(string.ascii_lowercase)
+                   for i in range(rng.randint(low, high)))
+
+
+def generate_domains(count, seed=0):
+    '''
+    Generate `count` blacklist-like domains: mostly registered domains
+    with a share of tracking subdomains.
+    '''
+    rng = random.Random(seed)
+    domains = set()
+    while len(domains) < count:
+        domain = '%s.%s' % (random_label(rng), rng.choice(TLDS))
+        if rng.random() < 0.3:
+            domain = '%s.%s' % (rng.choice(SUBDOMAINS), domain)
+        domains.add(domain)
+    return sorted(domains)
+
+
+def set_match(domains, host):
+    '''
+    The lookup ResourceList.check did before the domain table.
+    '''
+    host_parts = host.split('.')
+    for i in range(len(host_parts)):
+        if '.'.join(host_parts[i:]) in domains:
+            return True
+    return False
+
+
+def mapped_table(domains):
+    '''
+    Compile the domains to a file and map it like a worker does.
+    '''
+    path = os.path.join(tempfile.gettempdir(), 'domain_footprint.rules')
+    resource.ResourceList.compile_to({'domain': domains}, path)
+    table = resource.ResourceList.open(path).domains
+    os.unlink(path)
+    return table
+
+
+def measure(build, payload):
+    '''
+    Build a structure from the JSON `payload` the way ResourceList.load
+    does and return it with its retained size in bytes and its build
+    time. The parsed JSON is released before measuring, so only what the
+    structure keeps alive is counted.
+    '''
+    ruleset = json.loads(payload)
+    start = time.perf_counter()
+    build(ruleset['domain'])
+    elapsed = time.perf_counter() - start
+    del ruleset
+
+    gc.collect()
+    tracemalloc.start()
+    ruleset = json.loads(payload)
+    structure = build(ruleset['domain'])
+    del ruleset
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return structure, size, elapsed
+
+
+def lookup_time(match, structure, hosts):
+    start = time.perf_counter()
+    for host in hosts:
+        match(structure, host)
+    return (time.perf_counter() - start) / len(hosts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domains', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=200000)
+    args = parser.parse_args()
+
+    domains = generate_domains(args.domains)
+    payload = json.dumps({'domain': domains})
+
+    rng = random.Random(1)
+    hosts = []
+    for i in range(args.lookups):
+        if rng.random() < 0.5:
+            hosts.append('%s.%s' % (random_label(rng, 2, 6), rng.choice(domains)))
+        else:
+            hosts.append('www.%s.%s' % (random_label(rng), rng.choice(TLDS)))
+
+    results = {}
+    for name, build, match in (('set', set, set_match),
+                               ('table', resource.DomainTable.build, resource.DomainTable.match),
+                               ('mapped', mapped_table, resource.DomainTable.match)):
+        structure, size, elapsed = measure(build, payload)
+        results[name] = {
+            'bytes': size,
+            'build_seconds': elapsed,
+            'lookup_us': lookup_time(match, structure, hosts) * 1e6,
+            'shared': structure.sizeof() if name == 'mapped' else 0,
+        }
+        del structure
+
+    print('%d domains, %d lookups' % (len(domains), len(hosts)))
+    print('%-6s %14s %14s %12s %12s' % ('', 'memory (MiB)', 'shared (MiB)',
+                                        'build (s)', 'lookup (us)'))
+    for name, result in results.items():
+        print('%-6s %14.1f %14.1f %12.2f %12.2f' % (name, result['bytes'] / 2 ** 20,
+                                                    result['shared'] / 2 ** 20,
+                                                    result['build_seconds'],
+                                                    result['lookup_us']))
+
+
+if __name__ == '__main__':
+    main()
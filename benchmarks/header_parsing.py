@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+'''
+Compare the request header parser of ProxyServer against the previous
+implementation, which read the headers line by line and parsed them with
+email.parser.
+
+Usage:
+    PYTHONPATH=src python3 benchmarks/header_parsing.py [--requests N]
+'''
+import argparse
+import asyncio
+import email.parser
+import http.client
+import time
+
+import proxy
+
+
+HEAD = (b'Host: www.example.com\r\n'
+        b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:56.0) Gecko/20100101 Firefox/56.0\r\n'
+        b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+        b'Accept-Language: en-US,en;q=0.5\r\n'
+        b'Accept-Encoding: gzip, deflate\r\n'
+        b'Referer: http://www.example.com/index.html\r\n'
+        b'Cookie: session=0123456789abcdef; theme=dark\r\n'
+        b'Connection: keep-alive\r\n'
+        b'Upgrade-Insecure-Requests: 1\r\n'
+        b'\r\n')
+
+
+async def email_parse_headers(reader):
+    '''
+    The parser that ProxyServer.parse_headers replaced.
+    '''
+    headers = []
+    while True:
+        line = await reader.readline()
+        if len(line) > proxy.ProxyServer.MAXLINE:
+            raise ValueError('Line too long while parsing header')
+        headers.append(line)
+        if len(headers) > proxy.ProxyServer.MAXHEADERS:
+            raise ValueError('Too many headers found while parsing')
+        if line in (b'\r\n', b'\n', b''):
+            break
+
+    hstring = b''.join(headers).decode('iso-8859-1')
+    parser = email.parser.Parser(_class=http.client.HTTPMessage)
+    return parser.parsestr(hstring)
+
+
+async def parse_all(parse, reader, count):
+    for i in range(count):
+        headers = await parse(reader)
+        headers.get('connection')
+
+
+def measure(loop, parse, count):
+    reader = asyncio.StreamReader(loop=loop, limit=len(HEAD) * count + 1)
+    reader.feed_data(HEAD * count)
+    reader.feed_eof()
+    start = time.perf_counter()
+    loop.run_until_complete(parse_all(parse, reader, count))
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    results = [
+        ('email.parser', measure(loop, email_parse_headers, args.requests)),
+        ('parse_headers', measure(loop, proxy.ProxyServer.parse_headers, args.requests)),
+    ]
+    loop.close()
+
+    print('%d requests with %d header bytes each' % (args.requests, len(HEAD)))
+    for name, seconds in results:
+        print('%-14s %8.2f us/request' % (name, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
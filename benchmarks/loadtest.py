@@ -0,0 +1,395 @@
+#! /usr/bin/env python3
+'''
+Load test a ProxyServer against a local origin server and list server, so
+no requests leave the machine and results can be compared between
+versions.
+
+The origin serves small objects, large bodies and slow responses, plus a
+port that streams data for CONNECT tunnels. The blacklist, whitelist and
+cache list are served over HTTP from the origin process. The origin, the
+proxy and the client each run in their own process.
+
+For every scenario the requests per second, p50/p99 latency and the RSS of
+the proxy process are reported; for CONNECT tunnels the throughput. The
+results are saved as JSON, and --baseline compares them to a previous run.
+
+Usage:
+    PYTHONPATH=src python3 benchmarks/loadtest.py [--requests N] [--concurrency N]
+        [--output FILE] [--baseline FILE]
+'''
+import os
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.server
+
+import config
+
+
+# Size of the responses to /small and /slow
+SMALL_SIZE = 1024
+
+
+def listening_socket():
+    # asyncio only sets TCP_NODELAY on the accepted connections if the
+    # protocol is given explicitly.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    return sock
+
+
+def fork(function, *args):
+    '''
+    Run function(*args) in a child process.
+
+    :return: the pid of the child.
+    '''
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            function(*args)
+            code = 0
+        except KeyboardInterrupt:
+            code = 0
+        finally:
+            os._exit(code)
+    return pid
+
+
+def rss(pid):
+    '''
+    :return: the current and peak resident set size of a process in KiB,
+      or None where /proc is not available.
+    '''
+    try:
+        with open('/proc/{0}/status'.format(pid)) as status:
+            fields = dict(line.split(':', 1) for line in status)
+    except OSError:
+        return None
+    return {'rss_kib': int(fields['VmRSS'].split()[0]),
+            'peak_kib': int(fields['VmHWM'].split()[0])}
+
+
+def list_server(lists):
+    '''
+    :param lists: dict of path -> JSON data.
+    :return: an HTTP server that serves the lists, not yet started.
+    '''
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = lists.get(self.path)
+            if data is None:
+                self.send_error(404)
+                return
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return http.server.HTTPServer(('127.0.0.1', 0), Handler)
+
+
+def run_origin(origin_sock, tunnel_sock, lists, args):
+    '''
+    Serve the origin, the tunnel data and the lists until SIGTERM.
+    '''
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    threading.Thread(target=lists.serve_forever, daemon=True).start()
+
+    bodies = {
+        '/small': b'x' * SMALL_SIZE,
+        '/large': b'x' * (args.large_kb * 1024),
+        '/slow': b'x' * SMALL_SIZE,
+    }
+    tunnel_data = memoryview(bytearray(config.buffer_high))
+    tunnel_size = args.tunnel_mb * 1024 * 1024
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                path = head.split(b' ', 2)[1].decode('ascii')
+                body = bodies.get(path)
+                if body is None:
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                    continue
+                if path == '/slow':
+                    await asyncio.sleep(args.slow_ms / 1000)
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body))
+                writer.write(body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def stream(reader, writer):
+        try:
+            for offset in range(0, tunnel_size, len(tunnel_data)):
+                writer.write(tunnel_data[:tunnel_size - offset])
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(asyncio.start_server(handle, sock=origin_sock))
+    loop.run_until_complete(asyncio.start_server(stream, sock=tunnel_sock))
+    loop.run_forever()
+
+
+def run_proxy(proxy_sock, list_url, args):
+    '''
+    Serve proxy requests until SIGTERM.
+    '''
+    import logging
+    import proxy
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logging.basicConfig(level=logging.WARNING)
+    config.blacklist = list_url + '/blacklist.json'
+    config.whitelist = list_url + '/whitelist.json'
+    config.cachelist = list_url + '/cachelist.json'
+    config.list_cache_dir = tempfile.mkdtemp()
+    config.access_log = ''
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = proxy.ProxyServer(loop)
+    loop.run_until_complete(asyncio.start_server(server.handler, sock=proxy_sock))
+    loop.run_forever()
+
+
+async def fetch(reader, writer, url):
+    '''
+    Send a GET request for `url` through the proxy and read the response.
+
+    :return: the status code.
+    '''
+    writer.write('GET {0} HTTP/1.1\r\nHost: x\r\n\r\n'.format(url).encode('ascii'))
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, sep, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    while length:
+        length -= len(await reader.read(min(length, 262144)))
+    return int(head.split(b' ', 2)[1])
+
+
+async def load(proxy_port, url, requests, concurrency):
+    '''
+    Send `requests` requests for `url` over `concurrency` persistent
+    connections.
+
+    :return: a dict of the results.
+    '''
+    latencies = []
+    errors = [0]
+    remaining = [requests]
+
+    async def client():
+        reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = time.perf_counter()
+                try:
+                    status = await fetch(reader, writer, url)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    # The proxy closed the connection, open a new one.
+                    errors[0] += 1
+                    writer.close()
+                    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+                    continue
+                latencies.append(time.perf_counter() - start)
+                if status >= 500:
+                    errors[0] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    def percentile(fraction):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000, 3)
+
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(0.5),
+        'p99_ms': percentile(0.99),
+    }
+
+
+async def tunnels(proxy_port, tunnel_port, count):
+    '''
+    Open `count` CONNECT tunnels to the tunnel port at once and read all
+    the data it sends.
+
+    :return: a dict of the results.
+    '''
+    received = [0]
+
+    async def tunnel():
+        reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+        writer.write('CONNECT 127.0.0.1:{0} HTTP/1.1\r\n\r\n'.format(tunnel_port).encode('ascii'))
+        await reader.readuntil(b'\n\n')
+        while True:
+            data = await reader.read(262144)
+            if not data:
+                break
+            received[0] += len(data)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[tunnel() for i in range(count)])
+    elapsed = time.perf_counter() - start
+    return {
+        'tunnels': count,
+        'megabytes': round(received[0] / 1024 / 1024, 1),
+        'mib_per_second': round(received[0] / elapsed / 1024 / 1024, 1),
+    }
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    '''
+    Print the change of every result against a previous run.
+    '''
+    print()
+    print('Compared to {0} ({1}):'.format(baseline.get('version'), baseline.get('time')))
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        for key in ('requests_per_second', 'p50_ms', 'p99_ms', 'mib_per_second'):
+            if result.get(key) and before.get(key):
+                change = (result[key] / before[key] - 1) * 100
+                print('{0:<12} {1:<20} {2:>10} -> {3:>10} ({4:+.1f}%)'.format(
+                    name, key, before[key], result[key], change))
+    if results.get('rss') and baseline.get('rss'):
+        print('{0:<12} {1:<20} {2:>10} -> {3:>10}'.format(
+            'proxy', 'peak_kib', baseline['rss']['peak_kib'], results['rss']['peak_kib']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--large-kb', type=int, default=1024)
+    parser.add_argument('--slow-ms', type=int, default=50)
+    parser.add_argument('--tunnels', type=int, default=4)
+    parser.add_argument('--tunnel-mb', type=int, default=256,
+                        help='megabytes sent through each tunnel')
+    parser.add_argument('--output', default='loadtest.json')
+    parser.add_argument('--baseline', help='results of a previous run to compare to')
+    args = parser.parse_args()
+
+    origin_sock = listening_socket()
+    tunnel_sock = listening_socket()
+    proxy_sock = listening_socket()
+    origin = 'http://127.0.0.1:{0}'.format(origin_sock.getsockname()[1])
+    lists = list_server({
+        '/blacklist.json': {'domain': ['blocked.test']},
+        '/whitelist.json': {'domain': []},
+        '/cachelist.json': {r'redirect\.test/.*': origin + '/small'},
+    })
+    list_url = 'http://127.0.0.1:{0}'.format(lists.server_address[1])
+
+    pids = [fork(run_origin, origin_sock, tunnel_sock, lists, args)]
+    lists.server_close()
+    pids.append(fork(run_proxy, proxy_sock, list_url, args))
+    proxy_pid = pids[-1]
+    proxy_port = proxy_sock.getsockname()[1]
+    tunnel_port = tunnel_sock.getsockname()[1]
+    for sock in (origin_sock, tunnel_sock, proxy_sock):
+        sock.close()
+
+    scenarios = [
+        ('small', origin + '/small', args.requests),
+        ('large', origin + '/large', max(1, args.requests // 10)),
+        ('slow', origin + '/slow', args.requests),
+        ('blocked', 'http://blocked.test/', args.requests),
+        ('redirected', 'http://redirect.test/a', args.requests),
+    ]
+
+    results = {
+        'version': version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'settings': vars(args),
+        'scenarios': {},
+    }
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        # The first requests wait for the proxy to start.
+        loop.run_until_complete(load(proxy_port, origin + '/small', 1, 1))
+
+        print('{0:<12} {1:>9} {2:>7} {3:>10} {4:>9} {5:>9} {6:>10}'.format(
+            'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'RSS KiB'))
+        for name, url, requests in scenarios:
+            result = loop.run_until_complete(load(proxy_port, url, requests, args.concurrency))
+            memory = rss(proxy_pid)
+            result['rss_kib'] = memory and memory['rss_kib']
+            results['scenarios'][name] = result
+            print('{0:<12} {1:>9} {2:>7} {3:>10} {4:>9} {5:>9} {6:>10}'.format(
+                name, result['requests'], result['errors'], result['requests_per_second'],
+                result['p50_ms'], result['p99_ms'], result['rss_kib']))
+
+        result = loop.run_until_complete(tunnels(proxy_port, tunnel_port, args.tunnels))
+        results['scenarios']['connect'] = result
+        print('{0:<12} {1} tunnels, {2} MiB at {3} MiB/s'.format(
+            'connect', result['tunnels'], result['megabytes'], result['mib_per_second']))
+
+        results['rss'] = rss(proxy_pid)
+        if results['rss']:
+            print('proxy RSS {0} KiB, peak {1} KiB'.format(results['rss']['rss_kib'],
+                                                           results['rss']['peak_kib']))
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        loop.close()
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print('Results saved to {0}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
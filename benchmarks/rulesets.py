@@ -0,0 +1,311 @@
+#! /usr/bin/env python3
+'''
+Measure how ResourceList and CacheList scale with the size of their
+rulesets: load and compile time, retained memory and the latency
+distribution of check().
+
+Synthetic rulesets with up to millions of domains and thousands of path,
+misc and cache rules are written to JSON files and loaded through
+fetch_json() with file:// URLs, so nothing is downloaded. The requests
+checked are a synthetic mix of listed, cached and unlisted URLs; hosts
+and paths from access logs written by Kalamari can be added with
+--access-log.
+
+Usage:
+    PYTHONPATH=src python3 benchmarks/rulesets.py [--domains N,N,...] [--checks N]
+        [--access-log FILE] [--output FILE]
+'''
+import argparse
+import collections
+import gc
+import json
+import os
+import pathlib
+import random
+import tempfile
+import time
+import tracemalloc
+
+import resource
+from domain_footprint import TLDS, random_label, generate_domains
+
+
+# check() only reads the host and path of a request
+Request = collections.namedtuple('Request', 'host path')
+
+LIBRARIES = ['jquery', 'bootstrap', 'react', 'angular', 'lodash', 'moment', 'vue', 'd3']
+WORDS = ['ads', 'banner', 'track', 'pixel', 'beacon', 'promo', 'sponsor', 'popup', 'metrics']
+
+
+def generate_path_rules(rng, count):
+    '''
+    Generate blacklist path rules: substrings, prefixes, patterns with a
+    literal to filter on, and a few without one.
+
+    :return: the rules and a path that each of them blocks.
+    '''
+    rules = []
+    paths = []
+    for i in range(count):
+        word = '%s%d' % (rng.choice(WORDS), i)
+        kind = i % 4
+        if kind == 0:
+            rules.append('.*/%s/.*' % word)
+            paths.append('/static/%s/a.js' % word)
+        elif kind == 1:
+            rules.append('/%s\\.(gif|png|js)' % word)
+            paths.append('/%s.gif' % word)
+        elif kind == 2:
+            rules.append('.*/%s/[0-9]+/.*' % word)
+            paths.append('/a/%s/42/b' % word)
+        else:
+            rules.append('/[a-z]{2}%d/.*' % i)
+            paths.append('/ab%d/c' % i)
+    return rules, paths
+
+
+def generate_misc_rules(rng, count):
+    '''
+    Generate blacklist rules on the host and path.
+    '''
+    return ['(www\\.)?%s\\.%s/%s/.*' % (random_label(rng), rng.choice(TLDS).replace('.', '\\.'),
+                                        rng.choice(WORDS))
+            for i in range(count)]
+
+
+def generate_cache_rules(rng, count):
+    '''
+    Generate cache list rules that redirect versioned script URLs of CDN
+    hosts to a local copy.
+
+    :return: the ruleset and the hosts and paths of URLs it caches.
+    '''
+    ruleset = collections.OrderedDict()
+    cached = []
+    while len(ruleset) < count:
+        host = 'cdn.%s.%s' % (random_label(rng), rng.choice(TLDS))
+        library = rng.choice(LIBRARIES)
+        rule = '%s/libs/%s/[0-9.]+/%s(\\.min)?\\.js' % (host.replace('.', '\\.'), library,
+                                                        library)
+        ruleset[rule] = 'http://127.0.0.1:8080/%s.js' % library
+        cached.append((host, '/libs/%s/%d.%d.%d/%s.min.js' % (library, rng.randrange(4),
+                                                             rng.randrange(10),
+                                                             rng.randrange(10), library)))
+    # A few rules that apply to any host
+    for library in LIBRARIES:
+        ruleset['.*/%s-[0-9.]+\\.min\\.js' % library] = 'http://127.0.0.1:8080/%s.js' % library
+    return ruleset, cached
+
+
+def random_path(rng):
+    return '/' + '/'.join(random_label(rng, 2, 8) for i in range(rng.randint(1, 4)))
+
+
+def generate_corpus(rng, count, domains, blocked_paths, cached):
+    '''
+    Generate requests: a quarter for listed domains or their subdomains,
+    some with blacklisted paths or cached URLs, and the rest for unlisted
+    hosts.
+    '''
+    requests = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.25:
+            host = rng.choice(domains)
+            if rng.random() < 0.5:
+                host = '%s.%s' % (random_label(rng, 2, 6), host)
+            requests.append(Request(host, random_path(rng)))
+        elif kind < 0.35 and blocked_paths:
+            requests.append(Request('www.%s.com' % random_label(rng), rng.choice(blocked_paths)))
+        elif kind < 0.45 and cached:
+            requests.append(Request(*rng.choice(cached)))
+        else:
+            requests.append(Request('www.%s.%s' % (random_label(rng), rng.choice(TLDS)),
+                                    random_path(rng)))
+    return requests
+
+
+def read_access_log(path):
+    '''
+    :return: the requests of an access log, skipping CONNECT requests and
+      lines that are not access log records.
+    '''
+    requests = []
+    with open(path) as log:
+        for line in log:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get('host') and record.get('path'):
+                requests.append(Request(record['host'], record['path']))
+    return requests
+
+
+def write_ruleset(ruleset, directory, name):
+    '''
+    :return: the file:// URL of the ruleset written to `directory`.
+    '''
+    path = os.path.join(directory, name + '.json')
+    with open(path, 'w') as output:
+        json.dump(ruleset, output)
+    return pathlib.Path(path).as_uri()
+
+
+def retained(build):
+    '''
+    :return: what build() returns and the bytes of memory it keeps
+      allocated.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    structure = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return structure, size
+
+
+def latencies(check, requests):
+    '''
+    :return: the distribution of the latency of check() in microseconds,
+      and the share of requests it matched.
+    '''
+    clock = time.perf_counter_ns
+    times = []
+    matched = 0
+    for request in requests:
+        start = clock()
+        result = check(request)
+        times.append(clock() - start)
+        if result:
+            matched += 1
+    times.sort()
+    def percentile(fraction):
+        return round(times[min(len(times) - 1, int(len(times) * fraction))] / 1000, 2)
+    return {
+        'mean_us': round(sum(times) / len(times) / 1000, 2),
+        'p50_us': percentile(0.5),
+        'p90_us': percentile(0.9),
+        'p99_us': percentile(0.99),
+        'max_us': round(times[-1] / 1000, 2),
+        'matched': round(matched / len(times), 3),
+    }
+
+
+def build_list(cls, ruleset):
+    rules = cls()
+    rules.build(ruleset)
+    return rules
+
+
+def measure(cls, url, requests, directory, memory):
+    '''
+    Load a ruleset from `url` into `cls` and check the requests against
+    it. ResourceLists are also compiled to a file and memory mapped like
+    the workers of a supervisor do.
+    '''
+    start = time.perf_counter()
+    ruleset = resource.fetch_json(url)
+    fetched = time.perf_counter()
+    rules = build_list(cls, ruleset)
+    built = time.perf_counter()
+    result = {
+        'fetch_seconds': round(fetched - start, 3),
+        'build_seconds': round(built - fetched, 3),
+        'check': latencies(rules.check, requests),
+    }
+    del rules
+    if memory:
+        rules, result['bytes'] = retained(lambda: build_list(cls, ruleset))
+        del rules
+
+    if cls is resource.ResourceList:
+        path = os.path.join(directory, 'compiled.rules')
+        start = time.perf_counter()
+        cls.compile_to(ruleset, path)
+        compiled = time.perf_counter()
+        mapped = cls.open(path)
+        opened = time.perf_counter()
+        result['compile_seconds'] = round(compiled - start, 3)
+        result['open_seconds'] = round(opened - compiled, 3)
+        result['mapped_check'] = latencies(mapped.check, requests)
+        if memory:
+            mapped, result['mapped_bytes'] = retained(lambda: cls.open(path))
+        del mapped
+        os.unlink(path)
+    return result
+
+
+def print_result(name, result):
+    print('{0:<28} fetch {1:6.2f} s  build {2:6.2f} s{3}'.format(
+        name, result['fetch_seconds'], result['build_seconds'],
+        '  memory {0:7.1f} MiB'.format(result['bytes'] / 2 ** 20) if 'bytes' in result else ''))
+    checks = [('check', result['check'])]
+    if 'mapped_check' in result:
+        print('{0:<28} compile {1:6.2f} s  open {2:6.2f} s{3}'.format(
+            '', result['compile_seconds'], result['open_seconds'],
+            '  memory {0:7.1f} MiB'.format(result['mapped_bytes'] / 2 ** 20)
+            if 'mapped_bytes' in result else ''))
+        checks.append(('mapped check', result['mapped_check']))
+    for label, check in checks:
+        print('{0:<28} {1:<13} mean {2:6.2f}  p50 {3:6.2f}  p90 {4:6.2f}  p99 {5:7.2f}  '
+              'max {6:8.2f} us  matched {7:.1%}'.format(
+                  '', label, check['mean_us'], check['p50_us'], check['p90_us'],
+                  check['p99_us'], check['max_us'], check['matched']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domains', default='10000,100000,1000000',
+                        help='comma-separated numbers of blacklisted domains')
+    parser.add_argument('--path-rules', type=int, default=2000)
+    parser.add_argument('--misc-rules', type=int, default=2000)
+    parser.add_argument('--cache-rules', type=int, default=5000)
+    parser.add_argument('--checks', type=int, default=100000)
+    parser.add_argument('--access-log', action='append', default=[],
+                        help='add the requests of a Kalamari access log to the checks')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc measurements, which build every list twice')
+    parser.add_argument('--output', help='save the results as JSON')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    sizes = [int(size) for size in args.domains.split(',')]
+    all_domains = generate_domains(max(sizes))
+    path_rules, blocked_paths = generate_path_rules(rng, args.path_rules)
+    misc_rules = generate_misc_rules(rng, args.misc_rules)
+    cache_rules, cached = generate_cache_rules(rng, args.cache_rules)
+
+    logged = []
+    for path in args.access_log:
+        logged += read_access_log(path)
+
+    results = {'settings': vars(args), 'blacklist': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            domains = rng.sample(all_domains, size)
+            requests = generate_corpus(random.Random(1), args.checks, domains, blocked_paths,
+                                       cached) + logged
+            url = write_ruleset({'domain': domains, 'path': path_rules, 'misc': misc_rules},
+                                directory, 'blacklist')
+            name = '{0} domains'.format(size)
+            results['blacklist'][name] = result = measure(resource.ResourceList, url,
+                                                          requests, directory, args.memory)
+            print_result('blacklist, ' + name, result)
+
+        url = write_ruleset(cache_rules, directory, 'cachelist')
+        results['cachelist'] = result = measure(resource.CacheList, url, requests,
+                                                directory, args.memory)
+        print_result('cachelist, {0} rules'.format(len(cache_rules)), result)
+
+    print('{0} synthetic requests, {1} from access logs'.format(args.checks, len(logged)))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print('Results saved to {0}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
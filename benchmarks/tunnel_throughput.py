@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+'''
+Measure the throughput of a CONNECT tunnel relay over loopback TCP for the
+previous stream based relay, the recv_into() relay and the splice() relay.
+
+Usage:
+    PYTHONPATH=src python3 benchmarks/tunnel_throughput.py [--megabytes N]
+'''
+import argparse
+import asyncio
+import socket
+import time
+
+import config
+import tunnel
+
+
+def tcp_pair():
+    '''
+    :return: two connected non-blocking loopback TCP sockets.
+    '''
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        left = socket.create_connection(listener.getsockname())
+        right, address = listener.accept()
+    for sock in (left, right):
+        sock.setblocking(False)
+    return left, right
+
+
+async def stream_relay(loop, client, remote, buffer_size, use_splice):
+    '''
+    The relay that ProxySession used before, with StreamReader.read(8192)
+    and transport writes.
+    '''
+    async def pump(source, destination):
+        # Both streams are kept referenced so their transports stay open.
+        reader, source_writer = await asyncio.open_connection(sock=source)
+        destination_reader, writer = await asyncio.open_connection(sock=destination)
+        while True:
+            data = await reader.read(8192)
+            if not data:
+                writer.write_eof()
+                await writer.drain()
+                return
+            writer.write(data)
+            await writer.drain()
+
+    await pump(client, remote)
+
+
+async def measure(loop, relay, size):
+    sender, proxy_client = tcp_pair()
+    proxy_remote, receiver = tcp_pair()
+    chunk = memoryview(bytearray(config.buffer_high))
+
+    async def send():
+        for offset in range(0, size, len(chunk)):
+            await loop.sock_sendall(sender, chunk)
+        sender.shutdown(socket.SHUT_WR)
+
+    async def receive():
+        buffer = bytearray(config.buffer_high)
+        received = 0
+        while True:
+            count = await loop.sock_recv_into(receiver, buffer)
+            if not count:
+                return received
+            received += count
+
+    start = time.perf_counter()
+    relaying = asyncio.ensure_future(relay(loop, proxy_client, proxy_remote,
+                                           config.tunnel_buffer, relay is not tunnel.copy))
+    unused, received = await asyncio.gather(send(), receive())
+    elapsed = time.perf_counter() - start
+    relaying.cancel()
+    for sock in (sender, proxy_client, proxy_remote, receiver):
+        sock.close()
+    return received / elapsed / 1024 / 1024
+
+
+async def copy_relay(loop, client, remote, buffer_size, use_splice):
+    await tunnel.copy(loop, client, remote, buffer_size)
+
+
+async def splice_relay(loop, client, remote, buffer_size, use_splice):
+    await tunnel.splice(loop, client, remote, buffer_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--megabytes', type=int, default=512)
+    args = parser.parse_args()
+
+    relays = [('streams', stream_relay), ('recv_into', copy_relay)]
+    if tunnel.splice_supported():
+        relays.append(('splice', splice_relay))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    size = args.megabytes * 1024 * 1024
+    for name, relay in relays:
+        throughput = loop.run_until_complete(measure(loop, relay, size))
+        print('{0:<10} {1:8.0f} MiB/s'.format(name, throughput))
+
+
+if __name__ == '__main__':
+    main()
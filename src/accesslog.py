@@ -0,0 +1,112 @@
+import sys
+import json
+import queue
+import logging
+import logging.handlers
+
+
+# Logger of the access log records, which are written separately from the
+# other log messages
+ACCESS_LOGGER = 'kalamari.access'
+
+
+def setup_logging(level, access_log):
+    '''
+    Move the handlers of the root logger to a background thread behind a
+    queue, so logging never blocks the event loop on I/O. Call this in
+    each process; the thread does not survive a fork.
+
+    :param level: name or number of the log level.
+    :param access_log: path of the access log file, '-' for standard
+      output, or '' if there is no access log.
+    :return: the QueueListeners, for stop_logging().
+    '''
+    root = logging.getLogger()
+    root.setLevel(level)
+    handlers = root.handlers[:] or [logging.StreamHandler()]
+    for handler in handlers:
+        root.removeHandler(handler)
+    records = queue.Queue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listeners = [logging.handlers.QueueListener(records, *handlers)]
+
+    if access_log:
+        if access_log == '-':
+            handler = logging.StreamHandler(sys.stdout)
+        else:
+            handler = logging.FileHandler(access_log)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        access_records = queue.Queue()
+        logger = logging.getLogger(ACCESS_LOGGER)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(logging.handlers.QueueHandler(access_records))
+        listeners.append(logging.handlers.QueueListener(access_records, handler))
+
+    for listener in listeners:
+        listener.start()
+    return listeners
+
+
+def stop_logging(listeners):
+    '''
+    Write the queued log records and stop the background threads.
+    '''
+    for listener in listeners:
+        listener.stop()
+
+
+class AccessLog():
+    '''
+    Writes one JSON line per request. Lines are collected and passed to
+    the access logger in batches of up to `batch_size` lines, at most
+    `interval` seconds after the first line of a batch.
+    '''
+    def __init__(self, loop, batch_size, interval):
+        self.loop = loop
+        self.batch_size = batch_size
+        self.interval = interval
+        self.logger = logging.getLogger(ACCESS_LOGGER)
+        self.lines = []
+        self.timer = None
+
+    def log(self, request, client, target, duration):
+        '''
+        Record a request once it was answered.
+
+        :param target: the (host, port, path) the client asked for, before
+          a redirect by the cache list.
+        :param duration: seconds from the first byte of the request until
+          it was answered.
+        '''
+        host, port, path = target
+        record = {
+            'time': round(request.time, 3),
+            'session': request.session_id,
+            'client': client,
+            'method': request.method,
+            'host': host,
+            'port': port,
+            'path': path,
+            'verdict': request.verdict,
+            'status': request.status,
+            'bytes_sent': request.bytes_sent,
+            'bytes_received': request.bytes_received,
+            'duration_ms': round(duration * 1000, 3),
+        }
+        for stage, seconds in request.timings.items():
+            record[stage + '_ms'] = round(seconds * 1000, 3)
+        self.lines.append(json.dumps(record, separators=(',', ':')))
+
+        if len(self.lines) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.lines:
+            self.logger.info('\n'.join(self.lines))
+            self.lines = []
@@ -1,20 +1,70 @@
+import bisect
+import socket
 import ipaddress
 # Module Doc: https://docs.python.org/3/library/ipaddress.html
 
+# Prefix of IPv4 addresses mapped into IPv6, as dual-stack sockets report
+# IPv4 peers
+V4_MAPPED = b'\0' * 10 + b'\xff\xff'
+
+
+def parse_ip(ip):
+    '''
+    Convert an address to its family and integer value, without creating
+    ipaddress objects. IPv4-mapped IPv6 addresses are treated as IPv4.
+
+    :return: a tuple of 4 or 6 and the address as an int.
+    :raises: ValueError if the address is invalid.
+    '''
+    try:
+        if ':' in ip:
+            packed = socket.inet_pton(socket.AF_INET6, ip.split('%', 1)[0])
+            if packed.startswith(V4_MAPPED):
+                return 4, int.from_bytes(packed[12:], 'big')
+            return 6, int.from_bytes(packed, 'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, TypeError):
+        raise ValueError('Invalid IP address {0}'.format(ip))
+
+
+def merge(ranges):
+    '''
+    Merge overlapping and adjacent (first, last) ranges.
+
+    :return: a tuple of the sorted first and last addresses of the merged
+      ranges.
+    '''
+    firsts = []
+    lasts = []
+    for first, last in sorted(ranges):
+        if lasts and first <= lasts[-1] + 1:
+            lasts[-1] = max(lasts[-1], last)
+        else:
+            firsts.append(first)
+            lasts.append(last)
+    return firsts, lasts
+
+
 class ACL():
     '''
     This module handles the ACL logic and determines whether a given client should be allowed to connect to the ProxyServer and make requests
     Networks are specified in CIDR format, see doc here: https://en.wikipedia.org/wiki/Classless_Inter-Domain_Routing
+
+    The networks are compiled into sorted, merged integer ranges per
+    address family, so a lookup is a binary search no matter how many
+    networks the ACL has. Verdicts are cached per peer address.
     '''
 
-    def __init__(self, list_cidr):
+    def __init__(self, list_cidr, cache_size=4096):
         '''
         Constructor for ACL class
 
+        :param cache_size: number of peer addresses whose verdict is
+          cached. The cache is emptied when it is full.
         :raises: ValueError if any of the items in the ACL are invalid CIDR notation
         '''
 
-        # split up the comma-separated list of networks in CIDR notation 
+        # split up the comma-separated list of networks in CIDR notation
         nets = list_cidr.split(',')
 
         # create empty list to store network objects
@@ -22,11 +72,21 @@ class ACL():
 
         for net in nets:
             try:
-                self.networks.append(ipaddress.IPv4Network(net))
+                self.networks.append(ipaddress.ip_network(net.strip()))
 
             except ValueError:
                 raise ValueError('Invalid IP ACL {0}'.format(net))
 
+        # family -> (first addresses, last addresses) of the allowed ranges
+        self.ranges = {}
+        for version in (4, 6):
+            self.ranges[version] = merge(
+                (int(net.network_address), int(net.broadcast_address))
+                for net in self.networks if net.version == version)
+
+        self.cache = {}
+        self.cache_size = cache_size
+
     def ip_allowed(self, ip):
         '''
         Checks networks to see if the ip should be allowed to access the proxy.
@@ -34,16 +94,16 @@ class ACL():
         :return: True or False if the IP is allowed.
         :raises: ValueError if an invalid IP address is passed into the function.
         '''
+        allowed = self.cache.get(ip)
+        if allowed is not None:
+            return allowed
 
-        try:
-            ip_address = ipaddress.IPv4Address(ip)
-
-        except ValueError:
-            raise ValueError('Invalid IP address {0}'.format(ip))
-
-        for net in self.networks:
-            if ip_address in net:
-                return True
-
-        return False
+        version, value = parse_ip(ip)
+        firsts, lasts = self.ranges[version]
+        index = bisect.bisect_right(firsts, value) - 1
+        allowed = index >= 0 and value <= lasts[index]
 
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[ip] = allowed
+        return allowed
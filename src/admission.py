@@ -0,0 +1,195 @@
+import collections
+
+
+class Saturated(Exception):
+    '''
+    Raised when a request cannot be served because a limit is reached and
+    the queue in front of it is full or was waited in for too long.
+    '''
+
+
+class Admission():
+    '''
+    Decides whether a new client connection is served, before anything is
+    read from it. The peer must be allowed by the ACL and may hold at most
+    `max_per_ip` connections at once, and at most `max_total` connections
+    may be open in total; 0 means no limit.
+    '''
+    ADMITTED = 'admitted'
+    DENIED = 'denied'
+    LIMITED = 'limited'
+    SATURATED = 'saturated'
+
+    def __init__(self, acl, max_per_ip, max_total=0):
+        self.acl = acl
+        self.max_per_ip = max_per_ip
+        self.max_total = max_total
+
+        # peer address -> number of open connections
+        self.active = {}
+        self.connections = 0
+
+        self.admitted = 0
+        self.denied = 0
+        self.limited = 0
+        self.saturated = 0
+
+    def admit(self, ip):
+        '''
+        Check a new connection from `ip`, which is None if the peer
+        address is unknown. An admitted connection must be released.
+
+        :return: ADMITTED, DENIED, LIMITED, or SATURATED.
+        '''
+        try:
+            allowed = ip is not None and self.acl.ip_allowed(ip)
+        except ValueError:
+            allowed = False
+        if not allowed:
+            self.denied += 1
+            return Admission.DENIED
+
+        if self.max_total and self.connections >= self.max_total:
+            self.saturated += 1
+            return Admission.SATURATED
+
+        count = self.active.get(ip, 0)
+        if self.max_per_ip and count >= self.max_per_ip:
+            self.limited += 1
+            return Admission.LIMITED
+
+        self.active[ip] = count + 1
+        self.connections += 1
+        self.admitted += 1
+        return Admission.ADMITTED
+
+    def release(self, ip):
+        '''
+        An admitted connection was closed.
+        '''
+        self.connections -= 1
+        count = self.active[ip] - 1
+        if count:
+            self.active[ip] = count
+        else:
+            del self.active[ip]
+
+    def stats(self):
+        return {
+            'admitted': self.admitted,
+            'denied': self.denied,
+            'limited': self.limited,
+            'saturated': self.saturated,
+            'peers': len(self.active),
+        }
+
+
+class ConnectLimiter():
+    '''
+    Limits the number of connections to remote servers that are being set
+    up at once, in total and per destination host; 0 means no limit.
+
+    Connects over a limit wait in a FIFO queue of at most `queue_size`
+    entries for up to `timeout` seconds. A waiting connect only waits for
+    the limits that apply to it, so a busy host does not hold up the
+    connects to other hosts.
+    '''
+    def __init__(self, loop, max_total, max_per_host, queue_size, timeout):
+        self.loop = loop
+        self.max_total = max_total
+        self.max_per_host = max_per_host
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+        # host -> number of connects in progress
+        self.active = {}
+        self.connecting = 0
+        # [host, future] of the waiting connects, in arrival order
+        self.waiters = collections.deque()
+
+        self.queued = 0
+        self.shed = 0
+        self.expired = 0
+
+    def available(self, host):
+        return ((not self.max_total or self.connecting < self.max_total) and
+                (not self.max_per_host or self.active.get(host, 0) < self.max_per_host))
+
+    def take(self, host):
+        self.connecting += 1
+        self.active[host] = self.active.get(host, 0) + 1
+
+    async def acquire(self, host):
+        '''
+        Wait until a connect to `host` may start. It must be released once
+        the connection is set up or failed.
+
+        :raises: Saturated if the queue is full or the connect waited for
+          longer than `timeout` seconds.
+        '''
+        # Waiters are granted as soon as their limits allow, so a connect
+        # that is within its limits does not overtake any of them.
+        if self.available(host):
+            self.take(host)
+            return
+
+        if len(self.waiters) >= self.queue_size:
+            self.shed += 1
+            raise Saturated('Connect queue is full')
+
+        self.queued += 1
+        waiter = self.loop.create_future()
+        entry = [host, waiter]
+        self.waiters.append(entry)
+        timer = self.loop.call_later(self.timeout, self.expire, entry)
+        try:
+            granted = await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                # Cancelled after the connect was granted
+                self.release(host)
+            elif entry in self.waiters:
+                self.waiters.remove(entry)
+            raise
+        finally:
+            timer.cancel()
+        if not granted:
+            self.expired += 1
+            raise Saturated('Waited too long for a connect to {0}'.format(host))
+
+    def expire(self, entry):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            if not entry[1].done():
+                entry[1].set_result(False)
+
+    def release(self, host):
+        '''
+        A connect to `host` finished, let waiting connects start.
+        '''
+        self.connecting -= 1
+        count = self.active[host] - 1
+        if count:
+            self.active[host] = count
+        else:
+            del self.active[host]
+
+        for entry in list(self.waiters):
+            if self.max_total and self.connecting >= self.max_total:
+                break
+            waiting_host, waiter = entry
+            if waiter.done():
+                self.waiters.remove(entry)
+            elif self.available(waiting_host):
+                self.waiters.remove(entry)
+                self.take(waiting_host)
+                waiter.set_result(True)
+
+    def stats(self):
+        return {
+            'connecting': self.connecting,
+            'waiting': len(self.waiters),
+            'queued': self.queued,
+            'shed': self.shed,
+            'expired': self.expired,
+        }
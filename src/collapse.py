@@ -0,0 +1,230 @@
+import asyncio
+
+import httpcache
+
+
+# Request headers that make a response specific to one client
+PRIVATE = ('authorization', 'cookie', 'range', 'if-match', 'if-none-match',
+           'if-modified-since', 'if-unmodified-since', 'if-range')
+
+# Request headers a shared response may vary on. They are part of the key,
+# so only requests with the same values share a response.
+KEY_HEADERS = ('accept-encoding',)
+
+
+def shareable(response):
+    '''
+    Indicate whether a response to one client may also be sent to other
+    clients that asked for the same URL.
+    '''
+    headers = response.headers
+    response_directives = httpcache.directives(headers)
+    return ('private' not in response_directives and
+            'no-store' not in response_directives and
+            'set-cookie' not in headers and
+            headers.tokens('vary') <= set(KEY_HEADERS))
+
+
+class Flight():
+    '''
+    A response from a remote server that the client of the leading
+    session and any number of followers wait for.
+
+    Followers can join until the first response data is dropped. That
+    happens once the response outgrows `retain` bytes; from then on data
+    is dropped as soon as every follower has sent it.
+    '''
+    def __init__(self, loop, key, retain, low_water):
+        self.loop = loop
+        self.key = key
+        self.retain = retain
+        self.low_water = low_water
+
+        # Response data from stream offset `base` to `end`
+        self.buffer = bytearray()
+        self.base = 0
+        self.end = 0
+
+        # None until the status of the response is known
+        self.status = None
+        self.shared = None
+        self.done = False
+        self.complete = False
+        self.keep_alive = False
+
+        # follower id -> stream offset sent to the follower's client
+        self.followers = {}
+        self.next_follower = 0
+        self.changed = None
+        self.drain_waiter = None
+
+    def joinable(self):
+        return not self.done and self.shared is not False and self.base == 0
+
+    def feed(self, data, response):
+        '''
+        Add response data that was forwarded to the leading client.
+        '''
+        if self.shared is False:
+            return
+        self.buffer += data
+        self.end += len(data)
+        if self.shared is None and response.status is not None:
+            self.status = response.status
+            self.shared = shareable(response)
+            if not self.shared:
+                self.buffer = bytearray()
+        self.trim()
+        self.notify()
+
+    def finish(self, response):
+        '''
+        The leading session is done. `response` is its parser, or None if
+        no response was received.
+        '''
+        self.done = True
+        if self.shared is None:
+            self.shared = False
+        if response is not None:
+            self.complete = response.complete
+            self.keep_alive = response.keep_alive
+        self.notify()
+
+    def notify(self):
+        changed, self.changed = self.changed, None
+        if changed is not None and not changed.done():
+            changed.set_result(None)
+
+    def backlog(self):
+        '''
+        :return: the number of bytes the slowest follower is behind.
+        '''
+        if not self.followers:
+            return 0
+        return self.end - min(self.followers.values())
+
+    def trim(self):
+        '''
+        Drop the data every follower has sent, unless the whole response
+        so far fits in `retain` bytes.
+        '''
+        if self.base or self.end > self.retain:
+            low = min(self.followers.values()) if self.followers else self.end
+            del self.buffer[:low - self.base]
+            self.base = low
+
+        waiter = self.drain_waiter
+        if waiter is not None and self.backlog() <= self.low_water:
+            self.drain_waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def drain(self):
+        '''
+        Wait until the slowest follower is at most `low_water` bytes behind.
+        '''
+        if self.backlog() <= self.low_water:
+            return
+        if self.drain_waiter is None:
+            self.drain_waiter = self.loop.create_future()
+        await asyncio.shield(self.drain_waiter)
+
+    async def follow(self, writer, persistent):
+        '''
+        Send the response to the client of a follower as it arrives.
+
+        :return: None if the response cannot be shared and the follower
+          has to make its own request. Otherwise whether the client
+          connection can be used for another request.
+        '''
+        follower = self.next_follower
+        self.next_follower += 1
+        self.followers[follower] = self.base
+        try:
+            offset = self.base
+            while True:
+                if self.shared is False:
+                    return None
+                if self.shared and offset < self.end:
+                    writer.write(bytes(self.buffer[offset - self.base:]))
+                    offset = self.followers[follower] = self.end
+                    self.trim()
+                    await writer.drain()
+                    continue
+                if self.done:
+                    return self.complete and self.keep_alive and persistent
+                if self.changed is None:
+                    self.changed = self.loop.create_future()
+                await asyncio.shield(self.changed)
+        finally:
+            del self.followers[follower]
+            self.trim()
+
+
+class Flights():
+    '''
+    Collapses concurrent identical GET requests into one request to the
+    remote server whose response is streamed to every client.
+    '''
+    def __init__(self, loop, retain, low_water):
+        self.loop = loop
+        self.retain = retain
+        self.low_water = low_water
+
+        # key -> Flight
+        self.flights = {}
+
+        self.leaders = 0
+        self.followers = 0
+        self.refetches = 0
+
+    @staticmethod
+    def key(request):
+        '''
+        :return: the key of requests that can share a response, or None if
+          the request cannot share one.
+        '''
+        headers = request.headers
+        if (request.method != 'GET' or 'transfer-encoding' in headers or
+                headers.get('content-length', '0') != '0' or
+                any(name in headers for name in PRIVATE) or
+                'no-cache' in httpcache.directives(headers)):
+            return None
+        return ((request.host.lower(), int(request.port), request.path, request.version) +
+                tuple(headers.get(name, '') for name in KEY_HEADERS))
+
+    def join(self, key):
+        '''
+        :return: the flight of an identical request that can be followed,
+          or None.
+        '''
+        flight = self.flights.get(key)
+        if flight is None or not flight.joinable():
+            return None
+        self.followers += 1
+        return flight
+
+    def start(self, key):
+        '''
+        :return: a new Flight that later identical requests can follow.
+        '''
+        flight = Flight(self.loop, key, self.retain, self.low_water)
+        self.flights[key] = flight
+        self.leaders += 1
+        return flight
+
+    def land(self, flight, response):
+        '''
+        End a flight once the leading session is done.
+        '''
+        flight.finish(response)
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def stats(self):
+        return {
+            'in_flight': len(self.flights),
+            'leaders': self.leaders,
+            'followers': self.followers,
+            'refetches': self.refetches,
+        }
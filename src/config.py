@@ -1,8 +1,44 @@
-#import logging
+import logging
 import os
+import tempfile
 
 DEFAULT_REFRESH = 3600
-DEFAULT_TIMEOUT = 150
+DEFAULT_LISTEN_PORT = 3128
+DEFAULT_METRICS_PORT = 9128
+DEFAULT_WORKERS = 1
+DEFAULT_HEARTBEAT_INTERVAL = 5
+DEFAULT_WORKER_TIMEOUT = 30
+DEFAULT_SHUTDOWN_GRACE = 30
+DEFAULT_LIST_TIMEOUT = 30
+DEFAULT_KEEPALIVE_TIMEOUT = 60
+DEFAULT_HEADER_TIMEOUT = 10
+DEFAULT_MAX_CONNECTIONS_PER_IP = 256
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_MAX_CONNECTS = 256
+DEFAULT_MAX_CONNECTS_PER_HOST = 32
+DEFAULT_CONNECT_QUEUE = 1024
+DEFAULT_CONNECT_QUEUE_TIMEOUT = 5
+DEFAULT_RETRY_AFTER = 1
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_CONNECT_ATTEMPT_DELAY = 250
+DEFAULT_BUFFER_HIGH = 64 * 1024
+DEFAULT_BUFFER_LOW = 16 * 1024
+DEFAULT_POOL_MAX_IDLE = 100
+DEFAULT_POOL_MAX_PER_HOST = 8
+DEFAULT_POOL_IDLE_TIMEOUT = 30
+DEFAULT_VERDICT_CACHE_SIZE = 10000
+DEFAULT_CACHE_MEMORY = 64 * 1024 * 1024
+DEFAULT_CACHE_MEMORY_FILE_MAX = 1024 * 1024
+DEFAULT_HTTP_CACHE_SIZE = 0
+DEFAULT_TUNNEL_BUFFER = 256 * 1024
+DEFAULT_HTTP_CACHE_MAX_OBJECT = 1024 * 1024
+DEFAULT_DNS_TTL = 300
+DEFAULT_DNS_NEGATIVE_TTL = 30
+DEFAULT_DNS_WORKERS = 16
+DEFAULT_DNS_CACHE_SIZE = 10000
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_ACCESS_LOG_BATCH = 64
+DEFAULT_ACCESS_LOG_INTERVAL = 1
 
 blacklist = os.getenv('BLACKLIST',
                       'https://kalamari-proxy.github.io/lists/blacklist.json')
@@ -10,6 +46,83 @@ whitelist = os.getenv('WHITELIST',
                       'https://kalamari-proxy.github.io/lists/whitelist.json')
 cachelist = os.getenv('CACHELIST',
                       'https://kalamari-proxy.github.io/lists/cachelist.json')
+listen_host = os.getenv('LISTEN_HOST', '0.0.0.0')
+
+# Level of the log messages, e.g. DEBUG, INFO or WARNING.
+log_level = os.getenv('LOG_LEVEL', DEFAULT_LOG_LEVEL).upper()
+if not isinstance(logging.getLevelName(log_level), int):
+    logging.warn('Unknown LOG_LEVEL %s, using %s.' % (log_level, DEFAULT_LOG_LEVEL))
+    log_level = DEFAULT_LOG_LEVEL
+
+# File that gets one JSON line per request, '-' for standard output. Set
+# ACCESS_LOG to an empty string to disable it. Lines are written in batches
+# of up to ACCESS_LOG_BATCH lines, at most ACCESS_LOG_INTERVAL seconds
+# after a request was answered.
+access_log = os.getenv('ACCESS_LOG', '-')
+
+try:
+    access_log_batch = int(os.getenv('ACCESS_LOG_BATCH', DEFAULT_ACCESS_LOG_BATCH))
+    access_log_interval = int(os.getenv('ACCESS_LOG_INTERVAL', DEFAULT_ACCESS_LOG_INTERVAL))
+except ValueError:
+    logging.warn('Could not parse ACCESS_LOG_BATCH/ACCESS_LOG_INTERVAL environment variables as integers.')
+    access_log_batch = DEFAULT_ACCESS_LOG_BATCH
+    access_log_interval = DEFAULT_ACCESS_LOG_INTERVAL
+
+try:
+    listen_port = int(os.getenv('LISTEN_PORT', DEFAULT_LISTEN_PORT))
+except ValueError:
+    logging.warn('Could not parse LISTEN_PORT environment variable as an integer.')
+    listen_port = DEFAULT_LISTEN_PORT
+
+# Admin port that serves metrics in the Prometheus text format at
+# /metrics. Set METRICS_PORT to 0 to disable it.
+metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+
+try:
+    metrics_port = int(os.getenv('METRICS_PORT', DEFAULT_METRICS_PORT))
+except ValueError:
+    logging.warn('Could not parse METRICS_PORT environment variable as an integer.')
+    metrics_port = DEFAULT_METRICS_PORT
+
+# Number of worker processes. With more than one, a supervisor process
+# forks the workers, refreshes the lists for all of them and restarts
+# workers that die or stop sending heartbeats.
+try:
+    workers = int(os.getenv('WORKERS', DEFAULT_WORKERS))
+    heartbeat_interval = int(os.getenv('HEARTBEAT_INTERVAL', DEFAULT_HEARTBEAT_INTERVAL))
+    worker_timeout = int(os.getenv('WORKER_TIMEOUT', DEFAULT_WORKER_TIMEOUT))
+    shutdown_grace = int(os.getenv('SHUTDOWN_GRACE', DEFAULT_SHUTDOWN_GRACE))
+except ValueError:
+    logging.warn('Could not parse WORKERS/HEARTBEAT_INTERVAL/WORKER_TIMEOUT/SHUTDOWN_GRACE environment variables as integers.')
+    workers = DEFAULT_WORKERS
+    heartbeat_interval = DEFAULT_HEARTBEAT_INTERVAL
+    worker_timeout = DEFAULT_WORKER_TIMEOUT
+    shutdown_grace = DEFAULT_SHUTDOWN_GRACE
+
+# If set to 1, every worker binds its own listening socket with
+# SO_REUSEPORT and the kernel balances connections between them. Otherwise
+# the workers accept on one socket inherited from the supervisor.
+reuse_port = os.getenv('REUSE_PORT', '0') == '1'
+
+# If set to 1, concurrent identical GET requests are sent to the remote
+# server once and the response is streamed to every waiting client.
+collapsed_forwarding = os.getenv('COLLAPSED_FORWARDING', '1') == '1'
+
+# CONNECT tunnels relay between the client and remote sockets directly
+# with buffers of TUNNEL_BUFFER bytes. On Linux with Python 3.10+ the data
+# is moved with splice() and never copied to user space. Set TUNNEL_RAW=0
+# to relay through the asyncio transports instead, or TUNNEL_SPLICE=0 to
+# always use recv_into().
+tunnel_raw = os.getenv('TUNNEL_RAW', '1') == '1'
+tunnel_splice = os.getenv('TUNNEL_SPLICE', '1') == '1'
+
+try:
+    tunnel_buffer = int(os.getenv('TUNNEL_BUFFER', DEFAULT_TUNNEL_BUFFER))
+except ValueError:
+    logging.warn('Could not parse TUNNEL_BUFFER environment variable as an integer.')
+    tunnel_buffer = DEFAULT_TUNNEL_BUFFER
+
+# Comma-separated IPv4 and IPv6 networks whose clients may use the proxy
 ip_acl = os.getenv('IP_ACL', '192.168.1.0/24,127.0.0.0/8,172.17.0.1/32')
 
 try:
@@ -18,11 +131,143 @@ except ValueError:
     logging.warn('Could not parse REFRESH environment variable an an integer.')
     list_refresh = DEFAULT_REFRESH
 
+try:
+    list_timeout = int(os.getenv('LIST_TIMEOUT', DEFAULT_LIST_TIMEOUT))
+except ValueError:
+    logging.warn('Could not parse LIST_TIMEOUT environment variable as an integer.')
+    list_timeout = DEFAULT_LIST_TIMEOUT
+
+# Directory for the last good copy of each list. Set to an empty string to
+# disable saving the lists.
+list_cache_dir = os.getenv('LIST_CACHE_DIR',
+                           os.path.join(tempfile.gettempdir(), 'kalamari-lists'))
+
 webserver_ip = os.getenv('WEBSERVER_IP', '127.0.0.1')
 webserver_port = os.getenv('WEBSERVER_PORT', '8080')
 
+# Directory that the web server above serves. Cache list hits that point
+# to the web server are served by Kalamari directly from this directory.
+# Set to an empty string to proxy them to the web server instead.
+cache_root = os.getenv('CACHE_ROOT', '/var/www/cached')
+
+# Size of the memory tier for files in CACHE_ROOT and of the largest file
+# kept in it, in bytes. Larger files are sent from disk.
+try:
+    cache_memory = int(os.getenv('CACHE_MEMORY', DEFAULT_CACHE_MEMORY))
+    cache_memory_file_max = int(os.getenv('CACHE_MEMORY_FILE_MAX', DEFAULT_CACHE_MEMORY_FILE_MAX))
+except ValueError:
+    logging.warn('Could not parse CACHE_MEMORY/CACHE_MEMORY_FILE_MAX environment variables as integers.')
+    cache_memory = DEFAULT_CACHE_MEMORY
+    cache_memory_file_max = DEFAULT_CACHE_MEMORY_FILE_MAX
+
+# Size of the shared cache for responses to plain HTTP GET requests and of
+# the largest response kept in it, in bytes. Responses are cached as
+# allowed by their Cache-Control and Expires headers and revalidated with
+# their ETag or Last-Modified header. The cache is disabled when
+# HTTP_CACHE_SIZE is 0.
+try:
+    http_cache_size = int(os.getenv('HTTP_CACHE_SIZE', DEFAULT_HTTP_CACHE_SIZE))
+    http_cache_max_object = int(os.getenv('HTTP_CACHE_MAX_OBJECT', DEFAULT_HTTP_CACHE_MAX_OBJECT))
+except ValueError:
+    logging.warn('Could not parse HTTP_CACHE_SIZE/HTTP_CACHE_MAX_OBJECT environment variables as integers.')
+    http_cache_size = DEFAULT_HTTP_CACHE_SIZE
+    http_cache_max_object = DEFAULT_HTTP_CACHE_MAX_OBJECT
+
+# Seconds to resolve and connect to a remote server, and milliseconds to
+# wait for a connection attempt before also trying the next address.
+try:
+    connect_timeout = int(os.getenv('CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT))
+    connect_attempt_delay = int(os.getenv('CONNECT_ATTEMPT_DELAY', DEFAULT_CONNECT_ATTEMPT_DELAY))
+except ValueError:
+    logging.warn('Could not parse CONNECT_TIMEOUT/CONNECT_ATTEMPT_DELAY environment variables as integers.')
+    connect_timeout = DEFAULT_CONNECT_TIMEOUT
+    connect_attempt_delay = DEFAULT_CONNECT_ATTEMPT_DELAY
+
+# TIMEOUT bounded the connect to a remote server before CONNECT_TIMEOUT
+# replaced it. It still applies if CONNECT_TIMEOUT is not set.
+if os.getenv('TIMEOUT') is not None:
+    logging.warn('The TIMEOUT environment variable is deprecated, use CONNECT_TIMEOUT instead.')
+    if os.getenv('CONNECT_TIMEOUT') is None:
+        try:
+            connect_timeout = int(os.getenv('TIMEOUT'))
+        except ValueError:
+            logging.warn('Could not parse TIMEOUT environment variable as an integer.')
+
+try:
+    keepalive_timeout = int(os.getenv('KEEPALIVE_TIMEOUT', DEFAULT_KEEPALIVE_TIMEOUT))
+except ValueError:
+    logging.warn('Could not parse KEEPALIVE_TIMEOUT environment variable as an integer.')
+    keepalive_timeout = DEFAULT_KEEPALIVE_TIMEOUT
+
+# Seconds a client has to send the request line and headers once it has
+# started a request, and the number of connections one client address may
+# hold open at once (0 for no limit).
+try:
+    header_timeout = int(os.getenv('HEADER_TIMEOUT', DEFAULT_HEADER_TIMEOUT))
+    max_connections_per_ip = int(os.getenv('MAX_CONNECTIONS_PER_IP', DEFAULT_MAX_CONNECTIONS_PER_IP))
+except ValueError:
+    logging.warn('Could not parse HEADER_TIMEOUT/MAX_CONNECTIONS_PER_IP environment variables as integers.')
+    header_timeout = DEFAULT_HEADER_TIMEOUT
+    max_connections_per_ip = DEFAULT_MAX_CONNECTIONS_PER_IP
+
+# Load shedding: at most MAX_CONNECTIONS client connections are open at
+# once, and at most MAX_CONNECTS connections to remote servers, and
+# MAX_CONNECTS_PER_HOST to one host, are being set up at once (0 for no
+# limit). Connects over the limits wait in a queue of CONNECT_QUEUE
+# entries for up to CONNECT_QUEUE_TIMEOUT seconds. Clients over a limit
+# get a 503 that asks them to retry after RETRY_AFTER seconds.
+try:
+    max_connections = int(os.getenv('MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS))
+    max_connects = int(os.getenv('MAX_CONNECTS', DEFAULT_MAX_CONNECTS))
+    max_connects_per_host = int(os.getenv('MAX_CONNECTS_PER_HOST', DEFAULT_MAX_CONNECTS_PER_HOST))
+    connect_queue = int(os.getenv('CONNECT_QUEUE', DEFAULT_CONNECT_QUEUE))
+    connect_queue_timeout = int(os.getenv('CONNECT_QUEUE_TIMEOUT', DEFAULT_CONNECT_QUEUE_TIMEOUT))
+    retry_after = int(os.getenv('RETRY_AFTER', DEFAULT_RETRY_AFTER))
+except ValueError:
+    logging.warn('Could not parse MAX_CONNECTIONS/MAX_CONNECTS/MAX_CONNECTS_PER_HOST/CONNECT_QUEUE/CONNECT_QUEUE_TIMEOUT/RETRY_AFTER environment variables as integers.')
+    max_connections = DEFAULT_MAX_CONNECTIONS
+    max_connects = DEFAULT_MAX_CONNECTS
+    max_connects_per_host = DEFAULT_MAX_CONNECTS_PER_HOST
+    connect_queue = DEFAULT_CONNECT_QUEUE
+    connect_queue_timeout = DEFAULT_CONNECT_QUEUE_TIMEOUT
+    retry_after = DEFAULT_RETRY_AFTER
+
+try:
+    buffer_high = int(os.getenv('BUFFER_HIGH', DEFAULT_BUFFER_HIGH))
+    buffer_low = int(os.getenv('BUFFER_LOW', DEFAULT_BUFFER_LOW))
+except ValueError:
+    logging.warn('Could not parse BUFFER_HIGH/BUFFER_LOW environment variables as integers.')
+    buffer_high = DEFAULT_BUFFER_HIGH
+    buffer_low = DEFAULT_BUFFER_LOW
+
+try:
+    pool_max_idle = int(os.getenv('POOL_MAX_IDLE', DEFAULT_POOL_MAX_IDLE))
+    pool_max_per_host = int(os.getenv('POOL_MAX_PER_HOST', DEFAULT_POOL_MAX_PER_HOST))
+    pool_idle_timeout = int(os.getenv('POOL_IDLE_TIMEOUT', DEFAULT_POOL_IDLE_TIMEOUT))
+except ValueError:
+    logging.warn('Could not parse POOL_* environment variables as integers.')
+    pool_max_idle = DEFAULT_POOL_MAX_IDLE
+    pool_max_per_host = DEFAULT_POOL_MAX_PER_HOST
+    pool_idle_timeout = DEFAULT_POOL_IDLE_TIMEOUT
+
+# Number of host and path pairs whose list verdict is remembered. Set to 0
+# to check the lists on every request.
+try:
+    verdict_cache_size = int(os.getenv('VERDICT_CACHE_SIZE', DEFAULT_VERDICT_CACHE_SIZE))
+except ValueError:
+    logging.warn('Could not parse VERDICT_CACHE_SIZE environment variable as an integer.')
+    verdict_cache_size = DEFAULT_VERDICT_CACHE_SIZE
+
+# Lifetime in seconds of resolved and failed DNS lookups of remote servers,
+# and the number of threads that run lookups.
 try:
-    timeout = os.getenv('TIMEOUT', DEFAULT_TIMEOUT)
+    dns_ttl = int(os.getenv('DNS_TTL', DEFAULT_DNS_TTL))
+    dns_negative_ttl = int(os.getenv('DNS_NEGATIVE_TTL', DEFAULT_DNS_NEGATIVE_TTL))
+    dns_workers = int(os.getenv('DNS_WORKERS', DEFAULT_DNS_WORKERS))
+    dns_cache_size = int(os.getenv('DNS_CACHE_SIZE', DEFAULT_DNS_CACHE_SIZE))
 except ValueError:
-    logging.warn('Could not parse TIMEOUT environment variable as an integer.')
-    timeout = DEFAULT_TIMEOUT
+    logging.warn('Could not parse DNS_* environment variables as integers.')
+    dns_ttl = DEFAULT_DNS_TTL
+    dns_negative_ttl = DEFAULT_DNS_NEGATIVE_TTL
+    dns_workers = DEFAULT_DNS_WORKERS
+    dns_cache_size = DEFAULT_DNS_CACHE_SIZE
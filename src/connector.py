@@ -0,0 +1,94 @@
+import asyncio
+import collections
+import logging
+import socket
+
+
+def interleave(addresses):
+    '''
+    Order getaddrinfo() results so that the address families alternate,
+    starting with the family of the first result (RFC 8305 section 4).
+    '''
+    families = collections.OrderedDict()
+    for address in addresses:
+        families.setdefault(address[0], collections.deque()).append(address)
+
+    ordered = []
+    queues = list(families.values())
+    while queues:
+        for queue in queues:
+            ordered.append(queue.popleft())
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+
+async def connect_socket(loop, address):
+    '''
+    Open a non-blocking socket and connect it to a getaddrinfo() result.
+
+    :return: the connected socket.
+    '''
+    family, type_, proto, canonname, sockaddr = address
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def open_socket(loop, addresses, delay):
+    '''
+    Race connections to `addresses` like Happy Eyeballs (RFC 8305). The
+    next address is tried when the previous attempt fails or has not
+    succeeded within `delay` seconds, while the earlier attempts keep
+    going. The first connection wins and the other attempts are
+    cancelled, so one unreachable address does not stall the request.
+
+    :return: the connected socket.
+    :raises: OSError if every attempt failed.
+    '''
+    pending = set()
+    errors = []
+    winner = None
+
+    def collect(done):
+        nonlocal winner
+        for task in done:
+            pending.discard(task)
+            if task.exception() is not None:
+                errors.append(task.exception())
+            elif winner is None:
+                winner = task.result()
+            else:
+                task.result().close()
+
+    try:
+        for address in interleave(addresses):
+            pending.add(asyncio.ensure_future(connect_socket(loop, address), loop=loop))
+            done, _ = await asyncio.wait(pending, timeout=delay,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            collect(done)
+            if winner is not None:
+                return winner
+
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            collect(done)
+            if winner is not None:
+                return winner
+    finally:
+        for task in pending:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                # Connected after the last wait, while this coroutine was
+                # being cancelled.
+                task.result().close()
+
+    if len(errors) == 1:
+        raise errors[0]
+    logging.debug('Every connection attempt failed: %s' % errors)
+    raise OSError('Multiple exceptions: {}'.format(', '.join(str(err) for err in errors)))
@@ -0,0 +1,121 @@
+import os
+import stat
+import logging
+import mimetypes
+import collections
+import urllib.parse
+import email.utils
+
+
+class CachedFile():
+    '''
+    A file under the cache root. Small files carry their content in
+    `data`; larger ones are sent from disk.
+    '''
+    def __init__(self, path, st, data=None):
+        self.path = path
+        self.size = st.st_size
+        self.version = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.data = data
+
+
+class FileCache():
+    '''
+    Looks up the files that cache list rules point to, so the proxy can
+    serve them itself instead of proxying to the local web server.
+
+    Files of at most `max_file_size` bytes are kept in memory in an LRU
+    of at most `max_bytes` bytes. Every lookup checks the file on disk, so
+    a changed or deleted file is never served from memory.
+    '''
+    def __init__(self, root, max_bytes, max_file_size):
+        self.root = os.path.realpath(root)
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+
+        # path -> CachedFile, least recently used first
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def resolve(self, url_path):
+        '''
+        :return: the file system path for the path of a URL, or None if it
+          is outside the cache root.
+        '''
+        url_path = urllib.parse.unquote(url_path.split('?', 1)[0])
+        path = os.path.realpath(os.path.join(self.root, url_path.lstrip('/')))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def lookup(self, url_path):
+        '''
+        :return: a CachedFile, or None if there is no such file.
+        '''
+        path = self.resolve(url_path)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+            if stat.S_ISDIR(st.st_mode):
+                path = os.path.join(path, 'index.html')
+                st = os.stat(path)
+        except OSError:
+            self.forget(path)
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        cached = self.memory.get(path)
+        if cached is not None:
+            if cached.version == (st.st_ino, st.st_size, st.st_mtime_ns):
+                self.memory.move_to_end(path)
+                self.hits += 1
+                return cached
+            self.forget(path)
+
+        self.misses += 1
+        if st.st_size > self.max_file_size or st.st_size > self.max_bytes:
+            return CachedFile(path, st)
+
+        try:
+            with open(path, 'rb') as cached_file:
+                data = cached_file.read(st.st_size + 1)
+        except OSError as err:
+            logging.warning('Could not read %s: %s' % (path, err))
+            return None
+        if len(data) != st.st_size:
+            # The file changed while it was read, send it from disk.
+            return CachedFile(path, st)
+
+        cached = CachedFile(path, st, data)
+        self.memory[path] = cached
+        self.memory_bytes += cached.size
+        while self.memory_bytes > self.max_bytes:
+            path, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.size
+            self.evictions += 1
+        return cached
+
+    def forget(self, path):
+        cached = self.memory.pop(path, None)
+        if cached is not None:
+            self.memory_bytes -= cached.size
+
+    def stats(self):
+        '''
+        :return: a dict of cache counters for sizing the memory tier.
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'files': len(self.memory),
+            'bytes': self.memory_bytes,
+        }
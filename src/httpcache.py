@@ -0,0 +1,345 @@
+import time
+import collections
+import email.utils
+
+import message
+
+
+# Response headers that only apply to one connection (RFC 7230 section 6.1)
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+              'upgrade', 'proxy-authenticate', 'proxy-authorization'}
+
+# Headers of a 304 response that must not replace the stored ones
+NOT_UPDATED = {'content-length', 'transfer-encoding', 'content-encoding', 'content-range'}
+
+# Status codes that may be cached with a heuristic lifetime (RFC 7231
+# section 6.1)
+HEURISTIC_STATUS = {200, 203, 204, 300, 301, 404, 405, 410, 414, 501}
+
+# Upper bound of a heuristic lifetime, which is a tenth of the time since
+# the response was last modified.
+HEURISTIC_MAX = 24 * 3600
+
+# Request headers that make the client expect something other than the
+# full stored response.
+BYPASS = ('authorization', 'range', 'if-match', 'if-none-match',
+          'if-modified-since', 'if-unmodified-since', 'if-range')
+
+UNSAFE_METHODS = {'POST', 'PUT', 'DELETE', 'PATCH'}
+
+
+def directives(headers):
+    '''
+    Parse the Cache-Control header of a message.
+
+    :return: a dict of lowercased directives to their argument, or None
+      for directives without one.
+    '''
+    result = {}
+    for value in headers.get_all('cache-control'):
+        for part in value.split(','):
+            name, sep, argument = part.strip().partition('=')
+            if name:
+                result[name.lower()] = argument.strip('"') if sep else None
+    return result
+
+
+def seconds(value):
+    '''
+    :return: a delta-seconds value as an int, or None if it is invalid.
+    '''
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def http_date(value):
+    '''
+    :return: an HTTP date as a Unix timestamp, or None if it is invalid.
+    '''
+    if not value:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+class CacheEntry():
+    '''
+    A stored response. The body is kept with the framing it was received
+    with, so the head keeps its Content-Length or Transfer-Encoding.
+    '''
+    def __init__(self, status_line, status, headers, body, request_time, response_time):
+        self.status_line = status_line
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.update(headers, request_time, response_time)
+
+    def update(self, headers, request_time, response_time):
+        '''
+        Compute the age and lifetime of the response (RFC 7234 section 4.2).
+        '''
+        self.headers = headers
+        self.directives = directives(headers)
+        self.response_time = response_time
+
+        date = http_date(headers.get('date'))
+        if date is None:
+            date = response_time
+        apparent_age = max(0, response_time - date)
+        corrected_age = (seconds(headers.get('age')) or 0) + (response_time - request_time)
+        self.initial_age = max(apparent_age, corrected_age)
+
+        if 's-maxage' in self.directives:
+            self.lifetime = seconds(self.directives['s-maxage']) or 0
+        elif 'max-age' in self.directives:
+            self.lifetime = seconds(self.directives['max-age']) or 0
+        elif 'expires' in headers:
+            expires = http_date(headers.get('expires'))
+            self.lifetime = max(0, expires - date) if expires is not None else 0
+        else:
+            last_modified = http_date(headers.get('last-modified'))
+            if last_modified is not None and self.status in HEURISTIC_STATUS:
+                self.lifetime = min(HEURISTIC_MAX, max(0, (date - last_modified) // 10))
+            else:
+                self.lifetime = 0
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(name) + len(value) for name, value in self.headers.items())
+
+    def age(self, now):
+        return self.initial_age + now - self.response_time
+
+    def fresh(self, now, request_directives):
+        if 'no-cache' in self.directives:
+            return False
+        age = self.age(now)
+        lifetime = self.lifetime
+        if 'max-age' in request_directives:
+            lifetime = min(lifetime, seconds(request_directives['max-age']) or 0)
+        min_fresh = seconds(request_directives.get('min-fresh')) or 0
+        return age + min_fresh < lifetime
+
+    def validators(self):
+        '''
+        :return: a list of conditional request headers to revalidate the
+          response.
+        '''
+        conditions = []
+        if self.headers.get('etag'):
+            conditions.append(('If-None-Match', self.headers.get('etag')))
+        if self.headers.get('last-modified'):
+            conditions.append(('If-Modified-Since', self.headers.get('last-modified')))
+        return conditions
+
+    def head(self, now, close=False):
+        '''
+        :return: the status line and headers to send to a client.
+        '''
+        options = self.headers.tokens('connection')
+        lines = [self.status_line]
+        for name, value in self.headers.items():
+            lower = name.lower()
+            if lower in HOP_BY_HOP or lower in options or lower == 'age':
+                continue
+            lines.append('{0}: {1}'.format(name, value))
+        lines.append('Age: {0}'.format(int(self.age(now))))
+        if close:
+            lines.append('Connection: close')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+
+
+class HTTPCache():
+    '''
+    Shared cache of GET responses from remote servers (RFC 7234).
+
+    Responses are stored if they are complete, at most `max_object_size`
+    bytes, and allowed to be stored by a shared cache. Each stored
+    response is kept per URL, per HTTP version of the request, since the
+    body keeps the framing the remote chose for that version, and per
+    value of the request headers named in its Vary header. The least
+    recently used responses are evicted once the cache holds more than
+    `max_bytes` bytes.
+    '''
+    def __init__(self, max_bytes, max_object_size):
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+
+        # (url, HTTP version, values of the Vary headers) -> CacheEntry,
+        # oldest first
+        self.entries = collections.OrderedDict()
+        # url -> names of the request headers the stored response varies on
+        self.vary = {}
+        # url -> keys of its entries, so a URL is dropped without a scan
+        self.keys = {}
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def url(request):
+        return (request.host.lower(), int(request.port), request.path)
+
+    def variant(self, request):
+        url = HTTPCache.url(request)
+        names = self.vary.get(url, ())
+        return (url, request.version,
+                tuple(request.headers.get(name, '') for name in names))
+
+    def lookup(self, request, now=None):
+        '''
+        Find the stored response for a request. Requests with unsafe
+        methods invalidate the stored response of their URL.
+
+        :return: a tuple of the CacheEntry and whether it is fresh, or None.
+          A stale entry can be revalidated with its validators.
+        '''
+        if request.method in UNSAFE_METHODS:
+            self.invalidate(request)
+            return None
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        if any(name in request.headers for name in BYPASS):
+            return None
+
+        request_directives = directives(request.headers)
+        if 'no-cache' in request.headers.tokens('pragma'):
+            request_directives.setdefault('no-cache', None)
+        if 'no-store' in request_directives:
+            return None
+
+        entry = self.entries.get(self.variant(request))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(self.variant(request))
+
+        now = time.time() if now is None else now
+        if 'no-cache' not in request_directives and entry.fresh(now, request_directives):
+            self.hits += 1
+            if request.method == 'GET':
+                self.bytes_saved += len(entry.body)
+            return entry, True
+        if entry.validators():
+            return entry, False
+        self.misses += 1
+        return None
+
+    def storable_request(self, request):
+        '''
+        Indicate whether the response to a request may be stored.
+        '''
+        if request.method != 'GET' or any(name in request.headers for name in BYPASS):
+            return False
+        return 'no-store' not in directives(request.headers)
+
+    def store(self, request, response, raw, request_time, response_time):
+        '''
+        Store a complete response. `raw` holds the response as received
+        from the remote server.
+
+        :return: True if the response was stored.
+        '''
+        headers = response.headers
+        response_directives = directives(headers)
+        if (not response.complete or response.status == 206 or
+                response.body.mode == message.BodyFramer.CLOSE or
+                'no-store' in response_directives or 'private' in response_directives or
+                'set-cookie' in headers or '*' in headers.tokens('vary') or
+                len(raw) > self.max_object_size or len(raw) > self.max_bytes):
+            return False
+
+        end = message.HEAD_END.search(raw)
+        if end is None:
+            return False
+        status_line, head = message.parse_head(raw[:end.end()])
+        if status_line.split(' ', 2)[1:2] != [str(response.status)]:
+            return False  # an interim response was received first
+
+        entry = CacheEntry(status_line, response.status, headers, raw[end.end():],
+                           request_time, response_time)
+        if entry.lifetime <= 0 and not entry.validators():
+            return False
+
+        self.invalidate(request)
+        url = HTTPCache.url(request)
+        self.vary[url] = tuple(sorted(headers.tokens('vary')))
+        key = self.variant(request)
+        self.entries[key] = entry
+        self.keys.setdefault(url, set()).add(key)
+        self.size += entry.size
+        self.stores += 1
+        self.evict()
+        return True
+
+    def revalidated(self, request, entry, headers, request_time, response_time):
+        '''
+        Update a stored response with the headers of a 304 response.
+
+        :return: the updated entry.
+        '''
+        fields = [(name, value) for name, value in headers.items()
+                  if name.lower() not in NOT_UPDATED]
+        updated = {name.lower() for name, value in fields}
+        merged = message.Headers(
+            [(name, value) for name, value in entry.headers.items()
+             if name.lower() not in updated] + fields)
+
+        self.size -= entry.size
+        entry.update(merged, request_time, response_time)
+        self.size += entry.size
+        self.revalidations += 1
+        if request.method == 'GET':
+            self.bytes_saved += len(entry.body)
+        self.evict()
+        return entry
+
+    def invalidate(self, request):
+        url = HTTPCache.url(request)
+        if url not in self.vary:
+            return
+        del self.vary[url]
+        for key in self.keys.pop(url, ()):
+            self.size -= self.entries.pop(key).size
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+            url = key[0]
+            keys = self.keys[url]
+            keys.discard(key)
+            if not keys:
+                del self.keys[url]
+                self.vary.pop(url, None)
+
+    def stats(self):
+        '''
+        :return: a dict of cache counters. Revalidated responses count as
+          hits in the hit ratio.
+        '''
+        lookups = self.hits + self.revalidations + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'bytes_saved': self.bytes_saved,
+            'hit_ratio': (self.hits + self.revalidations) / lookups if lookups else 0.0,
+        }
@@ -5,16 +5,29 @@ import proxy
 import os
 
 import config
+import metrics
+import accesslog
+import supervisor
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
+    logging.basicConfig(level=config.log_level)
+
+    if config.workers > 1:
+        # The workers move logging to a background thread themselves.
+        supervisor.Supervisor(config.workers, config.reuse_port).run()
+        raise SystemExit
+
+    listeners = accesslog.setup_logging(config.log_level, config.access_log)
 
     loop = asyncio.get_event_loop()
     proxy_instance = proxy.ProxyServer(loop)
-    coro = asyncio.start_server(proxy_instance.handler, '0.0.0.0', 3128,
-                                loop=loop)
+    coro = asyncio.start_server(proxy_instance.handler, config.listen_host,
+                                config.listen_port)
     server = loop.run_until_complete(coro)
+    if config.metrics_port:
+        loop.run_until_complete(metrics.start_server(proxy_instance.registry.collect,
+                                                     config.metrics_host, config.metrics_port))
     try:
         loop.run_forever()
     except KeyboardInterrupt:
@@ -22,4 +35,7 @@ if __name__ == '__main__':
 
     server.close()
     loop.run_until_complete(server.wait_closed())
+    if proxy_instance.access_log is not None:
+        proxy_instance.access_log.flush()
     loop.close()
+    accesslog.stop_logging(listeners)
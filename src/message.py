@@ -0,0 +1,305 @@
+import re
+
+
+HEAD_END = re.compile(b'\r?\n\r?\n')
+
+# Maximum size of a response status line plus headers.
+MAXHEAD = 65536
+
+
+class Headers():
+    '''
+    Case-insensitive collection of HTTP header fields. The original
+    order and spelling of the fields is kept so they can be forwarded
+    unchanged.
+    '''
+    def __init__(self, fields=()):
+        self.fields = []
+        self.index = {}
+        for name, value in fields:
+            self.add(name, value)
+
+    def add(self, name, value):
+        self.fields.append((name, value))
+        self.index.setdefault(name.lower(), []).append(value)
+
+    def get(self, name, default=None):
+        '''
+        :return: the first value of the field `name` or `default`.
+        '''
+        values = self.index.get(name.lower())
+        if values:
+            return values[0]
+        return default
+
+    def get_all(self, name):
+        '''
+        :return: a list with every value of the field `name`.
+        '''
+        return list(self.index.get(name.lower(), ()))
+
+    def tokens(self, name):
+        '''
+        :return: the lowercased comma-separated tokens of every value of
+          the field `name`, e.g. the options listed in `Connection`.
+        '''
+        tokens = set()
+        for value in self.index.get(name.lower(), ()):
+            for token in value.split(','):
+                token = token.strip().lower()
+                if token:
+                    tokens.add(token)
+        return tokens
+
+    def items(self):
+        return list(self.fields)
+
+    def __getitem__(self, name):
+        values = self.index.get(name.lower())
+        if not values:
+            raise KeyError(name)
+        return values[0]
+
+    def __contains__(self, name):
+        return name.lower() in self.index
+
+    def __iter__(self):
+        return (name for name, value in self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return 'Headers(%r)' % self.fields
+
+
+def parse_head(data):
+    '''
+    Parse an HTTP message head (start line and header fields).
+
+    :return: a tuple of the start line as a string and a Headers instance.
+    '''
+    lines = data.decode('iso-8859-1').split('\n')
+    if not lines[0].strip():
+        raise ValueError('Empty message head')
+    return lines[0].rstrip('\r'), parse_fields(lines[1:])
+
+
+def parse_fields(lines):
+    '''
+    Parse header field lines. Line endings may be CRLF or a bare LF and
+    blank lines are skipped.
+
+    :return: a Headers instance.
+    '''
+    headers = Headers()
+    name = None
+    for line in lines:
+        line = line.rstrip('\r')
+        if not line:
+            continue
+        if line[0] in ' \t' and name is not None:
+            # Obsolete line folding, continue the previous value.
+            name, value = headers.fields.pop()
+            headers.index[name.lower()].pop()
+            headers.add(name, value + ' ' + line.strip())
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ValueError('Invalid header line: %r' % line)
+        headers.add(name.strip(), value.strip())
+
+    return headers
+
+
+def persistent(version, headers):
+    '''
+    Indicate whether a message allows its connection to be reused
+    according to its HTTP version and Connection header.
+    '''
+    options = headers.tokens('connection')
+    if version == 'HTTP/1.1':
+        return 'close' not in options
+    return 'keep-alive' in options
+
+
+class BodyFramer():
+    '''
+    Track the end of an HTTP message body which is delimited by
+    Content-Length, by chunked transfer coding or by the connection
+    closing.
+    '''
+    LENGTH = 'length'
+    CHUNKED = 'chunked'
+    CLOSE = 'close'
+
+    # States of the chunked decoder.
+    SIZE = 0
+    DATA = 1
+    DATA_END = 2
+    TRAILER = 3
+
+    def __init__(self, mode, length=0):
+        self.mode = mode
+        self.remaining = length
+        self.state = BodyFramer.SIZE
+        self.line = b''
+        self.complete = mode == BodyFramer.LENGTH and length == 0
+
+    @classmethod
+    def for_headers(cls, headers):
+        '''
+        Choose the body framing for a message with the given headers.
+        Messages that have neither Content-Length nor Transfer-Encoding
+        end when the connection is closed.
+        '''
+        codings = headers.get_all('transfer-encoding')
+        if codings:
+            if codings[-1].split(',')[-1].strip().lower() == 'chunked':
+                return cls(cls.CHUNKED)
+            return cls(cls.CLOSE)
+
+        length = headers.get('content-length')
+        if length is None:
+            return cls(cls.CLOSE)
+        try:
+            length = int(length)
+        except ValueError:
+            return cls(cls.CLOSE)
+        if length < 0:
+            return cls(cls.CLOSE)
+        return cls(cls.LENGTH, length)
+
+    def feed(self, data, start=0):
+        '''
+        Consume body bytes from `data` starting at offset `start`.
+
+        :return: the offset just past the last byte belonging to the body.
+        '''
+        if self.mode == BodyFramer.CLOSE:
+            return len(data)
+        if self.mode == BodyFramer.LENGTH:
+            end = min(len(data), start + self.remaining)
+            self.remaining -= end - start
+            self.complete = self.remaining == 0
+            return end
+        return self.feed_chunked(data, start)
+
+    def feed_chunked(self, data, pos):
+        while pos < len(data) and not self.complete:
+            if self.state == BodyFramer.DATA:
+                end = min(len(data), pos + self.remaining)
+                self.remaining -= end - pos
+                pos = end
+                if self.remaining == 0:
+                    self.state = BodyFramer.DATA_END
+                continue
+
+            # The other states consume one line at a time.
+            newline = data.find(b'\n', pos)
+            if newline < 0:
+                self.line += data[pos:]
+                if len(self.line) > MAXHEAD:
+                    raise ValueError('Chunk line too long')
+                return len(data)
+            line = (self.line + data[pos:newline]).strip()
+            self.line = b''
+            pos = newline + 1
+
+            if self.state == BodyFramer.SIZE:
+                try:
+                    size = int(line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise ValueError('Invalid chunk size: %r' % line)
+                if size == 0:
+                    self.state = BodyFramer.TRAILER
+                else:
+                    self.remaining = size
+                    self.state = BodyFramer.DATA
+            elif self.state == BodyFramer.DATA_END:
+                self.state = BodyFramer.SIZE
+            elif not line:
+                self.complete = True
+
+        return pos
+
+
+class ResponseParser():
+    '''
+    Incrementally parse an HTTP/1.x response from a remote server so
+    the proxy knows where the response ends and whether the connection
+    can be reused afterwards.
+    '''
+    def __init__(self, method):
+        self.method = method
+        self.buffer = b''
+        self.version = None
+        self.status = None
+        self.headers = None
+        self.body = None
+        self.complete = False
+        self.keep_alive = False
+
+    def feed(self, data):
+        '''
+        Consume response bytes.
+
+        :return: the number of bytes of `data` that belong to this
+          response. Anything after that is not part of the response.
+        :raises: ValueError if the response is malformed.
+        '''
+        pos = 0
+        while self.body is None:
+            start = max(0, len(self.buffer) - 3)
+            self.buffer += data[pos:]
+            match = HEAD_END.search(self.buffer, start)
+            if match is None:
+                if len(self.buffer) > MAXHEAD:
+                    raise ValueError('Response head too long')
+                return len(data)
+            pos = len(data) - (len(self.buffer) - match.end())
+            head, self.buffer = self.buffer[:match.end()], b''
+            self.parse_head(head)
+
+        if self.complete:
+            return pos
+        pos = self.body.feed(data, pos)
+        self.complete = self.body.complete
+        return pos
+
+    def parse_head(self, head):
+        status_line, headers = parse_head(head)
+        parts = status_line.split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise ValueError('Invalid status line: %r' % status_line)
+        try:
+            status = int(parts[1])
+        except ValueError:
+            raise ValueError('Invalid status code: %r' % status_line)
+
+        if 100 <= status < 200 and status != 101:
+            # Interim response, the final response follows.
+            return
+
+        self.version = parts[0]
+        self.status = status
+        self.headers = headers
+
+        if status == 101:
+            self.body = BodyFramer(BodyFramer.CLOSE)
+        elif self.method == 'HEAD' or status in (204, 304):
+            self.body = BodyFramer(BodyFramer.LENGTH, 0)
+        else:
+            self.body = BodyFramer.for_headers(headers)
+
+        self.complete = self.body.complete
+        self.keep_alive = (self.body.mode != BodyFramer.CLOSE and
+                           persistent(self.version, headers))
+
+    def close(self):
+        '''
+        Signal that the connection was closed. A response which is
+        delimited by the connection closing is complete at this point.
+        '''
+        if self.body is not None and self.body.mode == BodyFramer.CLOSE:
+            self.complete = True
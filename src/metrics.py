@@ -0,0 +1,266 @@
+import bisect
+import asyncio
+import logging
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Fields of the stats() dicts that are rates or extremes. They are not
+# exposed, since the metrics of workers are added up and Prometheus can
+# derive them from the counters.
+DERIVED_STATS = {'hit_rate', 'hit_ratio', 'avg_lookup_ms', 'max_lookup_ms'}
+
+# Fields of the stats() dicts that only go up. The other fields are sizes
+# and are exposed as gauges.
+COUNTER_STATS = {'hits', 'negative_hits', 'misses', 'coalesced', 'evictions', 'stores',
+                 'revalidations', 'bytes_saved', 'leaders', 'followers', 'refetches'}
+
+
+class Counter():
+    '''
+    A value that only goes up, per combination of label values.
+    '''
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # label values -> count
+        self.values = {}
+
+    def inc(self, *values, amount=1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def samples(self):
+        return [['', list(zip(self.labels, values)), count]
+                for values, count in self.values.items()]
+
+
+class Gauge():
+    '''
+    A value that is read from `function` when the metrics are collected.
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def samples(self):
+        return [['', [], self.function()]]
+
+
+class CounterFunction(Gauge):
+    '''
+    A counter that is read from `function` when the metrics are collected.
+    '''
+    type = 'counter'
+
+
+class Histogram():
+    '''
+    Counts observations in buckets, per combination of label values.
+    The buckets are stored non-cumulatively and summed up when collected,
+    so an observation only increments one bucket.
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [bucket counts..., count above the last bucket, sum]
+        self.values = {}
+
+    def observe(self, value, *values):
+        counts = self.values.get(values)
+        if counts is None:
+            counts = self.values[values] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for values, counts in self.values.items():
+            labels = list(zip(self.labels, values))
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                samples.append(['_bucket', labels + [('le', repr(float(bound)))], total])
+            total += counts[-2]
+            samples.append(['_bucket', labels + [('le', '+Inf')], total])
+            samples.append(['_sum', labels, counts[-1]])
+            samples.append(['_count', labels, total])
+        return samples
+
+
+class Registry():
+    '''
+    The metrics of one process.
+    '''
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, function):
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def stats(self, prefix, description, function):
+        '''
+        Register a metric for each field of the dict that `function`
+        returns, e.g. the stats() of a cache: a counter named
+        `prefix`_<field>_total for counts that only go up, and a gauge
+        named `prefix`_<field> for sizes.
+        '''
+        for field in function():
+            if field in DERIVED_STATS:
+                continue
+            help = '{0} of the {1}.'.format(field.replace('_', ' ').capitalize(), description)
+            read = lambda field=field: function()[field]
+            if field in COUNTER_STATS:
+                self.register(CounterFunction('{0}_{1}_total'.format(prefix, field), help, read))
+            else:
+                self.gauge('{0}_{1}'.format(prefix, field), help, read)
+
+    def collect(self):
+        '''
+        :return: a JSON serializable list of metric families, each a list
+          of the name, type, help text and samples. A sample is a list of
+          the name suffix, a list of label pairs and the value.
+        '''
+        return [[metric.name, metric.type, metric.help, metric.samples()]
+                for metric in self.metrics]
+
+
+def merge(collections):
+    '''
+    Add up the metrics collected from several processes.
+
+    :return: the merged metric families in the format of collect().
+    '''
+    families = {}
+    merged = []
+    for collected in collections:
+        for name, type_, help, samples in collected:
+            family = families.get(name)
+            if family is None:
+                family = families[name] = [name, type_, help, {}]
+                merged.append(family)
+            for suffix, labels, value in samples:
+                key = (suffix, tuple(tuple(label) for label in labels))
+                family[3][key] = family[3].get(key, 0) + value
+    return [[name, type_, help, [[suffix, list(labels), value]
+                                 for (suffix, labels), value in samples.items()]]
+            for name, type_, help, samples in merged]
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(collected):
+    '''
+    :return: metric families in the Prometheus text exposition format.
+    '''
+    lines = []
+    for name, type_, help, samples in collected:
+        lines.append('# HELP {0} {1}'.format(name, help))
+        lines.append('# TYPE {0} {1}'.format(name, type_))
+        for suffix, labels, value in samples:
+            if labels:
+                label_text = '{' + ','.join('{0}="{1}"'.format(label, escape(str(label_value)))
+                                            for label, label_value in labels) + '}'
+            else:
+                label_text = ''
+            lines.append('{0}{1}{2} {3}'.format(name, suffix, label_text, value))
+    return '\n'.join(lines) + '\n'
+
+
+def response(request_line, collect):
+    '''
+    Answer a request to the admin port. The metrics are served at
+    /metrics.
+
+    :param collect: function that returns the metric families.
+    :return: the HTTP response.
+    '''
+    parts = request_line.split()
+    if len(parts) < 2 or parts[0] not in (b'GET', b'HEAD') or parts[1] != b'/metrics':
+        return b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+    body = render(collect()).encode('utf-8')
+    head = ('HTTP/1.1 200 OK\r\n'
+            'Content-Type: {0}\r\n'
+            'Content-Length: {1}\r\n'
+            'Connection: close\r\n\r\n').format(CONTENT_TYPE, len(body))
+    if parts[0] == b'HEAD':
+        return head.encode('iso-8859-1')
+    return head.encode('iso-8859-1') + body
+
+
+def start_server(collect, host, port):
+    '''
+    Serve the metrics on the admin port.
+
+    :return: a coroutine that starts the server.
+    '''
+    async def handle(reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            writer.write(response(head.split(b'\r\n', 1)[0], collect))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ConnectionError) as err:
+            logging.debug('Metrics request failed: %s' % err)
+        writer.close()
+
+    return asyncio.start_server(handle, host, port)
+
+
+class ProxyMetrics():
+    '''
+    The metrics a ProxyServer records. Stage latencies of requests are
+    labeled with the verdict of the lists, except for the stages that
+    come before the lists are checked.
+    '''
+    def __init__(self, registry):
+        self.registry = registry
+        self.accepted = registry.counter(
+            'kalamari_connections_accepted_total', 'Client connections accepted.')
+        self.rejected = registry.counter(
+            'kalamari_connections_rejected_total',
+            'Client connections rejected at admission.', ('reason',))
+        self.admission_seconds = registry.histogram(
+            'kalamari_admission_seconds', 'Time to check a new connection against the ACL.')
+        self.header_seconds = registry.histogram(
+            'kalamari_header_parse_seconds',
+            'Time from the first byte of a request until its headers are parsed.')
+        self.requests = registry.counter(
+            'kalamari_requests_total', 'Requests by verdict of the lists.', ('verdict',))
+        self.stage_seconds = registry.histogram(
+            'kalamari_request_stage_seconds',
+            'Latency of the list check, DNS lookup, upstream connect and time to '
+            'first response byte.', ('stage', 'verdict'))
+        self.shed = registry.counter(
+            'kalamari_requests_shed_total',
+            'Requests answered with 503 because too many connects to remote servers '
+            'were in progress.')
+        self.bytes = registry.counter(
+            'kalamari_bytes_total',
+            'Bytes relayed from clients to remote servers (upstream) and back (downstream).',
+            ('direction', 'verdict'))
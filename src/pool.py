@@ -0,0 +1,111 @@
+import collections
+import logging
+
+
+class ConnectionPool():
+    '''
+    Keeps idle connections to remote servers so that later requests to
+    the same host and port can reuse them instead of opening a new TCP
+    connection.
+
+    Connections are ProxySessionOutput instances. The pool holds at most
+    `max_idle` connections in total and `max_per_host` per (host, port);
+    connections that stay idle for `idle_timeout` seconds are closed.
+    '''
+    def __init__(self, loop, max_idle, max_per_host, idle_timeout):
+        self.loop = loop
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+
+        # (host, port) -> list of idle connections, most recently used last
+        self.idle = {}
+        # connection -> ((host, port), expiry timer), oldest first
+        self.order = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, host, port):
+        '''
+        Take an idle connection to (host, port) out of the pool.
+
+        :return: a connection or None if there is no usable one.
+        '''
+        connections = self.idle.get((host, port))
+        while connections:
+            connection = connections.pop()
+            self.forget(connection)
+            if connection.transport.is_closing():
+                continue
+            self.hits += 1
+            return connection
+
+        self.misses += 1
+        return None
+
+    def release(self, host, port, connection):
+        '''
+        Return a connection whose response is complete to the pool. The
+        connection is closed instead if the pool is disabled.
+        '''
+        if self.max_idle <= 0 or self.max_per_host <= 0:
+            connection.transport.close()
+            return
+
+        key = (host, port)
+        if len(self.idle.get(key, ())) >= self.max_per_host:
+            self.evict(self.idle[key][0])
+        if len(self.order) >= self.max_idle:
+            self.evict(next(iter(self.order)))
+
+        self.idle.setdefault(key, []).append(connection)
+        timer = self.loop.call_later(self.idle_timeout, self.evict, connection)
+        self.order[connection] = (key, timer)
+
+    def discard(self, connection):
+        '''
+        Remove a connection from the pool without closing it, e.g.
+        because the remote server closed it.
+        '''
+        if connection not in self.order:
+            return
+        key, timer = self.order[connection]
+        self.idle[key].remove(connection)
+        self.forget(connection)
+
+    def evict(self, connection):
+        '''
+        Remove a connection from the pool and close it.
+        '''
+        if connection not in self.order:
+            return
+        logging.debug('Evicting idle connection to %s:%s' % self.order[connection][0])
+        self.discard(connection)
+        self.evictions += 1
+        connection.transport.close()
+
+    def forget(self, connection):
+        key, timer = self.order.pop(connection)
+        timer.cancel()
+        if not self.idle[key]:
+            del self.idle[key]
+
+    def close(self):
+        '''
+        Close every idle connection.
+        '''
+        for connection in list(self.order):
+            self.evict(connection)
+
+    def stats(self):
+        '''
+        :return: a dict of pool counters for sizing the pool.
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'idle': len(self.order),
+        }
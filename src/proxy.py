@@ -1,13 +1,23 @@
+import mmap
 import time
 import asyncio
-import http.client
-import email.parser
 from urllib.parse import urlparse
 import logging
 
 import config
 import resource
 import acl
+import admission
+import message
+import pool
+import resolver
+import connector
+import filecache
+import httpcache
+import collapse
+import tunnel
+import metrics
+import accesslog
 
 
 class ProxyServer():
@@ -17,98 +27,449 @@ class ProxyServer():
     MAXLINE = 65536
     MAXHEADERS = 100
 
-    def __init__(self, loop):
+    # Verdicts of the lists for a request
+    WHITELISTED = 'whitelisted'
+    BLOCKED = 'blocked'
+    REDIRECTED = 'redirected'
+    FORWARDED = 'forwarded'
+
+    def __init__(self, loop, shared_lists=False):
+        '''
+        :param shared_lists: if True, the lists are read from the copies on
+          disk which a supervisor process keeps up to date, and are only
+          reloaded when reload_lists(fetch=False) is called.
+        '''
         self.loop = loop
 
         logging.info("Initializing proxy...")
 
         self.next_sess_id = 1
 
+        # Open client connections, and the ones waiting for their next
+        # request, for graceful shutdown
+        self.connections = 0
+        self.idle_writers = set()
+        self.closing = False
+        self.closed = None
+
+        # Idle connections to remote servers kept for reuse
+        self.pool = pool.ConnectionPool(loop, config.pool_max_idle,
+                                        config.pool_max_per_host,
+                                        config.pool_idle_timeout)
+
+        # Cached DNS lookups of remote servers
+        self.resolver = resolver.Resolver(loop, config.dns_ttl,
+                                          config.dns_negative_ttl,
+                                          config.dns_workers,
+                                          config.dns_cache_size)
+
         # Load blacklist, whitelist, and cache list
-        self.blacklist = resource.ResourceList()
-        self.whitelist = resource.ResourceList()
-        self.cachelist = resource.CacheList()
-        self.blacklist.load(config.blacklist)
-        self.whitelist.load(config.whitelist)
-        self.cachelist.load(config.cachelist)
+        self.sources = {}
+        for name, url in (('blacklist', config.blacklist),
+                          ('whitelist', config.whitelist),
+                          ('cachelist', config.cachelist)):
+            self.sources[name] = resource.ListSource(url, config.list_cache_dir,
+                                                     config.list_timeout)
+        self.blacklist = self.initial_list('blacklist', shared_lists)
+        self.whitelist = self.initial_list('whitelist', shared_lists)
+        self.cachelist = self.initial_list('cachelist', shared_lists)
+
+        # Verdicts of the lists above for recently requested URLs
+        self.verdicts = resource.VerdictCache(config.verdict_cache_size)
+
+        # Files that cache list rules point to
+        if config.cache_root:
+            self.files = filecache.FileCache(config.cache_root, config.cache_memory,
+                                             config.cache_memory_file_max)
+        else:
+            self.files = None
+
+        # Responses of remote servers to plain HTTP GET requests
+        if config.http_cache_size:
+            self.http_cache = httpcache.HTTPCache(config.http_cache_size,
+                                                  config.http_cache_max_object)
+        else:
+            self.http_cache = None
+
+        # Requests waiting for the response to an identical request
+        if config.collapsed_forwarding:
+            self.flights = collapse.Flights(loop, config.buffer_high, config.buffer_low)
+        else:
+            self.flights = None
 
         # Start periodic refresh
-        self.start_periodic_refresh(config.list_refresh)
+        if not shared_lists:
+            self.start_periodic_refresh(config.list_refresh)
 
         # create the acl object to handle incoming connections
         logging.info("Initializing Access Control Lists (ACL's)")
         self.acl = acl.ACL(config.ip_acl)
+        self.admission = admission.Admission(self.acl, config.max_connections_per_ip,
+                                             config.max_connections)
+
+        # Bounds the connects to remote servers in progress, so a surge
+        # is shed with 503s instead of slowing down every request.
+        self.connects = admission.ConnectLimiter(loop, config.max_connects,
+                                                 config.max_connects_per_host,
+                                                 config.connect_queue,
+                                                 config.connect_queue_timeout)
+
+        # Counters and latency histograms served on the admin port
+        self.registry = metrics.Registry()
+        self.metrics = metrics.ProxyMetrics(self.registry)
+        self.sessions = 0
+        self.registry.gauge('kalamari_active_connections', 'Open client connections.',
+                            lambda: self.connections)
+        self.registry.gauge('kalamari_active_sessions',
+                            'Requests being forwarded to remote servers.',
+                            lambda: self.sessions)
+        self.registry.gauge('kalamari_upstream_connects',
+                            'Connects to remote servers in progress.',
+                            lambda: self.connects.connecting)
+        self.registry.gauge('kalamari_upstream_connects_waiting',
+                            'Connects to remote servers waiting in the queue.',
+                            lambda: len(self.connects.waiters))
+        self.registry.stats('kalamari_pool', 'pool of idle remote connections',
+                            self.pool.stats)
+        self.registry.stats('kalamari_verdict_cache', 'cache of list verdicts',
+                            self.verdicts.stats)
+        self.registry.stats('kalamari_dns', 'cache of DNS lookups', self.resolver.stats)
+        if self.files is not None:
+            self.registry.stats('kalamari_file_cache', 'memory tier of the cached resources',
+                                self.files.stats)
+        if self.http_cache is not None:
+            self.registry.stats('kalamari_http_cache', 'HTTP cache', self.http_cache.stats)
+        if self.flights is not None:
+            self.registry.stats('kalamari_flights', 'collapsed forwarding of requests',
+                                self.flights.stats)
+
+        # One JSON line per request, written in batches
+        if config.access_log:
+            self.access_log = accesslog.AccessLog(loop, config.access_log_batch,
+                                                  config.access_log_interval)
+        else:
+            self.access_log = None
 
     async def handler(self, reader, writer):
         '''
-        Handler for incoming proxy requests.
+        Handler for incoming proxy connections. Requests on a persistent
+        client connection are handled one after another until the client
+        or Kalamari closes it.
         '''
-        # Read the request method and headers
-        method_line = (await reader.readline()).decode('utf8')
-        headers = await self.parse_headers(reader)
+        # Admit the client before reading anything from it, so denied
+        # and excess connections cost as little as possible.
+        self.metrics.accepted.inc()
+        start = time.monotonic()
+        peer = writer.get_extra_info('peername')
+        ip_address = peer[0] if peer else None
+        verdict = self.admission.admit(ip_address)
+        self.metrics.admission_seconds.observe(time.monotonic() - start)
+        if verdict != admission.Admission.ADMITTED:
+            self.metrics.rejected.inc(verdict)
+        if verdict == admission.Admission.DENIED:
+            logging.debug('Connection from %s denied per ACL\'s', ip_address)
+            writer.write(b'HTTP/1.1 403 Forbidden\n\n')
+            writer.close()
+            return
+        if verdict == admission.Admission.LIMITED:
+            logging.info('Too many connections from %s', ip_address)
+            writer.write(b'HTTP/1.1 429 Too Many Requests\r\n'
+                         b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+        if verdict == admission.Admission.SATURATED:
+            logging.info('Too many connections, refusing %s', ip_address)
+            writer.write(ProxyServer.unavailable())
+            writer.close()
+            return
 
-        # Parse method line
-        method, target, version = ProxyServer.parse_method(method_line)
-        if method == 'CONNECT':
-            hostname, port = target.split(':')
-            request = HTTPRequest(method, hostname, port, '', headers, self.next_sess_id)
-        else:
-            hostname, port, path = ProxyServer.parse_url(target)
-            request = HTTPRequest(method, hostname, port, path, headers, self.next_sess_id)
+        self.connections += 1
+        try:
+            accepted = start
+            while not self.closing and await self.handle_request(reader, writer, accepted):
+                accepted = None
+        except ConnectionError as err:
+            logging.debug('Client connection error: %s', err)
+        finally:
+            self.admission.release(ip_address)
+            self.connections -= 1
+            if self.closed is not None and not self.connections and not self.closed.done():
+                self.closed.set_result(None)
+            writer.close()
 
-        logging.info('HTTP REQUEST ' + str(request))
+    async def handle_request(self, reader, writer, accepted=None):
+        '''
+        Read, check, and forward a single request from the client.
 
-        # this is where we should reject requests that come from unauthorized ip's
+        :param accepted: the time the connection was accepted, if this is
+          its first request.
+        :return: True if the client connection can be used for another
+          request.
+        '''
+        # The head of the first request has to arrive within HEADER_TIMEOUT
+        # seconds of the accept. Between requests the client may keep the
+        # connection idle for up to KEEPALIVE_TIMEOUT seconds.
+        if accepted is None:
+            idle_timeout = config.keepalive_timeout
+        else:
+            idle_timeout = config.header_timeout
+        self.idle_writers.add(writer)
         try:
-            ip_address = writer.get_extra_info('peername')[0]
-
-            if ip_address is None:
-                logging.info('Could not get remote IP address')
-                writer.write(b'HTTP/1.1 403 Forbidden\n\n')
-                writer.close()
-                return
+            first = await asyncio.wait_for(reader.read(1), idle_timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.idle_writers.discard(writer)
+        if not first:
+            return False
 
+        start = time.monotonic()
+        deadline = (start if accepted is None else accepted) + config.header_timeout
+        try:
+            # Once a request was started, its request line and headers have
+            # to arrive within HEADER_TIMEOUT seconds.
+            try:
+                method_line, headers = await asyncio.wait_for(self.read_head(reader, first),
+                                                              deadline - start)
+            except asyncio.TimeoutError:
+                logging.info('Request headers not received in time')
+                writer.write(b'HTTP/1.1 408 Request Timeout\r\n'
+                             b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+                return False
+
+            # Parse method line
+            method, target, version = ProxyServer.parse_method(method_line.decode('utf8'))
+            if method == 'CONNECT':
+                hostname, port = target.split(':')
+                request = HTTPRequest(method, hostname, port, '', headers, self.next_sess_id, version)
             else:
-                if not self.acl.ip_allowed(ip_address):
-                    logging.info('Request from {} comes from disallowed network per ACL\'s, returning \'HTTP/1.1 403 Forbidden\''.format(ip_address))
-                    writer.write(b'HTTP/1.1 403 Forbidden\n\n')
-                    writer.close()
-                    return
+                hostname, port, path = ProxyServer.parse_url(target)
+                request = HTTPRequest(method, hostname, port, path, headers, self.next_sess_id, version)
+        except ValueError as err:
+            logging.info('Invalid request: %s', err)
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            return False
 
-                else:
-                    logging.info('Request from {} comes from allowed network per ACL\'s, continuing to process request'.format(ip_address))
+        self.metrics.header_seconds.observe(time.monotonic() - start)
 
-        # case where invalid ip address source
-        except ValueError:
-            logging.error('Invalid Inbound IP Address: {}, returning \'HTTP/1.1 403 Forbidden\''.format(ip_address))
-            writer.write(b'HTTP/1.1 403 Forbidden\n\n')
-            writer.close()
-            return
+        # increment session id
+        self.next_sess_id += 1
 
-        # Check if the request is on the blacklist or whitelist
-        if self.whitelist.check(request):
-            logging.info('Request is on the whitelist')
-        elif self.blacklist.check(request):
-            logging.info('Request is on the blacklist')
-            writer.write(b'HTTP/1.1 404 Not Found\n\n')
-            writer.close()
-            return
+        if self.access_log is None:
+            return await self.dispatch(request, reader, writer)
+        target = (request.host, request.port, request.path)
+        try:
+            return await self.dispatch(request, reader, writer)
+        finally:
+            peer = writer.get_extra_info('peername')
+            self.access_log.log(request, peer[0] if peer else None, target,
+                                time.monotonic() - start)
+
+    async def dispatch(self, request, reader, writer):
+        '''
+        Answer a request according to the lists, from the caches, or by
+        forwarding it to the remote server.
 
-        # Check if the request is on the cached resources list
-        redirect = self.cachelist.check(request)
+        :return: True if the client connection can be used for another
+          request.
+        '''
+        logging.debug('HTTP REQUEST %s', request)
+
+        # Check if the request is on the blacklist, whitelist or cached
+        # resources list
+        start = time.monotonic()
+        verdict, redirect = self.classify(request)
+        self.metrics.stage_seconds.observe(time.monotonic() - start, 'list_check', verdict)
+        self.metrics.requests.inc(verdict)
+        request.verdict = verdict
+        if verdict == ProxyServer.WHITELISTED:
+            logging.debug('Request is on the whitelist')
+        elif verdict == ProxyServer.BLOCKED:
+            logging.debug('Request is on the blacklist')
+            request.status = 404
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            # The connection can only be reused if there is no request body
+            # left to skip.
+            return request.persistent() and not ProxySession.has_body(request)
+
+        # Whitelisted requests are redirected by the cache list too.
         if redirect:
-            logging.info('Request is on the cached resource list.')
+            logging.debug('Request is on the cached resource list.')
             hostname, port, path = ProxyServer.parse_url(redirect)
-            request = HTTPRequest(method, hostname, port, path, headers, request.session_id)
-            logging.info('Redirecting request to: %s' % request)
+            if self.serves_locally(request, hostname, port):
+                return await self.serve_file(request, path, writer)
+            request.host, request.port, request.path = hostname, port, path
+            logging.debug('Redirecting request to: %s', request)
 
         # Create a ProxySession instance to handle the request
-        proxysession = ProxySession(self.loop, reader, writer, request)
+        proxysession = ProxySession(self, reader, writer, request, verdict)
+        if self.http_cache is not None:
+            if self.http_cache.storable_request(request):
+                proxysession.recording = bytearray()
+            cached = self.http_cache.lookup(request)
+            if cached is not None:
+                entry, fresh = cached
+                if fresh:
+                    logging.debug('Serving response from the HTTP cache: %s', request)
+                    return await self.write_cached(request, writer, entry)
+                proxysession.revalidate(entry)
+
+        # Wait for the response to an identical request that is already
+        # being forwarded, or let later identical requests wait for this one.
+        key = None
+        if self.flights is not None and proxysession.cache_entry is None:
+            key = self.flights.key(request)
+        if key is not None:
+            flight = self.flights.join(key)
+            if flight is not None:
+                logging.debug('Waiting for the response to an identical request: %s', request)
+                persistent = await flight.follow(writer, request.persistent())
+                if persistent is not None:
+                    request.status = flight.status
+                    request.bytes_sent = flight.end
+                    return persistent
+                logging.debug('Response to the identical request is not shared: %s', request)
+                self.flights.refetches += 1
+            else:
+                proxysession.flight = self.flights.start(key)
+
         proxysession.connect()
-        self.loop.create_task(proxysession.run())
+        self.sessions += 1
+        try:
+            return await proxysession.run()
+        finally:
+            self.sessions -= 1
+            if proxysession.flight is not None:
+                self.flights.land(proxysession.flight, proxysession.response)
 
-        # increment session id
-        self.next_sess_id += 1
+    @staticmethod
+    def unavailable():
+        '''
+        :return: the response to a request that is shed because a limit
+          is reached.
+        '''
+        return (b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\n'
+                b'Content-Length: 0\r\nConnection: close\r\n\r\n' % config.retry_after)
+
+    def serves_locally(self, request, hostname, port):
+        '''
+        Indicate whether a request redirected to `hostname` and `port` can
+        be answered from the files of the local web server.
+        '''
+        return (self.files is not None and
+                hostname == config.webserver_ip and str(port) == str(config.webserver_port) and
+                request.method in ('GET', 'HEAD') and not ProxySession.has_body(request))
+
+    async def serve_file(self, request, path, writer):
+        '''
+        Answer a request with a file from CACHE_ROOT. Small files come
+        from memory; larger ones are sent from the page cache with
+        sendfile() where the event loop supports it.
+
+        :return: True if the client connection can be used for another
+          request.
+        '''
+        persistent = request.persistent()
+        connection = b'' if persistent else b'Connection: close\r\n'
+
+        cached = self.files.lookup(path)
+        if cached is None:
+            logging.info('Cached resource not found: %s', path)
+            request.status = 404
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n' + connection + b'\r\n')
+            return persistent
+
+        logging.debug('Serving cached resource: %s', cached.path)
+        request.status = 200
+        head = ('HTTP/1.1 200 OK\r\n'
+                'Content-Type: {0}\r\n'
+                'Content-Length: {1}\r\n'
+                'Last-Modified: {2}\r\n').format(cached.content_type, cached.size,
+                                                  cached.last_modified)
+        head = head.encode('iso-8859-1') + connection + b'\r\n'
+        writer.write(head)
+        request.bytes_sent += len(head)
+        if request.method == 'HEAD':
+            return persistent
+
+        if cached.data is not None:
+            writer.write(cached.data)
+            request.bytes_sent += len(cached.data)
+            await writer.drain()
+            return persistent
+
+        sent = await self.send_file(writer, cached)
+        request.bytes_sent += sent
+        # The file changed since it was looked up; the response cannot be
+        # completed, so the connection has to be closed.
+        return persistent and sent == cached.size
+
+    async def send_file(self, writer, cached):
+        '''
+        :return: the number of bytes of the file that were sent.
+        '''
+        with open(cached.path, 'rb') as cached_file:
+            if hasattr(self.loop, 'sendfile'):
+                # Python 3.7+: os.sendfile() straight to the client socket.
+                return await self.loop.sendfile(writer.transport, cached_file, 0, cached.size)
+
+            sent = 0
+            with mmap.mmap(cached_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                end = min(cached.size, len(mapped))
+                while sent < end:
+                    chunk = mapped[sent:sent + config.buffer_high]
+                    writer.write(chunk)
+                    sent += len(chunk)
+                    await writer.drain()
+            return sent
+
+    async def write_cached(self, request, writer, entry):
+        '''
+        Answer a request with a response from the HTTP cache.
+
+        :return: True if the client connection can be used for another
+          request.
+        '''
+        persistent = request.persistent()
+        head = entry.head(time.time(), close=not persistent)
+        writer.write(head)
+        request.status = entry.status
+        request.bytes_sent += len(head)
+        if request.method != 'HEAD':
+            writer.write(entry.body)
+            request.bytes_sent += len(entry.body)
+        await writer.drain()
+        return persistent
+
+    def classify(self, request):
+        '''
+        Check a request against the lists. The result is cached per host
+        and path until the lists change.
+
+        :return: a tuple of the verdict and the redirect URL from the cache
+          list, which is None unless the verdict is REDIRECTED or
+          WHITELISTED.
+        '''
+        verdict = self.verdicts.get(request.host, request.path)
+        if verdict is not None:
+            return verdict
+
+        redirect = None
+        if self.whitelist.check(request):
+            verdict = ProxyServer.WHITELISTED
+            redirect = self.cachelist.check(request) or None
+        elif self.blacklist.check(request):
+            verdict = ProxyServer.BLOCKED
+        else:
+            redirect = self.cachelist.check(request)
+            if redirect:
+                verdict = ProxyServer.REDIRECTED
+            else:
+                verdict = ProxyServer.FORWARDED
+                redirect = None
+
+        self.verdicts.put(request.host, request.path, (verdict, redirect))
+        return verdict, redirect
 
     @staticmethod
     def parse_method(method):
@@ -152,41 +513,79 @@ class ProxyServer():
         '''
         Decompose a URL and return a tuple containing:
         (hostname, port, path)
+
+        :raises: ValueError if the URL has no host, e.g. the origin-form
+          target of a request meant for a web server.
         '''
         parsed = urlparse(url)
+        if not parsed.hostname:
+            raise ValueError('No host in URL: %s' % url)
         path = parsed.path or '/'
         if parsed.query:
             path += '?%s' % parsed.query
         return (parsed.hostname, parsed.port or 80, path)
 
     @classmethod
-    async def parse_headers(cls, reader):
+    async def read_head(cls, reader, first):
+        '''
+        Read the rest of the request line, whose first byte was already
+        read, and the headers.
+
+        :return: a tuple of the request line and the headers.
+        :raises: ValueError if the request head is invalid.
+        '''
+        method_line = first + await reader.readline()
+        headers = await cls.parse_headers(reader, method_line.endswith(b'\r\n'))
+        return method_line, headers
+
+    @classmethod
+    async def parse_headers(cls, reader, crlf=True):
         '''
-        Read HTTP header data from `reader`. This code is a port of the
-        HTTP header parsing code from the Python standard library; it
-        has been modified to use asyncio.
-        https://github.com/python/cpython/blob/3.6/Lib/http/client.py
+        Read the HTTP headers that follow the request line from `reader`.
+        Clients that end the request line with CRLF are expected to end
+        the header lines with CRLF too, so the whole block is read with a
+        single readuntil(). Otherwise the block is read line by line.
 
-        :return: a dict of headers and values.
+        :return: a message.Headers instance.
         :raises: ValueError if a line longer than MAXLINE characters is
           discovered.
         :raises: ValueError if more than MAXHEADERS headers are
           discovered.
+        :raises: ValueError if the connection is closed before the end of
+          the headers.
         '''
-        headers = []
-        while True:
-            line = await reader.readline()
+        try:
+            if crlf:
+                # The blank line that ends the headers follows the LF of the
+                # request line when there are no headers, so check for it
+                # before searching for the end of the last header line.
+                head = await reader.readexactly(2)
+                if head != b'\r\n':
+                    head += await reader.readuntil(b'\n\r\n')
+            else:
+                lines = []
+                while True:
+                    line = await reader.readline()
+                    if len(line) > cls.MAXLINE:
+                        raise ValueError('Line too long while parsing header')
+                    lines.append(line)
+                    if len(lines) > cls.MAXHEADERS:
+                        raise ValueError('Too many headers found while parsing')
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                head = b''.join(lines)
+        except asyncio.IncompleteReadError:
+            raise ValueError('Connection closed while parsing headers')
+        except asyncio.LimitOverrunError:
+            raise ValueError('Headers too long while parsing')
+
+        lines = head.decode('iso-8859-1').split('\n')
+        if len(lines) > cls.MAXHEADERS + 1:
+            raise ValueError('Too many headers found while parsing')
+        for line in lines:
             if len(line) > cls.MAXLINE:
                 raise ValueError('Line too long while parsing header')
-            headers.append(line)
-            if len(headers) > cls.MAXHEADERS:
-                raise ValueError('Too many headers found while parsing')
-            if line in (b'\r\n', b'\n', b''):
-                break
-
-        hstring = b''.join(headers).decode('iso-8859-1')
-        parser = email.parser.Parser(_class=http.client.HTTPMessage)
-        return parser.parsestr(hstring)
+        return message.parse_fields(lines)
 
     async def refresh_lists(self, interval):
         '''
@@ -197,23 +596,91 @@ class ProxyServer():
             # initializeation. So, we should sleep first.
             await asyncio.sleep(interval)
             logging.debug('Refreshing lists')
+            await self.reload_lists()
 
+    @staticmethod
+    def new_list(name):
+        if name == 'cachelist':
+            return resource.CacheList()
+        return resource.ResourceList()
+
+    def initial_list(self, name, shared):
+        '''
+        :return: the list `name` when the proxy starts.
+        '''
+        if shared:
+            rules = self.read_shared_list(name)
+            if rules is not None:
+                return rules
+        rules = ProxyServer.new_list(name)
+        rules.build(self.sources[name].load())
+        return rules
+
+    def read_shared_list(self, name):
+        '''
+        Read a list from the copies on disk that the supervisor keeps up
+        to date. The blacklist and whitelist are memory mapped from their
+        compiled copy, so all workers share one copy of the domains.
+
+        :return: the list, or None if there is no copy on disk.
+        '''
+        source = self.sources[name]
+        if name != 'cachelist' and source.compiled_path is not None:
             try:
-                blacklist = resource.ResourceList()
-                blacklist.load(config.blacklist)
-                whitelist = resource.ResourceList()
-                whitelist.load(config.whitelist)
-                cachelist = resource.CacheList()
-                cachelist.load(config.cachelist)
+                return resource.ResourceList.open(source.compiled_path)
+            except (OSError, ValueError) as err:
+                logging.warning('Could not open the compiled %s: %s' % (name, err))
+
+        cached = source.read_cache()
+        if cached is None:
+            return None
+        rules = ProxyServer.new_list(name)
+        rules.build(cached['ruleset'])
+        return rules
+
+    async def reload_lists(self, fetch=True):
+        '''
+        Download and compile the lists in the default executor so the
+        event loop keeps serving requests, then swap in the lists that
+        changed. A list that fails to download is kept as it is.
 
-                self.blacklist = blacklist
-                self.whitelist = whitelist
-                self.cachelist = cachelist
+        :param fetch: if False, the lists are read from the copies on disk
+          instead of being downloaded.
+        '''
+        names = ('blacklist', 'whitelist', 'cachelist')
+        results = await asyncio.gather(*[self.reload_list(name, fetch) for name in names],
+                                       return_exceptions=True)
+
+        changed = False
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logging.error('Error while refreshing %s: %s' % (name, result))
+            elif result is None:
+                logging.debug('The %s has not changed' % name)
+            else:
+                setattr(self, name, result)
+                changed = True
 
-            except Exception as err:
-                logging.error('Error while refreshing lists: %s' % err)
+        # The lists are swapped and the cache is cleared without yielding
+        # to the event loop, so no request sees stale verdicts.
+        if changed:
+            logging.debug('Verdict cache before refresh: %s' % self.verdicts.stats())
+            self.verdicts.clear()
 
+    async def reload_list(self, name, fetch=True):
+        '''
+        :return: the new list, or None if it has not changed.
+        '''
+        if not fetch:
+            return await self.loop.run_in_executor(None, self.read_shared_list, name)
+
+        ruleset = await self.loop.run_in_executor(None, self.sources[name].fetch)
+        if ruleset is None:
+            return None
 
+        rules = ProxyServer.new_list(name)
+        await self.loop.run_in_executor(None, rules.build, ruleset)
+        return rules
 
     def start_periodic_refresh(self, interval=12*3600):
         '''
@@ -231,26 +698,67 @@ class ProxyServer():
 
         asyncio.ensure_future(self.refresh_lists(interval))
 
+    async def shutdown(self, grace):
+        '''
+        Stop handling requests: idle client connections are closed at once
+        and requests in progress get up to `grace` seconds to finish.
+        '''
+        self.closing = True
+        for writer in list(self.idle_writers):
+            writer.close()
+        if self.connections:
+            self.closed = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self.closed, grace)
+            except asyncio.TimeoutError:
+                logging.warning('%d connections still open after %s seconds' %
+                                (self.connections, grace))
+        if self.access_log is not None:
+            self.access_log.flush()
+        self.pool.close()
+        self.resolver.close()
+
 
 
 class HTTPRequest():
     '''
     Class to store information about a request.
     '''
-    def __init__(self, method, hostname, port, path, headers, session_id):
+    def __init__(self, method, hostname, port, path, headers, session_id,
+                 version='HTTP/1.1'):
         self.method = method
         self.host = hostname
         self.port = port
         self.path = path
         self.headers = headers
         self.session_id = session_id
+        self.version = version
 
         self.time = time.time()
 
-    def timed_out(self):
-        if time.time() - self.time > config.timeout:
-            return True
-        return False
+        # Outcome of the request for the access log: the verdict of the
+        # lists, the status of the response, the bytes sent to and received
+        # from the client, and the seconds taken by the stages of
+        # forwarding it.
+        self.verdict = None
+        self.status = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timings = {}
+
+    def persistent(self):
+        '''
+        Indicate whether the client wants to keep its connection open
+        after this request, based on the HTTP version and the Connection
+        and Proxy-Connection headers.
+        '''
+        options = set()
+        for name in ('connection', 'proxy-connection'):
+            for option in self.headers.get(name, '').split(','):
+                options.add(option.strip().lower())
+        if self.version == 'HTTP/1.1':
+            return 'close' not in options
+        return 'keep-alive' in options
 
     def __str__(self):
         return (
@@ -272,36 +780,415 @@ class ProxySession():
     Manages communication between the client and Kalamari and between
     Karamari and the request destination.
     '''
-    def __init__(self, loop, reader, writer, request):
-        self.loop = loop
+    def __init__(self, server, reader, writer, request, verdict='forwarded'):
+        self.server = server
+        self.loop = server.loop
         self.reader = reader
         self.writer = writer
         self.request = request
         self.output = None
+        # Verdict of the lists, the label of the metrics of the session
+        self.verdict = verdict
+
+        # Set once the whole request body has been forwarded; a connection
+        # is only returned to the pool if this is the case.
+        self.body_sent = not ProxySession.has_body(request)
+        # Parser of the response, set once it was completely forwarded.
+        self.response = None
+        self.response_done = self.loop.create_future()
+
+        # HTTP cache state: the raw response while it is recorded for the
+        # cache, and the stored response being revalidated. Response data
+        # is held back until it is known whether the remote answered the
+        # revalidation with 304 Not Modified.
+        self.request_time = time.time()
+        self.recording = None
+        self.cache_entry = None
+        self.held = []
+        self.not_modified = False
+
+        # Set if identical requests may wait for the response to this one.
+        self.flight = None
+
+        # Bound the amount of response data buffered for a slow client.
+        self.writer.transport.set_write_buffer_limits(high=config.buffer_high,
+                                                      low=config.buffer_low)
+
+    def pooling(self):
+        '''
+        Indicate whether the outbound connection may be kept open and
+        reused for later requests once the response is complete.
+        '''
+        return (self.server.pool is not None and
+                self.request.method != 'CONNECT' and
+                self.request.version == 'HTTP/1.1')
 
-    def connect(self):
+    def connect(self, reuse=True):
         '''
         Connect to the remote server and add the socket to the event
-        loop.
+        loop. An idle pooled connection to the same host and port is used
+        instead when there is one.
         '''
+        if reuse and self.pooling():
+            self.output = self.server.pool.acquire(self.request.host,
+                                                   self.request.port)
+            if self.output is not None:
+                logging.debug('REUSING CONNECTION TO REMOTE (Session %s)', self.request.session_id)
+                self.output.attach(self)
+                self.task = self.loop.create_future()
+                self.task.set_result(None)
+                return
+
+        if self.request.method == 'CONNECT' and self.raw_tunnel():
+            # The tunnel relays between the sockets themselves.
+            self.output = None
+            self.task = asyncio.ensure_future(self.create_socket(), loop=self.loop)
+            return
+
         # Creates a socket and uses inherited methods from asyncio.Protocol as
         # callbacks for network events.
         self.output = ProxySessionOutput(self, self.request)
-        coro = self.loop.create_connection(lambda: self.output,
-                                           self.request.host, self.request.port)
-        self.task = asyncio.async(coro)
+        self.task = asyncio.ensure_future(self.create_connection(), loop=self.loop)
+
+    def raw_tunnel(self):
+        '''
+        Indicate whether a CONNECT tunnel can relay between the client and
+        remote sockets directly instead of through the transports.
+        '''
+        # tunnel() takes the data the client sent after the request from
+        # the private buffer of the StreamReader. If a Python version does
+        # without it, the tunnel relays through the transports instead.
+        return (config.tunnel_raw and hasattr(self.loop, 'sock_recv_into') and
+                isinstance(getattr(self.reader, '_buffer', None), bytearray) and
+                self.writer.get_extra_info('socket') is not None)
+
+    async def create_socket(self):
+        '''
+        Resolve the remote server with the cache of the proxy server and
+        race connections to its addresses, within CONNECT_TIMEOUT seconds
+        of the connect limiter letting the connect start.
+
+        :return: the connected socket.
+        :raises: Saturated if the connect limiter sheds the connect, or
+          asyncio.TimeoutError.
+        '''
+        connects = self.server.connects
+        # The queue of the limiter has its own timeout, so a queued
+        # request is shed with a 503 rather than timing out with a 504.
+        await connects.acquire(self.request.host)
+        try:
+            return await asyncio.wait_for(self.resolve_and_connect(), config.connect_timeout)
+        finally:
+            connects.release(self.request.host)
+
+    async def resolve_and_connect(self):
+        stages = self.server.metrics.stage_seconds
+        start = time.monotonic()
+        addresses = await self.server.resolver.resolve(self.request.host,
+                                                       self.request.port)
+        resolved = time.monotonic()
+        stages.observe(resolved - start, 'dns', self.verdict)
+        sock = await connector.open_socket(self.loop, addresses,
+                                           config.connect_attempt_delay / 1000)
+        connected = time.monotonic()
+        stages.observe(connected - resolved, 'connect', self.verdict)
+        self.request.timings['dns'] = resolved - start
+        self.request.timings['connect'] = connected - resolved
+        return sock
+
+    async def create_connection(self):
+        '''
+        Connect to the remote server and attach the output protocol.
+        '''
+        sock = await self.create_socket()
+        try:
+            return await self.loop.create_connection(lambda: self.output, sock=sock)
+        except BaseException:
+            sock.close()
+            raise
+
+    async def open(self):
+        '''
+        Wait for the outbound connection to be established.
+
+        The client receives a 503 if the connect was shed, a 504 if the
+        connection could not be set up within CONNECT_TIMEOUT seconds and a
+        502 if it failed outright.
+
+        :return: True if the connection is ready.
+        '''
+        try:
+            await self.task
+        except admission.Saturated as err:
+            logging.info('Request shed (%s): %s', err, self.request)
+            self.request.status = 503
+            self.server.metrics.shed.inc()
+            self.writer.write(ProxyServer.unavailable())
+            return False
+        except asyncio.TimeoutError:
+            logging.info('Connection to remote timed out: %s', self.request)
+            self.request.status = 504
+            self.writer.write(b'HTTP/1.1 504 Gateway Timeout\r\n'
+                              b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            return False
+        except OSError as err:
+            logging.info('Could not connect to remote (%s): %s', err, self.request)
+            self.request.status = 502
+            self.writer.write(b'HTTP/1.1 502 Bad Gateway\r\n'
+                              b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            return False
+        return True
 
     async def run(self):
-        while not self.output.ready() and not self.request.timed_out():
-            await asyncio.sleep(0.5)
+        '''
+        Forward the request to the remote server and the response back to
+        the client.
+
+        :return: True if the client connection can be used for another
+          request afterwards.
+        '''
+        if not await self.open():
+            return False
+
+        if self.request.method == 'CONNECT':
+            if self.output is None:
+                return await self.tunnel()
+            while not self.reader.at_eof():
+                data = await self.reader.read(8192)
+                await self.forward(data)
+            return False
+
+        if not self.body_sent:
+            body = self.loop.create_task(self.send_body())
+        else:
+            body = None
+        retry = await self.response_done
+        if retry:
+            # A pooled connection was closed by the remote before it
+            # answered, try again once on a new connection.
+            logging.debug('Retrying request on a new connection: %s', self.request)
+            self.response_done = self.loop.create_future()
+            self.connect(reuse=False)
+            if not await self.open():
+                return False
+            await self.response_done
+        if body is not None:
+            body.cancel()
+
+        http_cache = self.server.http_cache
+        if self.not_modified and self.response is not None:
+            logging.debug('Serving revalidated response from the HTTP cache: %s', self.request)
+            entry = http_cache.revalidated(self.request, self.cache_entry, self.response.headers,
+                                           self.request_time, time.time())
+            persistent = await self.server.write_cached(self.request, self.writer, entry)
+            return persistent and self.body_sent
+        if self.recording is not None and self.response is not None:
+            http_cache.store(self.request, self.response, bytes(self.recording),
+                             self.request_time, time.time())
+
+        if self.response is not None:
+            self.request.status = self.response.status
+
+        # The client connection stays open if both sides want it and the
+        # request and response were delimited completely.
+        return (self.response is not None and self.response.keep_alive and
+                self.body_sent and self.request.persistent())
+
+    async def tunnel(self):
+        '''
+        Answer a CONNECT request and relay the tunnel between the raw
+        sockets, with splice() where available.
+
+        :return: False, the client connection cannot be used afterwards.
+        '''
+        remote = self.task.result()
+        client = None
+        try:
+            # Stop the transport from reading and flush the 200 completely
+            # before the sockets are used directly.
+            transport = self.writer.transport
+            transport.pause_reading()
+            transport.set_write_buffer_limits(high=0)
+            self.writer.write(b'HTTP/1.1 200 OK\n\n')
+            self.request.status = 200
+            await self.writer.drain()
+
+            # Data the client sent right after the request, e.g. a TLS
+            # ClientHello, was already read into the stream buffer.
+            # StreamReader has no public API to take it; raw_tunnel()
+            # checked that the buffer exists.
+            pending = bytes(self.reader._buffer)
+            self.reader._buffer.clear()
+            if pending:
+                await self.loop.sock_sendall(remote, pending)
+
+            client = tunnel.client_socket(self.writer)
+            sent, received = await tunnel.relay(self.loop, client, remote,
+                                                config.tunnel_buffer, config.tunnel_splice)
+            relayed = self.server.metrics.bytes
+            relayed.inc('upstream', self.verdict, amount=sent + len(pending))
+            relayed.inc('downstream', self.verdict, amount=received)
+            self.request.bytes_received += sent + len(pending)
+            self.request.bytes_sent += received
+            logging.debug('Tunnel closed after %d bytes sent and %d bytes received (Session %s)',
+                          sent + len(pending), received, self.request.session_id)
+        finally:
+            remote.close()
+            if client is not None:
+                client.close()
+        return False
 
-        if self.request.timed_out():
-            logging.info('Request timed out: %s' % self.request)
+    def revalidate(self, entry):
+        '''
+        Make the request conditional on the validators of a stale stored
+        response.
+        '''
+        self.cache_entry = entry
+        for name, value in entry.validators():
+            self.request.headers.add(name, value)
+
+    def write_response(self, data, response):
+        '''
+        Forward response data from the remote server to the client.
+        '''
+        if self.not_modified:
+            return
+        if self.cache_entry is not None:
+            if response.status is None:
+                self.held.append(data)
+                return
+            if response.status == 304:
+                # The stored response is sent once the 304 is complete.
+                self.not_modified = True
+                self.held = []
+                return
+            data = b''.join(self.held) + data
+            self.held = []
+            self.cache_entry = None
+
+        if self.recording is not None:
+            if len(self.recording) + len(data) > self.server.http_cache.max_object_size:
+                self.recording = None
+            else:
+                self.recording += data
+        if self.flight is not None:
+            self.flight.feed(data, response)
+        self.writer.write(data)
+        self.request.bytes_sent += len(data)
+        self.server.metrics.bytes.inc('downstream', self.verdict, amount=len(data))
+
+    def lagging(self):
+        '''
+        Indicate whether a client that is sent the response is slow to
+        accept data, so reading from the remote should pause.
+        '''
+        return (self.writer.transport.get_write_buffer_size() > config.buffer_high or
+                (self.flight is not None and self.flight.backlog() > config.buffer_high))
+
+    async def drain(self):
+        '''
+        Wait until every client that is sent the response caught up.
+        '''
+        await self.writer.drain()
+        if self.flight is not None:
+            await self.flight.drain()
+
+    async def forward(self, data):
+        '''
+        Write data to the remote server, waiting for it to catch up if
+        its write buffer is full.
+        '''
+        self.output.transport.write(data)
+        self.request.bytes_received += len(data)
+        self.server.metrics.bytes.inc('upstream', self.verdict, amount=len(data))
+        # Stop reading from the client until the remote catches up.
+        await self.output.drain()
+
+    @staticmethod
+    def has_body(request):
+        '''
+        Indicate whether a request is followed by a body.
+        '''
+        headers = request.headers
+        return ('transfer-encoding' in headers or
+                headers.get('content-length', '0') != '0')
+
+    async def send_body(self):
+        '''
+        Forward the request body from the client. The body is delimited by
+        chunked transfer coding or Content-Length; a request with neither
+        has no body.
+        '''
+        coding = self.request.headers.get('transfer-encoding')
+        if coding is not None:
+            if coding.split(',')[-1].strip().lower() != 'chunked':
+                logging.info('Unsupported request transfer coding: %s', coding)
+                self.writer.close()
+                return
+            self.body_sent = await self.send_chunked_body()
+            return
+
+        try:
+            length = int(self.request.headers.get('content-length', 0))
+        except ValueError:
+            logging.info('Invalid request Content-Length: %s', self.request)
+            self.writer.close()
             return
+        self.body_sent = await self.copy_body(length)
+
+    async def copy_body(self, length):
+        '''
+        Forward exactly `length` bytes from the client.
+
+        :return: False if the client closed the connection first.
+        '''
+        while length > 0:
+            data = await self.reader.read(min(length, 65536))
+            if not data:
+                return False
+            length -= len(data)
+            await self.forward(data)
+        return True
+
+    async def send_chunked_body(self):
+        '''
+        Forward a body sent with chunked transfer coding, including any
+        trailer fields.
 
-        while not self.reader.at_eof():
-            data = await self.reader.read(8192)
-            self.output.transport.write(data)
+        :return: False if the client closed the connection first.
+        '''
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return False
+            await self.forward(line)
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                logging.info('Invalid chunk size in request body: %s', self.request)
+                self.writer.close()
+                return False
+            if size == 0:
+                break
+            # Chunk data is followed by a CRLF.
+            if not await self.copy_body(size + 2):
+                return False
+
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return False
+            await self.forward(line)
+            if line in (b'\r\n', b'\n'):
+                return True
+
+    def response_finished(self, retry=False):
+        '''
+        Called by the output once the response was forwarded or the
+        remote closed the connection.
+        '''
+        if not self.response_done.done():
+            self.response_done.set_result(retry)
 
 
 class ProxySessionOutput(asyncio.Protocol):
@@ -314,6 +1201,21 @@ class ProxySessionOutput(asyncio.Protocol):
         self.proxysession = proxysession
         self.request = request
         self.transport = None
+        self.response = None
+        # Time the request was sent, until the first response byte arrives
+        self.sent = None
+
+        # Set while the connection waits in this pool for the next request.
+        self.pool = None
+        # Set if the connection was taken from the pool.
+        self.reused = False
+
+        # Flow control state: `paused` is set while the remote's write
+        # buffer is above the high watermark, `reading_paused` while the
+        # client's is.
+        self.paused = False
+        self.reading_paused = False
+        self.drain_waiter = None
 
     def ready(self):
         '''
@@ -329,45 +1231,173 @@ class ProxySessionOutput(asyncio.Protocol):
         Forward the request to the remote server.
         '''
 
-        logging.debug('CONNECTION SUCCESSFUL TO REMOTE (Session {0})'.format(self.request.session_id))
+        logging.debug('CONNECTION SUCCESSFUL TO REMOTE (Session %s)', self.request.session_id)
 
         self.transport = transport
-
-        logging.debug('FORWARDING REQUEST TO REMOTE (Session {0})'.format(self.request.session_id))
+        self.transport.set_write_buffer_limits(high=config.buffer_high,
+                                               low=config.buffer_low)
 
         # Special handling for the CONNECT method.
         # Notify the client that the connection has been opened.
         if self.request.method == 'CONNECT':
             self.proxysession.writer.write(b'HTTP/1.1 200 OK\n\n')
+            self.request.status = 200
             return
 
-        self.transport.write('{method} {path} HTTP/1.0\r\nHost: {host}\r\nConnection: close\r\n'.format(**{
-            'method': self.request.method,
-            'host': self.request.host,
-            'path': self.request.path
-        }).encode('iso-8859-1'))
-        for header, value in self.request.headers.items():
-            if header.lower() in ('connection', 'host'):
+        self.send_request()
+
+    def attach(self, proxysession):
+        '''
+        Reuse this pooled connection for the request of another session.
+        '''
+        self.proxysession = proxysession
+        self.request = proxysession.request
+        self.pool = None
+        self.reused = True
+        self.send_request()
+
+    def send_request(self):
+        '''
+        Send the request line and headers to the remote server.
+        '''
+        logging.debug('FORWARDING REQUEST TO REMOTE (Session %s)', self.request.session_id)
+
+        request = self.request
+        self.response = message.ResponseParser(request.method)
+        self.sent = time.monotonic()
+
+        # Headers that only apply to the client connection are not
+        # forwarded, including the ones named in the Connection header.
+        hop_by_hop = {'connection', 'host', 'keep-alive', 'proxy-connection'}
+        for option in request.headers.get('connection', '').split(','):
+            hop_by_hop.add(option.strip().lower())
+
+        version = 'HTTP/1.1' if request.version == 'HTTP/1.1' else 'HTTP/1.0'
+        host = request.host
+        if request.port != 80:
+            host = '%s:%s' % (host, request.port)
+
+        lines = ['{0} {1} {2}'.format(request.method, request.path, version),
+                 'Host: {0}'.format(host)]
+        if not self.proxysession.pooling():
+            lines.append('Connection: close')
+        for header, value in request.headers.items():
+            if header.lower() in hop_by_hop:
                 continue
-            self.transport.write('{header}: {value}\r\n'.format(**{
-                'header': header,
-                'value': value
-            }).encode('iso-8859-1'))
-        self.transport.write(b'\r\n')
+            lines.append('{0}: {1}'.format(header, value))
+        lines.append('\r\n')
+        self.transport.write('\r\n'.join(lines).encode('iso-8859-1'))
 
     def data_received(self, data):
         '''
         Callback for when data was received over the network.
         Pass the data to the proxy session.
         '''
+        session = self.proxysession
+        if session is None:
+            # An idle connection should not receive anything; the remote
+            # is misbehaving, so stop reusing the connection.
+            if self.pool is not None:
+                self.pool.evict(self)
+            return
 
-        logging.debug('RESPONSE RECEIEVED FROM REMOTE (Session {0})'.format(self.request.session_id))
+        if self.sent is not None:
+            ttfb = time.monotonic() - self.sent
+            session.server.metrics.stage_seconds.observe(ttfb, 'ttfb', session.verdict)
+            self.request.timings['ttfb'] = ttfb
+            self.sent = None
 
-        logging.debug('FORWARDING RESPONSE TO USER (Session {0})'.format(self.request.session_id))
+        if self.response is None:
+            session.writer.write(data)
+            self.request.bytes_sent += len(data)
+            session.server.metrics.bytes.inc('downstream', session.verdict, amount=len(data))
+        else:
+            try:
+                end = self.response.feed(data)
+            except ValueError as err:
+                logging.info('Invalid response from remote (%s): %s', err, self.request)
+                self.transport.close()
+                return
 
-        self.proxysession.writer.write(data)
+            session.write_response(data if end == len(data) else data[:end], self.response)
+            if self.response.complete:
+                self.finish(end == len(data))
+                return
 
-        logging.debug('FORWARDED RESPONSE TO USER (Session {0})'.format(self.request.session_id))
+        # Stop reading from the remote while the client is slow to accept
+        # data, resume once its buffer drains below the low watermark.
+        if not self.reading_paused and session.lagging():
+            self.reading_paused = True
+            self.transport.pause_reading()
+            session.loop.create_task(self.resume_after_drain(session))
+
+    def finish(self, clean):
+        '''
+        The response is complete. Return the connection to the pool if
+        it can be reused, otherwise close it.
+
+        :param clean: False if the remote sent more than the response.
+        '''
+        session = self.proxysession
+        self.proxysession = None
+
+        if self.reading_paused:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+        if clean and self.response.keep_alive and session.body_sent and session.pooling():
+            self.pool = session.server.pool
+            self.pool.release(self.request.host, self.request.port, self)
+        else:
+            self.transport.close()
+
+        session.response = self.response
+        session.response_finished()
+
+    async def resume_after_drain(self, session):
+        '''
+        Wait for the client's write buffer to drain and resume reading
+        from the remote server.
+        '''
+        try:
+            await session.drain()
+        except ConnectionError:
+            return
+        if self.proxysession is not session or not self.reading_paused:
+            return
+        self.reading_paused = False
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        '''
+        Callback for when the remote's write buffer goes over the high
+        watermark.
+        '''
+        self.paused = True
+
+    def resume_writing(self):
+        '''
+        Callback for when the remote's write buffer drains below the low
+        watermark.
+        '''
+        self.paused = False
+        self.wake_drain_waiter()
+
+    def wake_drain_waiter(self):
+        waiter = self.drain_waiter
+        self.drain_waiter = None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def drain(self):
+        '''
+        Wait until the remote's write buffer is below the low watermark.
+        '''
+        if not self.paused:
+            return
+        self.drain_waiter = asyncio.get_event_loop().create_future()
+        await self.drain_waiter
 
     def connection_lost(self, exc):
         '''
@@ -375,6 +1405,29 @@ class ProxySessionOutput(asyncio.Protocol):
         Notify the proxy session to close.
         '''
 
-        logging.debug('DISCONNECTED FROM REMOTE (Session {0})'.format(self.request.session_id))
+        logging.debug('DISCONNECTED FROM REMOTE (Session %s)', self.request.session_id)
+
+        self.paused = False
+        self.wake_drain_waiter()
+
+        session = self.proxysession
+        self.proxysession = None
+        if session is None:
+            if self.pool is not None:
+                self.pool.discard(self)
+            return
+
+        if (self.reused and self.response.status is None and
+                not self.response.buffer and not ProxySession.has_body(session.request)):
+            session.response_finished(retry=True)
+            return
 
-        self.proxysession.writer.close()
+        if self.response is not None:
+            self.response.close()
+            if not self.response.complete:
+                # A cut-off response must not be stored.
+                session.recording = None
+        session.writer.close()
+        # A response delimited by the connection closing ends here.
+        session.response = self.response
+        session.response_finished()
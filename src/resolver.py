@@ -0,0 +1,150 @@
+import asyncio
+import collections
+import concurrent.futures
+import ipaddress
+import logging
+import socket
+import time
+
+
+class Resolver():
+    '''
+    Caches the addresses of remote servers so that requests do not have
+    to wait for getaddrinfo() in a thread every time.
+
+    getaddrinfo() does not return the TTL of the DNS records, so answers
+    are kept for `ttl` seconds and failed lookups for `negative_ttl`
+    seconds. Concurrent lookups of the same name share one getaddrinfo()
+    call, which runs in an executor of `workers` threads that is separate
+    from the default executor used for list downloads.
+    '''
+    def __init__(self, loop, ttl, negative_ttl, workers, max_entries,
+                 getaddrinfo=socket.getaddrinfo):
+        self.loop = loop
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.getaddrinfo = getaddrinfo
+        self.executor = concurrent.futures.ThreadPoolExecutor(max(1, workers))
+
+        # (host, port) -> (expiry, addresses or exception), oldest first
+        self.cache = collections.OrderedDict()
+        # (host, port) -> future of the lookup in progress
+        self.pending = {}
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.lookups = 0
+        self.lookup_time = 0.0
+        self.max_lookup_time = 0.0
+
+    async def resolve(self, host, port):
+        '''
+        :return: a list of getaddrinfo() tuples for stream sockets to
+          (host, port).
+        :raises: OSError if the name cannot be resolved.
+        '''
+        literal = Resolver.literal(host, port)
+        if literal is not None:
+            return literal
+
+        key = (host, port)
+        entry = self.cache.get(key)
+        if entry is not None:
+            expiry, result = entry
+            if expiry > self.loop.time():
+                if isinstance(result, Exception):
+                    self.negative_hits += 1
+                    # Raise a new exception so that tracebacks do not pile
+                    # up on the cached one.
+                    raise type(result)(*result.args)
+                self.hits += 1
+                return result
+            del self.cache[key]
+
+        future = self.pending.get(key)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(self.lookup(host, port), loop=self.loop)
+            self.pending[key] = future
+            future.add_done_callback(lambda future: self.lookup_done(key, future))
+        else:
+            self.coalesced += 1
+
+        # A waiter that is cancelled, e.g. by a request timeout, must not
+        # cancel the lookup for the other waiters.
+        return await asyncio.shield(future)
+
+    @staticmethod
+    def literal(host, port):
+        '''
+        :return: the address info for an IP address literal, or None if
+          `host` is a name.
+        '''
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return None
+        if address.version == 6:
+            return [(socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                     (host, port, 0, 0))]
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                 (host, port))]
+
+    async def lookup(self, host, port):
+        start = time.monotonic()
+        try:
+            result = await self.loop.run_in_executor(
+                self.executor, self.getaddrinfo, host, port, 0, socket.SOCK_STREAM)
+            if not result:
+                raise socket.gaierror(socket.EAI_NONAME, 'No addresses found')
+        except OSError as err:
+            logging.debug('Could not resolve %s: %s' % (host, err))
+            self.store((host, port), err, self.negative_ttl)
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            self.lookups += 1
+            self.lookup_time += elapsed
+            self.max_lookup_time = max(self.max_lookup_time, elapsed)
+
+        self.store((host, port), result, self.ttl)
+        return result
+
+    def lookup_done(self, key, future):
+        del self.pending[key]
+        # Mark the exception as retrieved in case every waiter was
+        # cancelled.
+        if not future.cancelled():
+            future.exception()
+
+    def store(self, key, result, ttl):
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        self.cache.pop(key, None)
+        self.cache[key] = (self.loop.time() + ttl, result)
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+    def clear(self):
+        self.cache.clear()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        '''
+        :return: a dict of resolver counters and lookup latencies in
+          milliseconds.
+        '''
+        return {
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'entries': len(self.cache),
+            'avg_lookup_ms': 1000 * self.lookup_time / self.lookups if self.lookups else 0.0,
+            'max_lookup_ms': 1000 * self.max_lookup_time,
+        }
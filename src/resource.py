@@ -1,45 +1,305 @@
+import os
 import re
 import json
+import mmap
+import array
+import bisect
+import struct
+import hashlib
+import logging
+import collections
+import tempfile
+import urllib.error
 import urllib.request
 
+try:
+    import re._parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
 
-def fetch_json(url):
+
+class NotModified(Exception):
+    '''
+    Raised by fetch_json when the server reports that the data has not
+    changed since it was last downloaded.
+    '''
+
+
+def fetch_json(url, validators=None, timeout=None):
     '''
     Download JSON data and parse it.
+
+    If `validators` is given, the ETag and Last-Modified values it holds
+    are sent as conditional request headers, and it is updated with the
+    values from the response.
+
+    :raises: NotModified if the server answers 304 Not Modified.
     '''
-    req = urllib.request.urlopen(url)
+    request = urllib.request.Request(url)
+    if validators:
+        if validators.get('etag'):
+            request.add_header('If-None-Match', validators['etag'])
+        if validators.get('last-modified'):
+            request.add_header('If-Modified-Since', validators['last-modified'])
+
+    try:
+        req = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as err:
+        if err.code == 304:
+            raise NotModified(url)
+        raise
     data = req.read()
     data = json.loads(data.decode('utf-8'))
+
+    if validators is not None:
+        validators['etag'] = req.headers.get('ETag')
+        validators['last-modified'] = req.headers.get('Last-Modified')
     return data
 
 
+class ListSource():
+    '''
+    Downloads a ruleset from a URL. The last good copy is saved in
+    `cache_dir` together with its validators, so that refreshes are
+    conditional and a list server that is down or slow does not leave
+    the proxy without rules when it starts.
+    '''
+    def __init__(self, url, cache_dir=None, timeout=None):
+        self.url = url
+        self.timeout = timeout
+        self.validators = {}
+        self.path = None
+        if cache_dir:
+            name = hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json'
+            self.path = os.path.join(cache_dir, name)
+
+    def fetch(self):
+        '''
+        Download the ruleset if it changed since the last download.
+
+        :return: the ruleset, or None if it was not modified.
+        '''
+        try:
+            ruleset = fetch_json(self.url, self.validators, self.timeout)
+        except NotModified:
+            return None
+        self.save(ruleset)
+        return ruleset
+
+    def load(self):
+        '''
+        Get the current ruleset, falling back to the copy on disk if it
+        cannot be downloaded.
+        '''
+        cached = self.read_cache()
+        if cached is not None:
+            self.validators = cached['validators']
+
+        try:
+            ruleset = self.fetch()
+        except (OSError, ValueError) as err:
+            if cached is None:
+                raise
+            logging.warning('Could not download %s (%s), using the copy on disk' % (self.url, err))
+            return cached['ruleset']
+
+        if ruleset is None:
+            return cached['ruleset']
+        return ruleset
+
+    @property
+    def compiled_path(self):
+        '''
+        Path of the compiled copy of a blacklist or whitelist, see
+        ResourceList.compile_to.
+        '''
+        if self.path is None:
+            return None
+        return os.path.splitext(self.path)[0] + '.rules'
+
+    def read_cache(self):
+        '''
+        :return: the saved copy as a dict with `validators` and `ruleset`,
+          or None if there is none.
+        '''
+        if self.path is None:
+            return None
+        try:
+            with open(self.path, 'r') as cache:
+                cached = json.load(cache)
+        except (OSError, ValueError):
+            return None
+        if cached.get('url') != self.url:
+            return None
+        return cached
+
+    def save(self, ruleset):
+        if self.path is None:
+            return
+        data = {'url': self.url, 'validators': self.validators, 'ruleset': ruleset}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w') as cache:
+                json.dump(data, cache)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            logging.warning('Could not save %s to %s: %s' % (self.url, self.path, err))
+
+
+class DomainTable():
+    '''
+    Read-only set of domains in a sorted table, stored in a buffer such as
+    a memory map so that several processes can share one copy. It takes
+    far less memory than a set of domain strings, since no Python
+    object is kept per domain.
+
+    Every domain is stored with its labels reversed and each label
+    followed by a NUL byte, e.g. b'com\\x00example\\x00'. A host or one of
+    its parent domains is listed if the entry just before the host in the
+    table is a prefix of it: subdomains of listed domains are not stored,
+    so no other entry can sort between a listed parent and the host.
+    '''
+    def __init__(self, buffer, offset, count):
+        self.buffer = buffer
+        self.count = count
+        self.offsets = memoryview(buffer)[offset:offset + 4 * (count + 1)].cast('I')
+        self.data = offset + 4 * (count + 1)
+
+    @staticmethod
+    def key(domain):
+        return ('\x00'.join(reversed(domain.split('.'))) + '\x00').encode('utf-8', 'surrogatepass')
+
+    @staticmethod
+    def pack(domains):
+        '''
+        :return: the offsets and the data of the table for `domains`.
+        '''
+        offsets = array.array('I', [0])
+        entries = []
+        last = None
+        for key in sorted(set(DomainTable.key(domain) for domain in domains)):
+            if last is not None and key.startswith(last):
+                continue  # a parent domain is already listed
+            entries.append(key)
+            offsets.append(offsets[-1] + len(key))
+            last = key
+        return offsets, b''.join(entries)
+
+    @classmethod
+    def build(cls, domains):
+        '''
+        :return: a table of `domains` in memory.
+        '''
+        offsets, data = cls.pack(domains)
+        return cls(offsets.tobytes() + data, 0, len(offsets) - 1)
+
+    def match(self, host):
+        '''
+        Indicate whether `host` or one of its parent domains is listed.
+        '''
+        key = DomainTable.key(host)
+        index = bisect.bisect_right(self, key) - 1
+        return index >= 0 and key.startswith(self[index])
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.count:
+            raise IndexError(index)
+        return self.buffer[self.data + self.offsets[index]:self.data + self.offsets[index + 1]]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index in range(self.count):
+            labels = self[index].decode('utf-8', 'surrogatepass').split('\x00')[:-1]
+            yield '.'.join(reversed(labels))
+
+    def sizeof(self):
+        return len(self.buffer)
+
+
 class ResourceList():
     '''
     Stores a ruleset and allows checking a request against the ruleset.
     '''
     def __init__(self):
-        self.domains = set()
+        self.domains = DomainTable.build(())
         self.path_regex = None
         self.full_regex = None
 
+    # Header of a compiled list: magic, number of domains, offset and size
+    # of the JSON with the patterns. The domain table follows the header.
+    MAGIC = b'KALRULE1'
+    HEADER = struct.Struct('=8sIII')
+
     def load(self, url):
         '''
         Download a ruleset from a given URL.
         '''
-        ruleset = fetch_json(url)
+        self.build(fetch_json(url))
 
-        if 'domain' in ruleset:
-            self.domains = set(ruleset['domain'])
-        else:
-            self.domains = set()
+    @classmethod
+    def compile_to(cls, ruleset, path):
+        '''
+        Write a ruleset to `path` in the format read by open(). The file
+        is replaced atomically, so processes that mapped the old file
+        keep using it until they open the new one.
+        '''
+        offsets, data = DomainTable.pack(ruleset.get('domain', ()))
+        patterns = {key: ruleset[key] for key in ('path', 'misc') if key in ruleset}
+        patterns = json.dumps(patterns).encode('utf-8')
+        table_size = len(offsets) * offsets.itemsize + len(data)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as compiled:
+                compiled.write(cls.HEADER.pack(cls.MAGIC, len(offsets) - 1,
+                                               cls.HEADER.size + table_size, len(patterns)))
+                compiled.write(offsets.tobytes())
+                compiled.write(data)
+                compiled.write(patterns)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Memory map a list written by compile_to(). Only the regexes are
+        compiled; the domains are looked up in the shared mapping.
+
+        :raises: OSError if the file cannot be read, ValueError if it is
+          not a compiled list.
+        '''
+        with open(path, 'rb') as compiled:
+            buffer = mmap.mmap(compiled.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < cls.HEADER.size:
+            raise ValueError('Not a compiled list: %s' % path)
+        magic, count, patterns_offset, patterns_size = cls.HEADER.unpack_from(buffer)
+        if magic != cls.MAGIC or patterns_offset + patterns_size != len(buffer):
+            raise ValueError('Not a compiled list: %s' % path)
+
+        patterns = json.loads(buffer[patterns_offset:].decode('utf-8'))
+        rules = cls()
+        rules.build(patterns)
+        rules.domains = DomainTable(buffer, cls.HEADER.size, count)
+        return rules
+
+    def build(self, ruleset):
+        '''
+        Compile a downloaded ruleset.
+        '''
+        self.domains = DomainTable.build(ruleset.get('domain', ()))
 
         if 'path' in ruleset:
-            self.path_regex = re.compile('|'.join(ruleset['path']))
+            self.path_regex = PatternSet(ruleset['path'])
         else:
             self.path_regex = None
 
         if 'misc' in ruleset:
-            self.full_regex = re.compile('|'.join(ruleset['misc']))
+            self.full_regex = PatternSet(ruleset['misc'])
         else:
             self.full_regex = None
 
@@ -48,10 +308,8 @@ class ResourceList():
         Indicate whether a request matches the blacklist.
         :param request HTTPRequest:
         '''
-        host_parts = request.host.split('.')
-        for i in range(len(host_parts)):
-            if '.'.join(host_parts[i:]) in self.domains:
-                return True
+        if self.domains.match(request.host):
+            return True
 
         if self.path_regex is not None:
             if self.path_regex.match(request.path):
@@ -65,31 +323,419 @@ class ResourceList():
         return False
 
 
+class VerdictCache():
+    '''
+    Bounded LRU cache of the list verdict for a host and path, so the
+    lists only have to be checked once for URLs that are requested
+    repeatedly. The cache must be cleared whenever a list changes.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, host, path):
+        '''
+        :return: the cached verdict for (host, path) or None.
+        '''
+        key = (host, path)
+        verdict = self.entries.get(key)
+        if verdict is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return verdict
+
+    def put(self, host, path, verdict):
+        if self.size <= 0:
+            return
+        self.entries[(host, path)] = verdict
+        self.entries.move_to_end((host, path))
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        '''
+        :return: a dict of cache counters for sizing the cache.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def parse_pattern(pattern):
+    '''
+    Parse a regular expression with the parser of the re module.
+
+    :return: a tuple of the parsed pattern and its parser state, which
+      holds the flags and groups of the pattern.
+    :raises: re.error if the pattern is invalid.
+    '''
+    parsed = sre_parse.parse(pattern)
+    # The parser state is called `pattern` before Python 3.8.
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    return parsed, state
+
+
+def subpatterns(av):
+    '''
+    Yield the parsed subpatterns nested in the argument of a parsed op.
+    '''
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (list, tuple)):
+        for item in av:
+            for sub in subpatterns(item):
+                yield sub
+
+
+def refers_to_groups(parsed):
+    '''
+    Indicate whether a parsed pattern contains backreferences or
+    conditionals, which would refer to the wrong groups if the pattern
+    was combined with others into a single regex.
+    '''
+    for op, av in parsed:
+        if op == sre_parse.GROUPREF or op == sre_parse.GROUPREF_EXISTS:
+            return True
+        for sub in subpatterns(av):
+            if refers_to_groups(sub):
+                return True
+    return False
+
+
+def literal_prefix(parsed, state):
+    '''
+    :return: the literal text that every match of a parsed pattern
+      starts with, which may be empty.
+    '''
+    if state.flags & sre_parse.SRE_FLAG_IGNORECASE:
+        return ''
+    prefix = []
+    for op, av in parsed:
+        if op != sre_parse.LITERAL:
+            break
+        prefix.append(chr(av))
+    return ''.join(prefix)
+
+
+def is_dot_star(item):
+    '''
+    Indicate whether a parsed pattern item is `.*` or `.*?`.
+    '''
+    op, av = item
+    return (op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and
+            av[0] == 0 and av[1] == sre_parse.MAXREPEAT and
+            list(av[2]) == [(sre_parse.ANY, None)])
+
+
+class Automaton():
+    '''
+    Aho-Corasick automaton which finds all occurrences of a set of
+    literal strings in a single scan of a text.
+    '''
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+    def add(self, literal, value):
+        '''
+        Add a literal string; `value` is reported for each occurrence.
+        '''
+        node = 0
+        for char in literal:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.goto[node][char] = child
+            node = child
+        self.outputs[node].append(value)
+
+    def build(self):
+        '''
+        Compute the failure links. Must be called after the last add().
+        '''
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[child] = fail
+                # A node also reports the literals that end at its
+                # longest proper suffix.
+                self.outputs[child].extend(self.outputs[fail])
+                queue.append(child)
+        self.outputs = [tuple(output) for output in self.outputs]
+
+    def search(self, text):
+        '''
+        Yield a tuple of the end index and the value of every occurrence
+        of a literal in `text`.
+        '''
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for value in outputs[node]:
+                yield index, value
+
+
+class PatternSet():
+    '''
+    Matches text against a list of regexes with the same result as
+    re.match() with the patterns joined into one alternation.
+
+    The patterns are analysed once when the set is built:
+    - `.*literal.*` only needs to find the literal before the first
+      newline, and `literal.*` only needs the text to start with it;
+    - other patterns with a literal of at least MIN_LITERAL characters
+      are only run when that literal occurs in the text;
+    - the remaining patterns are joined into a fallback regex.
+    The literals of the first two kinds are found in a single scan by an
+    Aho-Corasick automaton.
+    '''
+    SUBSTRING = 0
+    PREFIX = 1
+    FILTER = 2
+
+    MIN_LITERAL = 3
+
+    def __init__(self, patterns):
+        # Like the empty regex, an empty set of patterns matches anything.
+        self.always = not patterns
+        self.automaton = None
+        self.fallback = None
+
+        analysed = [parse_pattern(pattern) for pattern in patterns]
+        if any(state.flags & ~sre_parse.SRE_FLAG_UNICODE or refers_to_groups(parsed)
+               for parsed, state in analysed):
+            # Inline flags apply to the other patterns in the joined regex
+            # too and backreferences depend on the groups before them, so
+            # keep the exact old behavior.
+            self.fallback = re.compile('|'.join(patterns))
+            return
+
+        automaton = Automaton()
+        fallback = []
+        for pattern, (parsed, state) in zip(patterns, analysed):
+            kind, literal = PatternSet.classify(parsed)
+            if kind is None:
+                self.always = True
+            elif kind == PatternSet.FILTER and len(literal) < PatternSet.MIN_LITERAL:
+                fallback.append(pattern)
+            else:
+                regex = re.compile(pattern) if kind == PatternSet.FILTER else None
+                automaton.add(literal, (kind, len(literal), regex))
+
+        if len(automaton.goto) > 1:
+            automaton.build()
+            self.automaton = automaton
+        if fallback:
+            self.fallback = re.compile('|'.join(fallback))
+
+    @staticmethod
+    def classify(parsed):
+        '''
+        :return: a tuple of the kind of test a parsed pattern needs and its
+          literal, or (None, '') if the pattern matches any text.
+        '''
+        items = list(parsed)
+        # A trailing .* does not change whether re.match() matches.
+        while items and is_dot_star(items[-1]):
+            items.pop()
+        start = 0
+        while start < len(items) and is_dot_star(items[start]):
+            start += 1
+
+        end = start
+        while end < len(items) and items[end][0] == sre_parse.LITERAL:
+            end += 1
+        if end == len(items):
+            literal = ''.join(chr(av) for op, av in items[start:end])
+            if not literal:
+                return None, ''
+            if start > 0:
+                return PatternSet.SUBSTRING, literal
+            return PatternSet.PREFIX, literal
+
+        # Every top-level literal has to occur in a match; use the longest
+        # run of them as the filter.
+        longest = run = ''
+        for op, av in parsed:
+            if op == sre_parse.LITERAL:
+                run += chr(av)
+                if len(run) > len(longest):
+                    longest = run
+            else:
+                run = ''
+        return PatternSet.FILTER, longest
+
+    def match(self, text):
+        '''
+        Indicate whether any of the patterns matches at the start of `text`.
+        '''
+        if self.always:
+            return True
+
+        if self.automaton is not None:
+            newline = text.find('\n')
+            if newline < 0:
+                newline = len(text)
+            tried = None
+            for end, (kind, length, regex) in self.automaton.search(text):
+                start = end - length + 1
+                if kind == PatternSet.SUBSTRING:
+                    # The leading .* cannot match across a newline.
+                    if start <= newline:
+                        return True
+                elif kind == PatternSet.PREFIX:
+                    if start == 0:
+                        return True
+                else:
+                    if tried is None:
+                        tried = set()
+                    elif regex in tried:
+                        continue
+                    tried.add(regex)
+                    if regex.match(text):
+                        return True
+
+        if self.fallback is not None:
+            return self.fallback.match(text) is not None
+        return False
+
+
+class RuleGroup():
+    '''
+    Cache rules combined into a single regex of named alternatives. The
+    regex engine tries the alternatives in order, so one match finds the
+    first matching rule of the group.
+    '''
+    def __init__(self):
+        self.rules = []
+        self.regex = None
+        self.redirects = {}
+
+    def add(self, index, pattern, redirect):
+        self.rules.append((index, pattern, redirect))
+
+    def compile(self):
+        alternatives = []
+        for index, pattern, redirect in self.rules:
+            name = 'r%d' % index
+            alternatives.append('(?P<%s>%s)' % (name, pattern))
+            self.redirects[name] = (index, redirect)
+        self.regex = re.compile('|'.join(alternatives))
+        self.rules = None
+
+    def match(self, url):
+        '''
+        :return: a tuple of the index and redirect of the first matching
+          rule, or None.
+        '''
+        match = self.regex.match(url)
+        if match is None:
+            return None
+        return self.redirects[match.lastgroup]
+
+
 class CacheList():
     '''
     Holds a cached resource ruleset and allows checking a request for
     a better location to load the cached resource from.
+
+    Rules are matched in list order and the first matching rule wins.
+    Rules that start with a literal host name and path are grouped by
+    that host, so a request is only checked against the rules for its
+    host and the rules that could match any host.
     '''
     def __init__(self):
-        self.resources = dict()
+        self.resources = []
+        self.by_host = {}
+        self.other = None
+        # Rules that cannot be combined with others, in list order
+        self.singles = []
 
     def load(self, url):
-        ruleset = fetch_json(url)
+        '''
+        Download a ruleset from a given URL.
+        '''
+        self.build(fetch_json(url))
 
+    def build(self, ruleset):
+        '''
+        Compile a downloaded ruleset.
+        '''
+        groups = {}
         for rule, url in ruleset.items():
             try:
-                rule_regex = re.compile(rule)
+                parsed, state = parse_pattern(rule)
+                regex = re.compile(rule)
             except Exception as err:
                 continue  # skipping invalid regex
-            self.resources[re.compile(rule)] = url
+            index = len(self.resources)
+            self.resources.append((rule, url))
+
+            # Patterns with their own flags or named groups, or that refer
+            # to their groups, only work as a standalone regex.
+            if (state.flags & ~sre_parse.SRE_FLAG_UNICODE or state.groupdict or
+                    refers_to_groups(parsed)):
+                self.singles.append((index, regex, url))
+                continue
+
+            host, slash, path = literal_prefix(parsed, state).partition('/')
+            key = host if slash else None
+            groups.setdefault(key, RuleGroup()).add(index, rule, url)
+
+        for key, group in groups.items():
+            group.compile()
+            if key is None:
+                self.other = group
+            else:
+                self.by_host[key] = group
 
     def check(self, request):
         '''
         :return: a new URL as a string or None if no rule matches.
         '''
         url = request.host + request.path
-        for rule, redirect in self.resources.items():
+        found = None
+        for group in (self.by_host.get(request.host), self.other):
+            if group is not None:
+                match = group.match(url)
+                if match is not None and (found is None or match[0] < found[0]):
+                    found = match
+
+        for index, rule, redirect in self.singles:
+            if found is not None and index > found[0]:
+                break
             if rule.match(url):
                 return redirect
 
+        if found is not None:
+            return found[1]
         return None
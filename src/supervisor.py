@@ -0,0 +1,554 @@
+import os
+import json
+import time
+import signal
+import socket
+import asyncio
+import logging
+import selectors
+
+import config
+import proxy
+import metrics
+import resource
+import accesslog
+
+
+# Exit status of the refresher process when at least one list changed.
+LISTS_CHANGED = 3
+
+# Workers that exit sooner than this after starting are restarted after
+# the same delay, so a worker that cannot start does not fork in a loop.
+RESPAWN_DELAY = 1
+
+
+def list_sources():
+    return [(name, resource.ListSource(url, config.list_cache_dir, config.list_timeout))
+            for name, url in (('blacklist', config.blacklist),
+                              ('whitelist', config.whitelist),
+                              ('cachelist', config.cachelist))]
+
+
+def save_list(name, source, ruleset):
+    '''
+    Compile the blacklist and whitelist to the file that the workers
+    memory map. The cache list is small and read from its JSON copy.
+    '''
+    if name != 'cachelist':
+        try:
+            resource.ResourceList.compile_to(ruleset, source.compiled_path)
+        except OSError as err:
+            logging.warning('Could not compile %s to %s: %s' % (name, source.compiled_path, err))
+
+
+def compiled(source):
+    '''
+    Indicate whether the compiled copy of a list is at least as new as
+    the saved JSON copy it was compiled from.
+    '''
+    if source.path is None:
+        return False
+    try:
+        return os.path.getmtime(source.compiled_path) >= os.path.getmtime(source.path)
+    except OSError:
+        return False
+
+
+def prepare_lists():
+    '''
+    Download the lists if needed and compile them before the workers
+    start, so that the workers only have to map them. A list that did
+    not change since it was last compiled is not compiled again.
+    '''
+    for name, source in list_sources():
+        ruleset = source.load()
+        if name != 'cachelist' and compiled(source):
+            continue
+        save_list(name, source, ruleset)
+
+
+def refresh_lists():
+    '''
+    Download the lists that changed since they were last saved to disk.
+
+    :return: True if any list changed.
+    '''
+    changed = False
+    for name, source in list_sources():
+        cached = source.read_cache()
+        if cached is not None:
+            source.validators = cached['validators']
+        try:
+            ruleset = source.fetch()
+            if ruleset is not None:
+                save_list(name, source, ruleset)
+                changed = True
+        except (OSError, ValueError) as err:
+            logging.error('Error while refreshing %s: %s' % (source.url, err))
+    return changed
+
+
+class Worker():
+    '''
+    A worker process as seen by the supervisor. Workers write a JSON line
+    with their health to a pipe every HEARTBEAT_INTERVAL seconds.
+    '''
+    def __init__(self, pid, fd, now):
+        self.pid = pid
+        self.fd = fd
+        self.started = now
+        self.last_heartbeat = now
+        self.health = {}
+        # Metric families the worker collected, see metrics.Registry.collect()
+        self.metrics = None
+        self.buffer = b''
+        # Time by which a worker that was asked to stop must have exited
+        self.deadline = None
+
+    def feed(self, data, now):
+        '''
+        Consume heartbeat data read from the pipe of the worker.
+        '''
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                self.health = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logging.warning('Invalid heartbeat from worker %d: %r' % (self.pid, line))
+                continue
+            self.metrics = self.health.pop('metrics', self.metrics)
+            self.last_heartbeat = now
+
+
+class Supervisor():
+    '''
+    Runs `count` worker processes which each have their own event loop
+    and ProxyServer, so the proxy can use more than one core.
+
+    The workers either accept connections on one listening socket created
+    by the supervisor or, with `reuse_port`, each bind their own socket
+    with SO_REUSEPORT. The supervisor downloads the lists in a short-lived
+    child process and signals the workers with SIGUSR1 to reload them from
+    the copies on disk, so each refresh is only downloaded once.
+
+    The metrics of the workers are added up and served on the admin port
+    by the supervisor.
+
+    Signals:
+    - SIGTERM, SIGINT: stop the workers gracefully and exit.
+    - SIGHUP: start new workers and stop the old ones gracefully.
+    - SIGUSR2: log the health of every worker.
+    '''
+    def __init__(self, count, reuse_port=False):
+        self.count = count
+        self.reuse_port = reuse_port
+        self.shared_lists = bool(config.list_cache_dir)
+
+        self.workers = {}
+        self.refresher = None
+        self.next_refresh = None
+        self.respawns = []
+        self.selector = selectors.DefaultSelector()
+        self.sock = None
+        self.metrics_sock = None
+
+        self.stopping = False
+        self.stop_requested = False
+        self.restart_requested = False
+        self.health_requested = False
+
+    def run(self):
+        if self.shared_lists:
+            # Make sure there are copies on disk for the workers to load.
+            prepare_lists()
+            if config.list_refresh >= 0:
+                self.next_refresh = time.monotonic() + config.list_refresh
+        else:
+            logging.warning('LIST_CACHE_DIR is not set, every worker refreshes the lists itself')
+
+        if not self.reuse_port:
+            self.sock = self.listen()
+        if config.metrics_port:
+            self.metrics_sock = self.listen_metrics()
+
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_restart)
+        signal.signal(signal.SIGUSR2, self.request_health)
+
+        for i in range(self.count):
+            self.spawn()
+
+        while self.workers or not self.stopping:
+            for key, mask in self.selector.select(timeout=1):
+                if key.fileobj is self.metrics_sock:
+                    self.serve_metrics()
+                else:
+                    self.read_heartbeat(key.data)
+            now = time.monotonic()
+            self.reap(now)
+            self.handle_requests(now)
+            self.check_workers(now)
+            if not self.stopping:
+                self.respawn(now)
+                self.maybe_refresh(now)
+
+        if self.sock is not None:
+            self.sock.close()
+        if self.metrics_sock is not None:
+            self.metrics_sock.close()
+        self.selector.close()
+        logging.info('Supervisor stopped')
+
+    @staticmethod
+    def bind(host, port):
+        '''
+        :return: a non-blocking socket listening on `host` and `port`, of
+          the address family of `host`, e.g. IPv6 for '::'.
+        '''
+        # asyncio only sets TCP_NODELAY on the accepted client connections
+        # if the protocol is given explicitly; without it a response head
+        # and body written separately wait for a delayed ACK.
+        family, type_, proto, canonname, address = socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP,
+            flags=socket.AI_PASSIVE)[0]
+        sock = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(address)
+            sock.listen(socket.SOMAXCONN)
+        except OSError:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        return sock
+
+    def listen(self):
+        return Supervisor.bind(config.listen_host, config.listen_port)
+
+    def listen_metrics(self):
+        sock = Supervisor.bind(config.metrics_host, config.metrics_port)
+        self.selector.register(sock, selectors.EVENT_READ)
+        return sock
+
+    def serve_metrics(self):
+        '''
+        Answer a request to the admin port with the metrics of all workers.
+        '''
+        try:
+            conn, address = self.metrics_sock.accept()
+        except BlockingIOError:
+            return
+        with conn:
+            conn.settimeout(1)
+            try:
+                head = b''
+                while b'\r\n\r\n' not in head:
+                    data = conn.recv(4096)
+                    if not data or len(head) > 65536:
+                        return
+                    head += data
+                conn.sendall(metrics.response(head.split(b'\r\n', 1)[0], self.collect_metrics))
+            except OSError as err:
+                logging.debug('Metrics request failed: %s' % err)
+
+    def collect_metrics(self):
+        '''
+        :return: the sum of the last metrics reported by each worker.
+        '''
+        collected = metrics.merge(worker.metrics for worker in self.workers.values()
+                                  if worker.metrics is not None)
+        collected.append(['kalamari_workers', 'gauge', 'Worker processes.',
+                          [['', [], len(self.workers)]]])
+        return collected
+
+    def request_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def request_restart(self, signum, frame):
+        self.restart_requested = True
+
+    def request_health(self, signum, frame):
+        self.health_requested = True
+
+    def handle_requests(self, now):
+        '''
+        Act on the signals received since the last iteration. The signal
+        handlers only set flags, so nothing runs in the middle of the loop.
+        '''
+        if self.stop_requested and not self.stopping:
+            logging.info('Stopping workers')
+            self.stopping = True
+            for worker in self.workers.values():
+                self.retire(worker, now)
+            if self.refresher is not None:
+                os.kill(self.refresher, signal.SIGTERM)
+
+        if self.restart_requested:
+            self.restart_requested = False
+            if not self.stopping:
+                logging.info('Restarting workers')
+                old = list(self.workers.values())
+                for i in range(self.count):
+                    self.spawn()
+                for worker in old:
+                    self.retire(worker, now)
+
+        if self.health_requested:
+            self.health_requested = False
+            logging.info('Worker health: %s' % json.dumps(self.health(now)))
+
+    def spawn(self):
+        '''
+        Fork a worker process.
+        '''
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            listeners = []
+            try:
+                os.close(rfd)
+                self.prepare_child()
+                listeners = accesslog.setup_logging(config.log_level, config.access_log)
+                worker_main(self.sock, wfd, self.shared_lists)
+                code = 0
+            except BaseException:
+                logging.exception('Worker %d failed' % os.getpid())
+            finally:
+                accesslog.stop_logging(listeners)
+                os._exit(code)
+
+        os.close(wfd)
+        os.set_blocking(rfd, False)
+        worker = Worker(pid, rfd, time.monotonic())
+        self.workers[pid] = worker
+        self.selector.register(rfd, selectors.EVENT_READ, worker)
+        logging.info('Started worker %d' % pid)
+
+    def prepare_child(self):
+        '''
+        Drop the state of the supervisor that a forked child must not use.
+        '''
+        for sig in (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR2):
+            signal.signal(sig, signal.SIG_DFL)
+        # The default action of SIGUSR1 would kill a worker that is told
+        # to reload the lists before worker_main() installed its handler.
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        # Ctrl-C reaches the whole process group; the supervisor stops the
+        # children itself.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for worker in self.workers.values():
+            os.close(worker.fd)
+        if self.metrics_sock is not None:
+            self.metrics_sock.close()
+        self.selector.close()
+
+    def retire(self, worker, now):
+        '''
+        Ask a worker to finish its requests and exit.
+        '''
+        if worker.deadline is not None:
+            return
+        worker.deadline = now + config.shutdown_grace + config.worker_timeout
+        try:
+            os.kill(worker.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def read_heartbeat(self, worker):
+        try:
+            data = os.read(worker.fd, 65536)
+        except BlockingIOError:
+            return
+        if data:
+            worker.feed(data, time.monotonic())
+        else:
+            # The worker exited or closed the pipe; it is reaped separately.
+            self.selector.unregister(worker.fd)
+
+    def reap(self, now):
+        '''
+        Collect exited children. Workers that exited unexpectedly are
+        replaced.
+        '''
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            if pid == self.refresher:
+                self.refresher = None
+                if os.WIFEXITED(status) and os.WEXITSTATUS(status) == LISTS_CHANGED:
+                    logging.info('Lists changed, reloading them in the workers')
+                    for worker in self.workers.values():
+                        os.kill(worker.pid, signal.SIGUSR1)
+                continue
+
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.fd in self.selector.get_map():
+                self.selector.unregister(worker.fd)
+            os.close(worker.fd)
+            if worker.deadline is None and not self.stopping:
+                logging.error('Worker %d exited with status %d, starting a new one' % (pid, status))
+                if now - worker.started < RESPAWN_DELAY:
+                    self.respawns.append(now + RESPAWN_DELAY)
+                else:
+                    self.respawns.append(now)
+
+    def respawn(self, now):
+        due = [when for when in self.respawns if when <= now]
+        self.respawns = [when for when in self.respawns if when > now]
+        for when in due:
+            self.spawn()
+
+    def check_workers(self, now):
+        '''
+        Kill workers that stopped sending heartbeats, e.g. because their
+        event loop is blocked, and workers that did not exit in time.
+        '''
+        for worker in self.workers.values():
+            if worker.deadline is not None:
+                if now > worker.deadline:
+                    logging.error('Worker %d did not stop in time, killing it' % worker.pid)
+                    self.kill(worker)
+            elif now - worker.last_heartbeat > config.worker_timeout:
+                logging.error('Worker %d stopped sending heartbeats, killing it' % worker.pid)
+                self.kill(worker)
+
+    def kill(self, worker):
+        try:
+            os.kill(worker.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def maybe_refresh(self, now):
+        '''
+        Start the refresher process when the lists are due for a refresh.
+        '''
+        if self.next_refresh is None or now < self.next_refresh or self.refresher is not None:
+            return
+        self.next_refresh = now + config.list_refresh
+
+        logging.debug('Refreshing lists')
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.prepare_child()
+                if self.sock is not None:
+                    self.sock.close()
+                if refresh_lists():
+                    code = LISTS_CHANGED
+                else:
+                    code = 0
+            except BaseException:
+                logging.exception('Refreshing the lists failed')
+            finally:
+                os._exit(code)
+        self.refresher = pid
+
+    def health(self, now):
+        '''
+        :return: a dict of the last reported health of each worker by pid.
+        '''
+        return {
+            worker.pid: dict(worker.health,
+                             uptime=round(now - worker.started),
+                             heartbeat_age=round(now - worker.last_heartbeat, 1),
+                             stopping=worker.deadline is not None)
+            for worker in self.workers.values()
+        }
+
+
+async def write_all(loop, fd, data):
+    '''
+    Write all of `data` to a non-blocking pipe. Heartbeats with metrics
+    can be larger than the pipe buffer.
+    '''
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except BlockingIOError:
+            waiter = loop.create_future()
+            loop.add_writer(fd, waiter.set_result, None)
+            try:
+                await waiter
+            finally:
+                loop.remove_writer(fd)
+
+
+async def send_heartbeats(server, fd, stopping):
+    '''
+    Report the health of a worker to the supervisor until the pipe is
+    closed.
+    '''
+    while True:
+        health = {
+            'pid': os.getpid(),
+            'connections': server.connections,
+            'pool': server.pool.stats(),
+            'verdicts': server.verdicts.stats(),
+            'resolver': server.resolver.stats(),
+            'admission': server.admission.stats(),
+            'connects': server.connects.stats(),
+        }
+        if server.http_cache is not None:
+            health['http_cache'] = server.http_cache.stats()
+        if server.files is not None:
+            health['files'] = server.files.stats()
+        if server.flights is not None:
+            health['flights'] = server.flights.stats()
+        if config.metrics_port:
+            health['metrics'] = server.registry.collect()
+        try:
+            await write_all(server.loop, fd, json.dumps(health).encode('utf-8') + b'\n')
+        except BrokenPipeError:
+            logging.error('Supervisor is gone, stopping')
+            if not stopping.done():
+                stopping.set_result(None)
+            return
+        await asyncio.sleep(config.heartbeat_interval)
+
+
+def worker_main(sock, heartbeat_fd, shared_lists):
+    '''
+    Serve proxy requests in a worker process until SIGTERM.
+
+    :param sock: the listening socket to accept on, or None to bind a new
+      one with SO_REUSEPORT.
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    os.set_blocking(heartbeat_fd, False)
+
+    server = proxy.ProxyServer(loop, shared_lists)
+    if sock is None:
+        coro = asyncio.start_server(server.handler, config.listen_host,
+                                    config.listen_port, reuse_port=True)
+    else:
+        coro = asyncio.start_server(server.handler, sock=sock)
+    listener = loop.run_until_complete(coro)
+
+    stopping = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM,
+                            lambda: stopping.done() or stopping.set_result(None))
+    if shared_lists:
+        loop.add_signal_handler(signal.SIGUSR1,
+                                lambda: asyncio.ensure_future(server.reload_lists(fetch=False)))
+    heartbeat = asyncio.ensure_future(send_heartbeats(server, heartbeat_fd, stopping))
+
+    loop.run_until_complete(stopping)
+    logging.info('Worker %d stopping' % os.getpid())
+    listener.close()
+    loop.run_until_complete(server.shutdown(config.shutdown_grace))
+    heartbeat.cancel()
+    loop.run_until_complete(asyncio.wait([heartbeat]))
+    loop.close()
@@ -0,0 +1,148 @@
+import os
+import socket
+import asyncio
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Linux fcntl() command to resize a pipe, fcntl.F_SETPIPE_SZ on Python 3.10+
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+def splice_supported():
+    '''
+    Indicate whether os.splice() (Linux, Python 3.10+) can move tunnel
+    data between sockets without copying it to user space.
+    '''
+    return hasattr(os, 'splice') and hasattr(os, 'pipe2')
+
+
+def client_socket(writer):
+    '''
+    :return: a non-blocking duplicate of the socket of a client
+      connection, or None if the transport has no socket.
+    '''
+    sock = writer.get_extra_info('socket')
+    if sock is None:
+        return None
+    dup = socket.socket(sock.family, sock.type, sock.proto, fileno=os.dup(sock.fileno()))
+    dup.setblocking(False)
+    return dup
+
+
+async def wait_readable(loop, fd):
+    waiter = loop.create_future()
+    loop.add_reader(fd, waiter.set_result, None)
+    try:
+        await waiter
+    finally:
+        loop.remove_reader(fd)
+
+
+async def wait_writable(loop, fd):
+    waiter = loop.create_future()
+    loop.add_writer(fd, waiter.set_result, None)
+    try:
+        await waiter
+    finally:
+        loop.remove_writer(fd)
+
+
+def shutdown(sock):
+    '''
+    Pass on the end of the stream from the other side of the tunnel.
+    '''
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+async def copy(loop, source, destination, buffer_size):
+    '''
+    Relay data from one socket to another through a reusable buffer.
+
+    :return: the number of bytes relayed.
+    '''
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    total = 0
+    while True:
+        size = await loop.sock_recv_into(source, buffer)
+        if not size:
+            shutdown(destination)
+            return total
+        await loop.sock_sendall(destination, view[:size])
+        total += size
+
+
+async def splice(loop, source, destination, buffer_size):
+    '''
+    Relay data from one socket to another through a pipe with splice(),
+    so it never leaves the kernel.
+
+    :return: the number of bytes relayed.
+    '''
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    read_end, write_end = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        try:
+            fcntl.fcntl(write_end, F_SETPIPE_SZ, buffer_size)
+        except (OSError, AttributeError):
+            pass  # the default pipe size is used
+
+        total = 0
+        while True:
+            try:
+                size = os.splice(source.fileno(), write_end, buffer_size, flags=flags)
+            except BlockingIOError:
+                await wait_readable(loop, source.fileno())
+                continue
+            if not size:
+                shutdown(destination)
+                return total
+
+            pending = size
+            while pending:
+                try:
+                    pending -= os.splice(read_end, destination.fileno(), pending, flags=flags)
+                except BlockingIOError:
+                    await wait_writable(loop, destination.fileno())
+            total += size
+    finally:
+        os.close(read_end)
+        os.close(write_end)
+
+
+def relayed(task):
+    '''
+    :return: the number of bytes a finished pump relayed, or 0 if it failed.
+    '''
+    if not task.done() or task.cancelled():
+        return 0
+    if task.exception() is not None:
+        logging.debug('Tunnel closed: %s' % task.exception())
+        return 0
+    return task.result()
+
+
+async def relay(loop, client, remote, buffer_size, use_splice):
+    '''
+    Relay data in both directions until both sides finished sending.
+    An error on either side ends the tunnel.
+
+    :return: a tuple of the bytes sent by the client and by the remote.
+    '''
+    pump = splice if use_splice and splice_supported() else copy
+    upstream = asyncio.ensure_future(pump(loop, client, remote, buffer_size), loop=loop)
+    downstream = asyncio.ensure_future(pump(loop, remote, client, buffer_size), loop=loop)
+    try:
+        await asyncio.wait([upstream, downstream], return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        upstream.cancel()
+        downstream.cancel()
+    return relayed(upstream), relayed(downstream)
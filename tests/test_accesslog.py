@@ -0,0 +1,107 @@
+import json
+import queue
+import asyncio
+import logging
+import tempfile
+import unittest
+import unittest.mock
+
+import accesslog
+import proxy
+
+
+class TestAccessLog(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.access_log = accesslog.AccessLog(self.loop, batch_size=2, interval=0.01)
+        self.access_log.logger = unittest.mock.Mock()
+
+    def request(self, session_id):
+        request = proxy.HTTPRequest('GET', 'example.com', 80, '/', {}, session_id)
+        request.verdict = 'forwarded'
+        request.status = 200
+        request.bytes_sent = 100
+        request.timings['ttfb'] = 0.002
+        return request
+
+    def lines(self):
+        return [json.loads(line)
+                for call in self.access_log.logger.info.call_args_list
+                for line in call[0][0].split('\n')]
+
+    def test_record_fields(self):
+        self.access_log.log(self.request(7), '127.0.0.1', ('example.com', 80, '/a'), 0.5)
+        self.access_log.flush()
+
+        record, = self.lines()
+        self.assertEqual(record['session'], 7)
+        self.assertEqual(record['client'], '127.0.0.1')
+        self.assertEqual(record['method'], 'GET')
+        self.assertEqual(record['path'], '/a')
+        self.assertEqual(record['verdict'], 'forwarded')
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['bytes_sent'], 100)
+        self.assertEqual(record['bytes_received'], 0)
+        self.assertEqual(record['duration_ms'], 500)
+        self.assertEqual(record['ttfb_ms'], 2)
+
+    def test_full_batch_is_written_at_once(self):
+        target = ('example.com', 80, '/')
+        self.access_log.log(self.request(1), None, target, 0)
+        self.assertFalse(self.access_log.logger.info.called)
+        self.access_log.log(self.request(2), None, target, 0)
+        self.assertEqual(self.access_log.logger.info.call_count, 1)
+        self.assertEqual([record['session'] for record in self.lines()], [1, 2])
+        self.assertIsNone(self.access_log.timer)
+
+    def test_partial_batch_is_written_after_interval(self):
+        self.access_log.log(self.request(1), None, ('example.com', 80, '/'), 0)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual([record['session'] for record in self.lines()], [1])
+
+    def test_flush_without_records(self):
+        self.access_log.flush()
+        self.assertFalse(self.access_log.logger.info.called)
+
+
+class TestSetupLogging(unittest.TestCase):
+    def setUp(self):
+        root = logging.getLogger()
+        access = logging.getLogger(accesslog.ACCESS_LOGGER)
+        saved = (root.level, root.handlers[:], access.level, access.handlers[:],
+                 access.propagate)
+
+        def restore():
+            root.setLevel(saved[0])
+            root.handlers[:] = saved[1]
+            access.setLevel(saved[2])
+            access.handlers[:] = saved[3]
+            access.propagate = saved[4]
+        self.addCleanup(restore)
+
+    def test_handlers_are_moved_behind_a_queue(self):
+        records = queue.Queue()
+        handler = logging.handlers.QueueHandler(records)
+        logging.getLogger().handlers[:] = [handler]
+
+        listeners = accesslog.setup_logging('WARNING', '')
+        logging.warning('hello')
+        accesslog.stop_logging(listeners)
+
+        self.assertEqual(len(listeners), 1)
+        self.assertIsInstance(logging.getLogger().handlers[0], logging.handlers.QueueHandler)
+        self.assertEqual(records.get_nowait().getMessage(), 'hello')
+        self.assertEqual(logging.getLogger().level, logging.WARNING)
+
+    def test_access_log_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + '/access.log'
+            listeners = accesslog.setup_logging('WARNING', path)
+            logging.getLogger(accesslog.ACCESS_LOGGER).info('{"session":1}')
+            accesslog.stop_logging(listeners)
+            for handler in listeners[1].handlers:
+                handler.close()
+
+            with open(path) as log:
+                self.assertEqual(log.read(), '{"session":1}\n')
@@ -20,3 +20,37 @@ class TestProxyServer(unittest.TestCase):
     def test_invalid_ip_format(self):
         with self.assertRaises(ValueError):
             self.acl.ip_allowed('400.0.0.1')
+
+    def test_ipv6(self):
+        ipv6 = acl.ACL('127.0.0.0/8,2001:db8::/32,::1/128')
+        self.assertTrue(ipv6.ip_allowed('2001:db8::1'))
+        self.assertTrue(ipv6.ip_allowed('::1'))
+        self.assertFalse(ipv6.ip_allowed('fe80::1%eth0'))
+        self.assertFalse(ipv6.ip_allowed('2001:db9::1'))
+
+    def test_ipv4_mapped_ipv6_peer(self):
+        self.assertTrue(self.acl.ip_allowed('::ffff:127.0.0.1'))
+        self.assertFalse(self.acl.ip_allowed('::ffff:10.0.0.1'))
+
+    def test_adjacent_and_overlapping_networks_are_merged(self):
+        merged = acl.ACL('10.0.0.0/25,10.0.0.128/25,10.0.0.0/8,11.0.0.0/8')
+        self.assertEqual(merged.ranges[4], ([0x0a000000], [0x0bffffff]))
+        self.assertTrue(merged.ip_allowed('11.255.255.255'))
+        self.assertFalse(merged.ip_allowed('12.0.0.0'))
+        self.assertFalse(merged.ip_allowed('9.255.255.255'))
+
+    def test_many_networks(self):
+        many = acl.ACL(','.join('10.{0}.{1}.0/24'.format(i // 256, i % 256)
+                                for i in range(0, 20000, 2)))
+        self.assertTrue(many.ip_allowed('10.0.2.7'))
+        self.assertFalse(many.ip_allowed('10.0.3.7'))
+        self.assertTrue(many.ip_allowed('10.78.30.255'))
+
+    def test_verdicts_are_cached(self):
+        small = acl.ACL('127.0.0.0/8', cache_size=2)
+        small.ip_allowed('127.0.0.1')
+        small.ranges[4] = ([], [])
+        self.assertTrue(small.ip_allowed('127.0.0.1'))
+        small.ip_allowed('127.0.0.2')
+        small.ip_allowed('127.0.0.3')
+        self.assertFalse(small.ip_allowed('127.0.0.1'))
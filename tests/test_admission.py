@@ -0,0 +1,129 @@
+import asyncio
+import unittest
+
+import acl
+import admission
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.admission = admission.Admission(acl.ACL('127.0.0.0/8,::1/128'), max_per_ip=2)
+
+    def test_peers_outside_the_acl_are_denied(self):
+        self.assertEqual(self.admission.admit('10.0.0.1'), admission.Admission.DENIED)
+        self.assertEqual(self.admission.admit('::2'), admission.Admission.DENIED)
+        self.assertEqual(self.admission.admit('garbage'), admission.Admission.DENIED)
+        self.assertEqual(self.admission.admit(None), admission.Admission.DENIED)
+        self.assertEqual(self.admission.stats()['denied'], 4)
+
+    def test_connections_per_peer_are_limited(self):
+        for i in range(2):
+            self.assertEqual(self.admission.admit('127.0.0.1'), admission.Admission.ADMITTED)
+        self.assertEqual(self.admission.admit('127.0.0.1'), admission.Admission.LIMITED)
+        self.assertEqual(self.admission.admit('::1'), admission.Admission.ADMITTED)
+
+        self.admission.release('127.0.0.1')
+        self.assertEqual(self.admission.admit('127.0.0.1'), admission.Admission.ADMITTED)
+        self.assertEqual(self.admission.stats(),
+                         {'admitted': 4, 'denied': 0, 'limited': 1, 'saturated': 0,
+                          'peers': 2})
+
+    def test_released_peers_are_forgotten(self):
+        self.admission.admit('127.0.0.1')
+        self.admission.release('127.0.0.1')
+        self.assertEqual(self.admission.active, {})
+
+    def test_no_limit(self):
+        self.admission.max_per_ip = 0
+        for i in range(10):
+            self.assertEqual(self.admission.admit('127.0.0.1'), admission.Admission.ADMITTED)
+
+    def test_total_connections_are_limited(self):
+        self.admission.max_total = 2
+        self.assertEqual(self.admission.admit('127.0.0.1'), admission.Admission.ADMITTED)
+        self.assertEqual(self.admission.admit('::1'), admission.Admission.ADMITTED)
+        self.assertEqual(self.admission.admit('127.0.0.2'), admission.Admission.SATURATED)
+        # Peers outside the ACL are still told they are denied
+        self.assertEqual(self.admission.admit('10.0.0.1'), admission.Admission.DENIED)
+
+        self.admission.release('::1')
+        self.assertEqual(self.admission.admit('127.0.0.2'), admission.Admission.ADMITTED)
+        self.assertEqual(self.admission.stats()['saturated'], 1)
+
+
+class TestConnectLimiter(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.limiter = admission.ConnectLimiter(self.loop, max_total=2, max_per_host=1,
+                                                queue_size=2, timeout=0.05)
+        self.tasks = []
+        self.addCleanup(self.cancel_tasks)
+
+    def cancel_tasks(self):
+        for task in self.tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+
+    def acquire(self, host):
+        task = self.loop.create_task(self.limiter.acquire(host))
+        self.tasks.append(task)
+        return task
+
+    def step(self, *tasks):
+        self.loop.run_until_complete(asyncio.sleep(0))
+        return tasks
+
+    def test_connects_within_limits_start_at_once(self):
+        a, b = self.step(self.acquire('a.com'), self.acquire('b.com'))
+        self.assertTrue(a.done() and b.done())
+        self.assertEqual(self.limiter.stats()['connecting'], 2)
+
+    def test_busy_host_does_not_hold_up_other_hosts(self):
+        self.limiter.max_total = 0
+        first, second, other = self.step(self.acquire('a.com'), self.acquire('a.com'),
+                                        self.acquire('b.com'))
+        self.assertTrue(first.done())
+        self.assertFalse(second.done())
+        self.assertTrue(other.done())
+
+        self.limiter.release('a.com')
+        self.step()
+        self.assertTrue(second.done())
+        self.assertEqual(self.limiter.active, {'a.com': 1, 'b.com': 1})
+
+    def test_waiting_connects_are_granted_in_order(self):
+        self.limiter.max_per_host = 0
+        tasks = self.step(*[self.acquire('a.com') for i in range(4)])
+        self.assertEqual([task.done() for task in tasks], [True, True, False, False])
+        self.limiter.release('a.com')
+        self.step()
+        self.assertEqual([task.done() for task in tasks], [True, True, True, False])
+
+    def test_full_queue_is_shed(self):
+        self.step(*[self.acquire('a.com') for i in range(3)])
+        with self.assertRaises(admission.Saturated):
+            self.loop.run_until_complete(self.limiter.acquire('a.com'))
+        self.assertEqual(self.limiter.stats()['shed'], 1)
+
+    def test_connect_that_waits_too_long_is_shed(self):
+        self.step(self.acquire('a.com'))
+        with self.assertRaises(admission.Saturated):
+            self.loop.run_until_complete(self.limiter.acquire('a.com'))
+        self.assertEqual(self.limiter.stats()['expired'], 1)
+        self.assertEqual(len(self.limiter.waiters), 0)
+
+    def test_cancelled_connect_leaves_the_queue(self):
+        first, second = self.step(self.acquire('a.com'), self.acquire('a.com'))
+        second.cancel()
+        self.step()
+        self.assertEqual(len(self.limiter.waiters), 0)
+
+        # Granted, but cancelled before it could start
+        third = self.acquire('a.com')
+        self.step()
+        self.limiter.release('a.com')
+        third.cancel()
+        self.step()
+        self.assertEqual(self.limiter.connecting, 0)
+        self.assertEqual(self.limiter.active, {})
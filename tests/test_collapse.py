@@ -0,0 +1,125 @@
+import unittest
+import unittest.mock
+
+import asyncio
+import collapse
+import message
+
+
+class Request():
+    def __init__(self, path='/a', method='GET', headers=()):
+        self.method = method
+        self.host = 'Example.com'
+        self.port = 80
+        self.path = path
+        self.version = 'HTTP/1.1'
+        self.headers = message.Headers(headers)
+
+
+class Writer():
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+class TestFlights(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.flights = collapse.Flights(self.loop, retain=10, low_water=0)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_key_includes_accept_encoding(self):
+        gzip = collapse.Flights.key(Request(headers=[('Accept-Encoding', 'gzip')]))
+        self.assertNotEqual(gzip, collapse.Flights.key(Request()))
+        self.assertEqual(gzip, collapse.Flights.key(Request(headers=[('Accept-Encoding', 'gzip')])))
+
+    def test_private_requests_are_not_collapsed(self):
+        for request in (Request(method='POST'), Request(headers=[('Cookie', 'a=b')]),
+                        Request(headers=[('Authorization', 'Basic eA==')]),
+                        Request(headers=[('Content-Length', '3')]),
+                        Request(headers=[('Cache-Control', 'no-cache')])):
+            self.assertIsNone(collapse.Flights.key(request))
+
+    def respond(self, flight, *chunks):
+        response = message.ResponseParser('GET')
+        for chunk in chunks:
+            response.feed(chunk)
+            flight.feed(chunk, response)
+        return response
+
+    def test_followers_receive_the_response(self):
+        key = collapse.Flights.key(Request())
+        flight = self.flights.start(key)
+        writers = [Writer(), Writer()]
+
+        async def run():
+            followers = [self.loop.create_task(self.flights.join(key).follow(writer, True))
+                         for writer in writers]
+            await asyncio.sleep(0)
+            response = self.respond(flight, b'HTTP/1.1 200 OK\r\nContent-', b'Length: 5\r\n\r\n')
+            await asyncio.sleep(0)
+            self.respond(flight, b'hello')
+            response.feed(b'hello')
+            self.flights.land(flight, response)
+            return await asyncio.gather(*followers)
+
+        self.assertEqual(self.loop.run_until_complete(run()), [True, True])
+        for writer in writers:
+            self.assertEqual(writer.data, b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+        self.assertIsNone(self.flights.join(key))
+        self.assertEqual(self.flights.stats()['followers'], 2)
+
+    def test_private_response_is_not_shared(self):
+        key = collapse.Flights.key(Request())
+        flight = self.flights.start(key)
+        writer = Writer()
+
+        async def run():
+            follower = self.loop.create_task(self.flights.join(key).follow(writer, True))
+            await asyncio.sleep(0)
+            self.respond(flight, b'HTTP/1.1 200 OK\r\nSet-Cookie: a=b\r\n'
+                                 b'Content-Length: 0\r\n\r\n')
+            return await follower
+
+        self.assertIsNone(self.loop.run_until_complete(run()))
+        self.assertEqual(writer.data, b'')
+
+    def test_failed_leader_releases_followers(self):
+        key = collapse.Flights.key(Request())
+        flight = self.flights.start(key)
+
+        async def run():
+            follower = self.loop.create_task(self.flights.join(key).follow(Writer(), True))
+            await asyncio.sleep(0)
+            self.flights.land(flight, None)
+            return await follower
+
+        self.assertIsNone(self.loop.run_until_complete(run()))
+
+    def test_late_followers_cannot_join_after_data_was_dropped(self):
+        key = collapse.Flights.key(Request())
+        flight = self.flights.start(key)
+        self.respond(flight, b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n')
+        self.assertIsNone(self.flights.join(key))
+
+    def test_slow_follower_holds_back_the_leader(self):
+        key = collapse.Flights.key(Request())
+        flight = self.flights.start(key)
+        flight.followers[0] = 0
+        self.respond(flight, b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n')
+        self.assertEqual(flight.backlog(), 38)
+
+        drained = self.loop.create_task(flight.drain())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(drained.done())
+        flight.followers[0] = 38
+        flight.trim()
+        self.loop.run_until_complete(drained)
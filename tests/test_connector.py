@@ -0,0 +1,102 @@
+import unittest
+import unittest.mock
+
+import asyncio
+import socket
+import connector
+
+
+def address(family, host):
+    return (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', (host, 80))
+
+
+V4_A = address(socket.AF_INET, '192.0.2.1')
+V4_B = address(socket.AF_INET, '192.0.2.2')
+V6_A = address(socket.AF_INET6, '2001:db8::1')
+V6_B = address(socket.AF_INET6, '2001:db8::2')
+
+
+class TestInterleave(unittest.TestCase):
+    def test_families_alternate(self):
+        self.assertEqual(connector.interleave([V6_A, V6_B, V4_A, V4_B]),
+                         [V6_A, V4_A, V6_B, V4_B])
+        self.assertEqual(connector.interleave([V4_A, V4_B, V6_A]),
+                         [V4_A, V6_A, V4_B])
+
+
+class TestOpenSocket(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.attempts = []
+        self.cancelled = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def open_socket(self, addresses, behaviour, delay=0.01):
+        '''
+        Run open_socket with connection attempts that hang, fail, or
+        succeed according to `behaviour` by address.
+        '''
+        async def connect_socket(loop, address):
+            self.attempts.append(address)
+            action = behaviour[address]
+            try:
+                if action == 'hang':
+                    await asyncio.sleep(10)
+                elif action == 'fail':
+                    raise ConnectionRefusedError(address[4][0])
+            except asyncio.CancelledError:
+                self.cancelled.append(address)
+                raise
+            return unittest.mock.MagicMock(address=address)
+
+        with unittest.mock.patch('connector.connect_socket', connect_socket):
+            return self.loop.run_until_complete(
+                connector.open_socket(self.loop, addresses, delay))
+
+    def test_first_address_wins(self):
+        sock = self.open_socket([V4_A, V4_B], {V4_A: 'ok', V4_B: 'ok'})
+        self.assertEqual(sock.address, V4_A)
+        self.assertEqual(self.attempts, [V4_A])
+
+    def test_hanging_address_is_raced(self):
+        sock = self.open_socket([V6_A, V4_A], {V6_A: 'hang', V4_A: 'ok'})
+        self.assertEqual(sock.address, V4_A)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.cancelled, [V6_A])
+
+    def test_failure_starts_next_attempt_immediately(self):
+        sock = self.open_socket([V4_A, V4_B], {V4_A: 'fail', V4_B: 'ok'}, delay=10)
+        self.assertEqual(sock.address, V4_B)
+
+    def test_all_fail(self):
+        with self.assertRaises(ConnectionRefusedError):
+            self.open_socket([V4_A], {V4_A: 'fail'})
+        with self.assertRaises(OSError):
+            self.open_socket([V4_A, V4_B], {V4_A: 'fail', V4_B: 'fail'})
+
+    def test_connection_made_while_cancelled_is_closed(self):
+        sock = unittest.mock.MagicMock()
+        async def connect_socket(loop, address):
+            # Cancel the race in the same iteration the attempt succeeds.
+            race.cancel()
+            return sock
+
+        with unittest.mock.patch('connector.connect_socket', connect_socket):
+            race = self.loop.create_task(connector.open_socket(self.loop, [V4_A], 10))
+            with self.assertRaises(asyncio.CancelledError):
+                self.loop.run_until_complete(race)
+        self.assertTrue(sock.close.called)
+
+    def test_connects_to_listening_socket(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        addresses = socket.getaddrinfo('127.0.0.1', server.getsockname()[1],
+                                       0, socket.SOCK_STREAM)
+        sock = self.loop.run_until_complete(connector.open_socket(self.loop, addresses, 0.25))
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getpeername(), server.getsockname())
@@ -0,0 +1,68 @@
+import unittest
+
+import os
+import tempfile
+import filecache
+
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.cache = filecache.FileCache(self.root, max_bytes=10, max_file_size=6)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_small_files_are_kept_in_memory(self):
+        self.write('a.css', b'abc')
+        cached = self.cache.lookup('/a.css?v=1')
+        self.assertEqual(cached.data, b'abc')
+        self.assertEqual(cached.content_type, 'text/css')
+        self.assertIs(self.cache.lookup('/a.css'), cached)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_large_files_are_sent_from_disk(self):
+        self.write('big.jpg', b'x' * 7)
+        cached = self.cache.lookup('/big.jpg')
+        self.assertIsNone(cached.data)
+        self.assertEqual(cached.size, 7)
+        self.assertEqual(cached.content_type, 'image/jpeg')
+        self.assertEqual(self.cache.stats()['files'], 0)
+
+    def test_changed_file_is_reloaded(self):
+        path = self.write('a.txt', b'old')
+        self.cache.lookup('/a.txt')
+        self.write('a.txt', b'newer')
+        os.utime(path, ns=(0, 10 ** 9))
+        self.assertEqual(self.cache.lookup('/a.txt').data, b'newer')
+
+        os.unlink(path)
+        self.assertIsNone(self.cache.lookup('/a.txt'))
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+
+    def test_lru_eviction(self):
+        for name in ('a', 'b', 'c'):
+            self.write(name, b'1234')
+        self.cache.lookup('/a')
+        self.cache.lookup('/b')
+        self.cache.lookup('/a')
+        self.cache.lookup('/c')
+        self.assertEqual([os.path.basename(path) for path in self.cache.memory], ['a', 'c'])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_paths_outside_root(self):
+        self.assertIsNone(self.cache.lookup('/../etc/passwd'))
+        self.assertIsNone(self.cache.lookup('/%2e%2e/etc/passwd'))
+        self.assertIsNone(self.cache.lookup('/missing'))
+
+    def test_directory_index(self):
+        self.write('dir/index.html', b'<p>')
+        self.assertEqual(self.cache.lookup('/dir/').content_type, 'text/html')
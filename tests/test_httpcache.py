@@ -0,0 +1,180 @@
+import unittest
+
+import email.utils
+import httpcache
+import message
+
+
+def make_response(head, body=b'', method='GET'):
+    raw = head.encode('iso-8859-1') + b'\r\n\r\n' + body
+    response = message.ResponseParser(method)
+    response.feed(raw)
+    return response, raw
+
+
+class Request():
+    def __init__(self, path='/a', method='GET', headers=(), version='HTTP/1.1'):
+        self.method = method
+        self.version = version
+        self.host = 'Example.com'
+        self.port = 80
+        self.path = path
+        self.headers = message.Headers(headers)
+
+
+class TestCacheEntry(unittest.TestCase):
+    def entry(self, *headers, request_time=1000, response_time=1000):
+        return httpcache.CacheEntry('HTTP/1.1 200 OK', 200, message.Headers(headers), b'',
+                                    request_time, response_time)
+
+    def test_s_maxage_takes_precedence(self):
+        entry = self.entry(('Cache-Control', 'max-age=10, s-maxage=20'))
+        self.assertEqual(entry.lifetime, 20)
+
+    def test_expires_is_relative_to_date(self):
+        entry = self.entry(('Date', email.utils.formatdate(0, usegmt=True)),
+                           ('Expires', email.utils.formatdate(60, usegmt=True)))
+        self.assertEqual(entry.lifetime, 60)
+
+    def test_invalid_expires_is_stale(self):
+        self.assertEqual(self.entry(('Expires', '0')).lifetime, 0)
+
+    def test_heuristic_lifetime_from_last_modified(self):
+        entry = self.entry(('Date', email.utils.formatdate(1000, usegmt=True)),
+                           ('Last-Modified', email.utils.formatdate(0, usegmt=True)))
+        self.assertEqual(entry.lifetime, 100)
+
+    def test_age_includes_age_header_and_resident_time(self):
+        entry = self.entry(('Cache-Control', 'max-age=60'), ('Age', '10'),
+                           request_time=998, response_time=1000)
+        self.assertEqual(entry.age(1005), 17)
+        self.assertTrue(entry.fresh(1040, {}))
+        self.assertFalse(entry.fresh(1050, {}))
+
+    def test_request_directives_limit_freshness(self):
+        entry = self.entry(('Cache-Control', 'max-age=60'))
+        self.assertFalse(entry.fresh(1010, {'max-age': '5'}))
+        self.assertFalse(entry.fresh(1010, {'min-fresh': '55'}))
+        self.assertTrue(entry.fresh(1010, {'max-age': '20'}))
+
+    def test_no_cache_response_is_never_fresh(self):
+        self.assertFalse(self.entry(('Cache-Control', 'no-cache, max-age=60')).fresh(1000, {}))
+
+    def test_head_drops_hop_by_hop_headers(self):
+        entry = self.entry(('Content-Length', '0'), ('Connection', 'keep-alive, X-Hop'),
+                           ('X-Hop', '1'), ('Age', '3'), ('ETag', '"a"'))
+        head = entry.head(1002, close=True)
+        self.assertEqual(head, b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\nETag: "a"\r\n'
+                               b'Age: 5\r\nConnection: close\r\n\r\n')
+
+
+class TestHTTPCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = httpcache.HTTPCache(max_bytes=1000, max_object_size=200)
+
+    def store(self, head, body=b'hello', request=None, now=1000):
+        response, raw = make_response(head, body)
+        return self.cache.store(request or Request(), response, raw, now, now)
+
+    def test_fresh_response_is_a_hit(self):
+        self.assertTrue(self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n'
+                                   'Content-Length: 5'))
+        entry, fresh = self.cache.lookup(Request(), now=1030)
+        self.assertTrue(fresh)
+        self.assertEqual(entry.body, b'hello')
+        self.assertEqual(self.cache.stats()['bytes_saved'], 5)
+        self.assertEqual(self.cache.stats()['hit_ratio'], 1.0)
+
+    def test_chunked_body_is_kept_framed(self):
+        self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n'
+                   'Transfer-Encoding: chunked', b'5\r\nhello\r\n0\r\n\r\n')
+        entry, fresh = self.cache.lookup(Request(), now=1000)
+        self.assertEqual(entry.body, b'5\r\nhello\r\n0\r\n\r\n')
+
+    def test_responses_are_kept_per_http_version(self):
+        self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n'
+                   'Transfer-Encoding: chunked', b'5\r\nhello\r\n0\r\n\r\n')
+        self.assertIsNone(self.cache.lookup(Request(version='HTTP/1.0'), now=1000))
+        self.assertTrue(self.store('HTTP/1.0 200 OK\r\nCache-Control: max-age=60\r\n'
+                                   'Content-Length: 5', request=Request(version='HTTP/1.0')))
+        entry, fresh = self.cache.lookup(Request(version='HTTP/1.0'), now=1000)
+        self.assertEqual(entry.body, b'hello')
+        self.assertIsNone(self.cache.lookup(Request(method='POST')))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_stale_response_with_validator_is_revalidated(self):
+        self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=10\r\nETag: "v1"\r\n'
+                   'Content-Length: 5')
+        entry, fresh = self.cache.lookup(Request(), now=1020)
+        self.assertFalse(fresh)
+        self.assertEqual(entry.validators(), [('If-None-Match', '"v1"')])
+
+        not_modified = message.Headers([('Cache-Control', 'max-age=100'),
+                                        ('Content-Length', '0')])
+        self.cache.revalidated(Request(), entry, not_modified, 1020, 1020)
+        self.assertEqual(entry.headers.get('content-length'), '5')
+        entry, fresh = self.cache.lookup(Request(), now=1100)
+        self.assertTrue(fresh)
+        self.assertEqual(self.cache.stats()['revalidations'], 1)
+
+    def test_stale_response_without_validator_is_a_miss(self):
+        self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=10\r\nContent-Length: 5')
+        self.assertIsNone(self.cache.lookup(Request(), now=1020))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_uncacheable_responses_are_not_stored(self):
+        for head in ('HTTP/1.1 200 OK\r\nCache-Control: no-store, max-age=60',
+                     'HTTP/1.1 200 OK\r\nCache-Control: private, max-age=60',
+                     'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nSet-Cookie: a=b',
+                     'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nVary: *',
+                     'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Range: bytes 0-4/9'
+                     .replace('200 OK', '206 Partial Content'),
+                     'HTTP/1.1 200 OK'):
+            self.assertFalse(self.store(head + '\r\nContent-Length: 5'), head)
+        # Cut off before the end of the body
+        self.assertFalse(self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n'
+                                    'Content-Length: 100', b'x' * 10))
+        self.assertFalse(self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n'
+                                    'Transfer-Encoding: chunked', b'5\r\nhello\r\n'))
+        # Delimited by the connection closing, so it may be truncated
+        self.assertFalse(self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60'))
+        self.assertFalse(self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n'
+                                    'Content-Length: 300', b'x' * 300))
+
+    def test_responses_vary_on_request_headers(self):
+        gzip = Request(headers=[('Accept-Encoding', 'gzip')])
+        plain = Request()
+        self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nVary: Accept-Encoding\r\n'
+                   'Content-Length: 5', request=gzip)
+        self.assertIsNotNone(self.cache.lookup(gzip, now=1000))
+        self.assertIsNone(self.cache.lookup(plain, now=1000))
+
+    def test_requests_that_bypass_the_cache(self):
+        self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 5')
+        for headers in ([('Cache-Control', 'no-cache')], [('Pragma', 'no-cache')],
+                        [('Authorization', 'Basic eA==')], [('Range', 'bytes=0-1')],
+                        [('If-None-Match', '"v1"')], [('Cache-Control', 'no-store')]):
+            self.assertIsNone(self.cache.lookup(Request(headers=headers), now=1000), headers)
+        self.assertTrue(self.cache.storable_request(Request(headers=[('Pragma', 'no-cache')])))
+        self.assertFalse(self.cache.storable_request(Request(headers=[('Range', 'bytes=0-1')])))
+        self.assertFalse(self.cache.storable_request(Request(method='HEAD')))
+
+    def test_unsafe_methods_invalidate(self):
+        self.store('HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 5')
+        self.assertIsNone(self.cache.lookup(Request(method='POST')))
+        self.assertIsNone(self.cache.lookup(Request(), now=1000))
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+
+    def test_least_recently_used_responses_are_evicted(self):
+        self.cache.max_bytes = 500
+        head = 'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 100'
+        for path in ('/a', '/b', '/c', '/d', '/e', '/f'):
+            self.store(head, b'x' * 100, request=Request(path))
+            self.cache.lookup(Request('/a'), now=1000)
+        stats = self.cache.stats()
+        self.assertLessEqual(stats['bytes'], 500)
+        self.assertGreater(stats['evictions'], 0)
+        self.assertIsNotNone(self.cache.lookup(Request('/a'), now=1000))
+        self.assertIsNone(self.cache.lookup(Request('/b'), now=1000))
+        self.assertEqual(sum(len(keys) for keys in self.cache.keys.values()), stats['entries'])
+        self.assertEqual(set(self.cache.keys), set(self.cache.vary))
@@ -0,0 +1,116 @@
+import unittest
+
+import message
+
+
+class TestHeaders(unittest.TestCase):
+    def test_case_insensitive_lookup(self):
+        headers = message.Headers([('Content-Type', 'text/html')])
+        self.assertEqual(headers['content-type'], 'text/html')
+        self.assertEqual(headers.get('CONTENT-TYPE'), 'text/html')
+        self.assertIn('Content-type', headers)
+        self.assertIsNone(headers.get('missing'))
+        with self.assertRaises(KeyError):
+            headers['missing']
+
+    def test_repeated_fields(self):
+        headers = message.Headers([('Via', 'a'), ('via', 'b')])
+        self.assertEqual(headers.get_all('VIA'), ['a', 'b'])
+        self.assertEqual(len(headers), 2)
+        self.assertEqual(headers.items(), [('Via', 'a'), ('via', 'b')])
+
+    def test_tokens(self):
+        headers = message.Headers([('Connection', 'Keep-Alive, Upgrade'),
+                                   ('Connection', 'close')])
+        self.assertEqual(headers.tokens('connection'),
+                         {'keep-alive', 'upgrade', 'close'})
+
+
+class TestParseHead(unittest.TestCase):
+    def test_parse_head(self):
+        line, headers = message.parse_head(
+            b'HTTP/1.1 200 OK\r\nServer: test\r\nX-Long: a\r\n b\r\n\r\n')
+        self.assertEqual(line, 'HTTP/1.1 200 OK')
+        self.assertEqual(headers['server'], 'test')
+        self.assertEqual(headers['x-long'], 'a b')
+
+    def test_parse_head_invalid_line(self):
+        with self.assertRaises(ValueError):
+            message.parse_head(b'HTTP/1.1 200 OK\r\nno colon\r\n\r\n')
+
+
+class TestResponseParser(unittest.TestCase):
+    def feed_bytewise(self, parser, data):
+        for i in range(len(data)):
+            self.assertFalse(parser.complete)
+            self.assertEqual(parser.feed(data[i:i + 1]), 1)
+
+    def test_content_length(self):
+        parser = message.ResponseParser('GET')
+        data = b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello'
+        self.assertEqual(parser.feed(data + b'extra'), len(data))
+        self.assertTrue(parser.complete)
+        self.assertTrue(parser.keep_alive)
+        self.assertEqual(parser.status, 200)
+
+    def test_content_length_split(self):
+        parser = message.ResponseParser('GET')
+        self.feed_bytewise(parser,
+                           b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+        self.assertTrue(parser.complete)
+
+    def test_chunked(self):
+        data = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                b'5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nTrailer: x\r\n\r\n')
+        parser = message.ResponseParser('GET')
+        self.assertEqual(parser.feed(data + b'HTTP/1.1'), len(data))
+        self.assertTrue(parser.complete)
+        self.assertTrue(parser.keep_alive)
+
+        parser = message.ResponseParser('GET')
+        self.feed_bytewise(parser, data)
+        self.assertTrue(parser.complete)
+
+    def test_read_until_close(self):
+        parser = message.ResponseParser('GET')
+        parser.feed(b'HTTP/1.1 200 OK\r\n\r\nbody')
+        self.assertFalse(parser.complete)
+        self.assertFalse(parser.keep_alive)
+        parser.close()
+        self.assertTrue(parser.complete)
+
+    def test_no_body_responses(self):
+        for method, status in (('HEAD', 200), ('GET', 204), ('GET', 304)):
+            parser = message.ResponseParser(method)
+            data = ('HTTP/1.1 %d X\r\nContent-Length: 10\r\n\r\n' % status).encode()
+            self.assertEqual(parser.feed(data), len(data))
+            self.assertTrue(parser.complete)
+            self.assertTrue(parser.keep_alive)
+
+    def test_interim_response(self):
+        parser = message.ResponseParser('POST')
+        parser.feed(b'HTTP/1.1 100 Continue\r\n\r\n')
+        self.assertFalse(parser.complete)
+        parser.feed(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+        self.assertTrue(parser.complete)
+        self.assertEqual(parser.status, 200)
+
+    def test_connection_close(self):
+        parser = message.ResponseParser('GET')
+        parser.feed(b'HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 0\r\n\r\n')
+        self.assertTrue(parser.complete)
+        self.assertFalse(parser.keep_alive)
+
+    def test_http10_keep_alive(self):
+        parser = message.ResponseParser('GET')
+        parser.feed(b'HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n')
+        self.assertFalse(parser.keep_alive)
+
+        parser = message.ResponseParser('GET')
+        parser.feed(b'HTTP/1.0 200 OK\r\nConnection: keep-alive\r\nContent-Length: 0\r\n\r\n')
+        self.assertTrue(parser.keep_alive)
+
+    def test_invalid_status_line(self):
+        parser = message.ResponseParser('GET')
+        with self.assertRaises(ValueError):
+            parser.feed(b'garbage\r\n\r\n')
@@ -0,0 +1,72 @@
+import unittest
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        requests = self.registry.counter('requests_total', 'Requests.', ('verdict',))
+        requests.inc('blocked')
+        requests.inc('blocked', amount=2)
+        requests.inc('forwarded')
+        self.assertEqual(metrics.render(self.registry.collect()),
+                         '# HELP requests_total Requests.\n'
+                         '# TYPE requests_total counter\n'
+                         'requests_total{verdict="blocked"} 3\n'
+                         'requests_total{verdict="forwarded"} 1\n')
+
+    def test_gauge_is_read_when_collected(self):
+        value = [1]
+        self.registry.gauge('connections', 'Connections.', lambda: value[0])
+        value[0] = 5
+        self.assertIn('connections 5\n', metrics.render(self.registry.collect()))
+
+    def test_stats_are_registered_as_gauges(self):
+        stats = {'hits': 1, 'idle_hosts': 2, 'hit_rate': 0.5}
+        self.registry.stats('cache', 'test cache', lambda: stats)
+        stats['hits'] = 3
+        text = metrics.render(self.registry.collect())
+        self.assertIn('# TYPE cache_hits_total counter\ncache_hits_total 3\n', text)
+        self.assertIn('# HELP cache_idle_hosts Idle hosts of the test cache.\n', text)
+        self.assertIn('# TYPE cache_idle_hosts gauge\ncache_idle_hosts 2\n', text)
+        self.assertNotIn('hit_rate', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        latency = self.registry.histogram('latency_seconds', 'Latency.', ('stage',),
+                                          buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.observe(value, 'dns')
+        self.assertEqual(metrics.render(self.registry.collect()).splitlines()[2:],
+                         ['latency_seconds_bucket{stage="dns",le="0.1"} 2',
+                          'latency_seconds_bucket{stage="dns",le="1.0"} 3',
+                          'latency_seconds_bucket{stage="dns",le="+Inf"} 4',
+                          'latency_seconds_sum{stage="dns"} 3.65',
+                          'latency_seconds_count{stage="dns"} 4'])
+
+    def test_merge_adds_up_processes(self):
+        requests = self.registry.counter('requests_total', 'Requests.', ('verdict',))
+        requests.inc('blocked')
+        other = metrics.Registry()
+        other.counter('requests_total', 'Requests.', ('verdict',)).inc('forwarded')
+        other.counter('requests_total', 'Requests.', ('verdict',))
+        merged = metrics.merge([self.registry.collect(), other.collect(), self.registry.collect()])
+        self.assertEqual(merged, [['requests_total', 'counter', 'Requests.',
+                                   [['', [('verdict', 'blocked')], 2],
+                                    ['', [('verdict', 'forwarded')], 1]]]])
+
+    def test_label_values_are_escaped(self):
+        self.registry.counter('errors_total', 'Errors.', ('error',)).inc('a "b"\n')
+        self.assertIn('errors_total{error="a \\"b\\"\\n"} 1', metrics.render(self.registry.collect()))
+
+    def test_response(self):
+        self.registry.counter('requests_total', 'Requests.').inc()
+        response = metrics.response(b'GET /metrics HTTP/1.1', self.registry.collect)
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertIn(b'Content-Type: ' + metrics.CONTENT_TYPE.encode('ascii'), head)
+        self.assertIn(b'Content-Length: %d' % len(body), head)
+        self.assertIn(b'requests_total 1\n', body)
+        self.assertTrue(metrics.response(b'GET / HTTP/1.1', self.registry.collect)
+                        .startswith(b'HTTP/1.1 404 Not Found\r\n'))
@@ -0,0 +1,80 @@
+import unittest
+import unittest.mock
+
+import asyncio
+import pool
+
+
+def connection():
+    conn = unittest.mock.MagicMock()
+    conn.transport.is_closing.return_value = False
+    return conn
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.pool = pool.ConnectionPool(self.loop, max_idle=3,
+                                        max_per_host=2, idle_timeout=30)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_acquire_empty_is_miss(self):
+        self.assertIsNone(self.pool.acquire('example.com', 80))
+        self.assertEqual(self.pool.stats()['misses'], 1)
+
+    def test_release_then_acquire_is_hit(self):
+        conn = connection()
+        self.pool.release('example.com', 80, conn)
+        self.assertIsNone(self.pool.acquire('example.com', 8080))
+        self.assertIs(self.pool.acquire('example.com', 80), conn)
+        self.assertEqual(self.pool.stats(),
+                         {'hits': 1, 'misses': 1, 'evictions': 0, 'idle': 0})
+
+    def test_acquire_skips_closed_connections(self):
+        closed = connection()
+        closed.transport.is_closing.return_value = True
+        self.pool.release('example.com', 80, closed)
+        self.assertIsNone(self.pool.acquire('example.com', 80))
+
+    def test_per_host_limit_evicts_oldest(self):
+        conns = [connection() for i in range(3)]
+        for conn in conns:
+            self.pool.release('example.com', 80, conn)
+
+        self.assertTrue(conns[0].transport.close.called)
+        self.assertEqual(self.pool.stats()['idle'], 2)
+        self.assertEqual(self.pool.stats()['evictions'], 1)
+
+    def test_total_limit_evicts_oldest(self):
+        conns = [connection() for i in range(4)]
+        for i, conn in enumerate(conns):
+            self.pool.release('host%d' % i, 80, conn)
+
+        self.assertTrue(conns[0].transport.close.called)
+        self.assertEqual(self.pool.stats()['idle'], 3)
+        self.assertIsNone(self.pool.acquire('host0', 80))
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0.01
+        conn = connection()
+        self.pool.release('example.com', 80, conn)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+        self.assertTrue(conn.transport.close.called)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_discard(self):
+        conn = connection()
+        self.pool.release('example.com', 80, conn)
+        self.pool.discard(conn)
+
+        self.assertFalse(conn.transport.close.called)
+        self.assertIsNone(self.pool.acquire('example.com', 80))
+
+    def test_disabled_pool_closes(self):
+        self.pool.max_idle = 0
+        conn = connection()
+        self.pool.release('example.com', 80, conn)
+        self.assertTrue(conn.transport.close.called)
@@ -1,9 +1,18 @@
 import unittest
 import unittest.mock
 
+import json
 import asyncio
-import time
+import tempfile
+import accesslog
+import admission
+import config
+import filecache
+import httpcache
+import message
+import metrics
 import proxy
+import resource
 
 
 class TestProxyServer(unittest.TestCase):
@@ -60,40 +69,565 @@ class TestProxyServer(unittest.TestCase):
         self.assertEqual(port, 80)
         self.assertEqual(path, '/hello_world?q=hello')
 
+    def test_parse_url_without_host(self):
+        with self.assertRaises(ValueError):
+            proxy.ProxyServer.parse_url('/hello_world')
+
+    def parse_headers(self, data, crlf=True):
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(data)
+        reader.feed_eof()
+        headers = self.loop.run_until_complete(proxy.ProxyServer.parse_headers(reader, crlf))
+        return headers, reader
+
     def test_parse_headers(self):
-        class MockReader():
-            def __init__(self):
-                self.lines = [b'Host: example.com\n', b'Test: value\n', b'\n']
+        headers, reader = self.parse_headers(b'Host: example.com\r\nTest: value\r\n\r\nbody')
+        self.assertEqual(headers['host'], 'example.com')
+        self.assertEqual(headers['test'], 'value')
+        self.assertEqual(len(headers), 2)
+        self.assertEqual(self.loop.run_until_complete(reader.read()), b'body')
 
-            async def readline(self):
-                return self.lines.pop(0)
+    def test_parse_headers_empty(self):
+        headers, reader = self.parse_headers(b'\r\nGET')
+        self.assertEqual(len(headers), 0)
+        self.assertEqual(self.loop.run_until_complete(reader.read()), b'GET')
 
-        async def run_async_test():
-            headers = await proxy.ProxyServer.parse_headers(MockReader())
-            self.assertEqual(headers['host'], 'example.com')
-            self.assertEqual(headers['test'], 'value')
-            self.assertEqual(len(headers), 2)
+    def test_parse_headers_short_line(self):
+        self.assertRaises(ValueError, self.parse_headers, b'X\r\n\r\n')
 
-        self.loop.run_until_complete(run_async_test())
+    def test_parse_headers_bare_lf(self):
+        headers, reader = self.parse_headers(b'Host: example.com\nTest: value\n\nbody', crlf=False)
+        self.assertEqual(headers.items(), [('Host', 'example.com'), ('Test', 'value')])
+        self.assertEqual(self.loop.run_until_complete(reader.read()), b'body')
+
+    def test_parse_headers_limits(self):
+        self.assertRaises(ValueError, self.parse_headers, b'Host: example.com\r\n')
+        many = b''.join(b'X-%d: 1\r\n' % i for i in range(proxy.ProxyServer.MAXHEADERS + 1))
+        self.assertRaises(ValueError, self.parse_headers, many + b'\r\n')
+        self.assertRaises(ValueError, self.parse_headers, many + b'\r\n', False)
+        with unittest.mock.patch('proxy.ProxyServer.MAXLINE', 10):
+            self.assertRaises(ValueError, self.parse_headers, b'Host: example.com\r\n\r\n')
 
     def test_start_periodic_refresh_with_negative_interval(self):
         self.assertIsNone(proxy.ProxyServer.start_periodic_refresh(None, -1))
 
 
-class TestHTTPRequest(unittest.TestCase):
-    def test_timed_out(self):
+class TestProxyServerHandler(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        def fetch_json(url, *args):
+            return {'domain': ['blocked.com']} if url == config.blacklist else {}
+
+        with unittest.mock.patch('resource.fetch_json', fetch_json), \
+                unittest.mock.patch('config.list_cache_dir', ''), \
+                unittest.mock.patch('proxy.ProxyServer.start_periodic_refresh'):
+            self.server = proxy.ProxyServer(self.loop)
+
+        self.writer = unittest.mock.MagicMock()
+        self.writer.get_extra_info.return_value = ('127.0.0.1', 5000)
+
+    def tearDown(self):
+        # Let the handlers of connections to test servers end while the
+        # loop is still open.
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def handle(self, data):
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(data)
+        reader.feed_eof()
+        self.loop.run_until_complete(self.server.handler(reader, self.writer))
+        return [c[0][0] for c in self.writer.write.call_args_list]
+
+    def test_every_pipelined_request_is_checked(self):
+        written = self.handle(b'GET http://blocked.com/a HTTP/1.1\r\nHost: blocked.com\r\n\r\n'
+                              b'GET http://www.blocked.com/b HTTP/1.1\r\nHost: blocked.com\r\n\r\n')
+        self.assertEqual(written, [b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n'] * 2)
+        self.assertTrue(self.writer.close.called)
+        self.assertEqual(self.server.next_sess_id, 3)
+
+    def test_requests_are_counted_per_verdict(self):
+        self.handle(b'GET http://blocked.com/a HTTP/1.1\r\nHost: blocked.com\r\n\r\n'
+                    b'GET http://blocked.com/b HTTP/1.1\r\nHost: blocked.com\r\n\r\n')
+        text = metrics.render(self.server.registry.collect())
+        self.assertIn('kalamari_connections_accepted_total 1\n', text)
+        self.assertIn('kalamari_requests_total{verdict="blocked"} 2\n', text)
+        self.assertIn('kalamari_header_parse_seconds_count 2\n', text)
+        self.assertIn('kalamari_request_stage_seconds_count{stage="list_check",verdict="blocked"} 2\n',
+                      text)
+        self.assertIn('kalamari_active_connections 0\n', text)
+        self.assertIn('kalamari_verdict_cache_misses_total 2\n', text)
+        self.assertIn('kalamari_pool_idle 0\n', text)
+        self.assertIn('kalamari_dns_entries 0\n', text)
+
+    def test_origin_form_request_is_rejected(self):
+        written = self.handle(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertEqual(written, [b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n'])
+        self.assertTrue(self.writer.close.called)
+
+    def test_connection_close_ends_request_loop(self):
+        written = self.handle(b'GET http://blocked.com/a HTTP/1.1\r\nConnection: close\r\n\r\n'
+                              b'GET http://blocked.com/b HTTP/1.1\r\n\r\n')
+        self.assertEqual(len(written), 1)
+
+    def test_http10_request_closes_connection(self):
+        written = self.handle(b'GET http://blocked.com/a HTTP/1.0\r\n\r\n'
+                              b'GET http://blocked.com/b HTTP/1.0\r\n\r\n')
+        self.assertEqual(len(written), 1)
+
+    def test_reload_lists_swaps_changed_lists(self):
+        blacklist = self.server.blacklist
+        rulesets = {config.whitelist: {'domain': ['example.com']}}
+
+        def fetch(source):
+            return rulesets.get(source.url)
+
+        with unittest.mock.patch('resource.ListSource.fetch', fetch):
+            self.loop.run_until_complete(self.server.reload_lists())
+
+        self.assertIs(self.server.blacklist, blacklist)
+        request = proxy.HTTPRequest('GET', 'example.com', 80, '/', {}, 1)
+        self.assertTrue(self.server.whitelist.check(request))
+
+    def test_reload_lists_keeps_lists_on_error(self):
+        cachelist = self.server.cachelist
+        with unittest.mock.patch('resource.ListSource.fetch', side_effect=OSError('down')):
+            self.loop.run_until_complete(self.server.reload_lists())
+        self.assertIs(self.server.cachelist, cachelist)
+
+    def test_classify_caches_verdicts(self):
+        request = proxy.HTTPRequest('GET', 'blocked.com', 80, '/a', {}, 1)
+        self.assertEqual(self.server.classify(request), (proxy.ProxyServer.BLOCKED, None))
+        with unittest.mock.patch.object(self.server.blacklist, 'check') as check:
+            self.assertEqual(self.server.classify(request), (proxy.ProxyServer.BLOCKED, None))
+            self.assertFalse(check.called)
+        self.assertEqual(self.server.verdicts.stats()['hits'], 1)
+
+    def test_reload_lists_clears_verdicts(self):
         request = proxy.HTTPRequest('GET', 'example.com', 80, '/', {}, 1)
-        self.assertFalse(request.timed_out())
+        self.assertEqual(self.server.classify(request), (proxy.ProxyServer.FORWARDED, None))
+
+        rulesets = {config.cachelist: {'example\\.com/': 'cached.com/'}}
+        def fetch(source):
+            return rulesets.get(source.url)
+
+        with unittest.mock.patch('resource.ListSource.fetch', fetch):
+            self.loop.run_until_complete(self.server.reload_lists())
+
+        self.assertEqual(self.server.classify(request),
+                         (proxy.ProxyServer.REDIRECTED, 'cached.com/'))
+
+    def test_reload_lists_from_disk(self):
+        cached = {'url': config.blacklist, 'validators': {}, 'ruleset': {'domain': ['other.com']}}
+        def read_cache(source):
+            return cached if source.url == config.blacklist else None
+
+        with unittest.mock.patch('resource.ListSource.read_cache', read_cache), \
+                unittest.mock.patch('resource.ListSource.fetch') as fetch:
+            self.loop.run_until_complete(self.server.reload_lists(fetch=False))
+        self.assertFalse(fetch.called)
+
+        request = proxy.HTTPRequest('GET', 'other.com', 80, '/', {}, 1)
+        self.assertTrue(self.server.blacklist.check(request))
+
+    def test_shared_blacklist_is_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = resource.ListSource(config.blacklist, tmp)
+            self.server.sources['blacklist'] = source
+            resource.ResourceList.compile_to({'domain': ['mapped.com']}, source.compiled_path)
+            self.loop.run_until_complete(self.server.reload_lists(fetch=False))
+
+        self.assertIsInstance(self.server.blacklist.domains, resource.DomainTable)
+        request = proxy.HTTPRequest('GET', 'www.mapped.com', 80, '/', {}, 1)
+        self.assertEqual(self.server.classify(request), (proxy.ProxyServer.BLOCKED, None))
+
+    def test_shutdown_closes_idle_connections(self):
+        reader = asyncio.StreamReader(loop=self.loop)
+        handler = self.loop.create_task(self.server.handler(reader, self.writer))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.server.connections, 1)
+
+        self.writer.close.side_effect = reader.feed_eof
+        self.loop.run_until_complete(self.server.shutdown(1))
+        self.loop.run_until_complete(handler)
+        self.assertEqual(self.server.connections, 0)
+
+    def serve_files(self, files):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name, data in files.items():
+            with open(tmp.name + '/' + name, 'wb') as f:
+                f.write(data)
+        self.server.files = filecache.FileCache(tmp.name, 1024, 16)
+        async def drain():
+            pass
+        self.writer.drain = drain
+        self.server.cachelist = resource.CacheList()
+        self.server.cachelist.build({'example\\.com/(.*)': 'http://127.0.0.1:8080/kitty.jpg'})
+
+    @unittest.mock.patch('config.webserver_ip', '127.0.0.1')
+    @unittest.mock.patch('config.webserver_port', '8080')
+    def test_cached_resource_is_served_locally(self):
+        self.serve_files({'kitty.jpg': b'meow'})
+        written = self.handle(b'GET http://example.com/cat.jpg HTTP/1.1\r\n\r\n'
+                              b'HEAD http://example.com/cat.jpg HTTP/1.1\r\n\r\n')
+        self.assertTrue(written[0].startswith(b'HTTP/1.1 200 OK\r\nContent-Type: image/jpeg\r\n'
+                                              b'Content-Length: 4\r\n'))
+        self.assertEqual(written[1], b'meow')
+        self.assertEqual(written[2], written[0])
+        self.assertEqual(len(written), 3)
+
+    @unittest.mock.patch('config.webserver_ip', '127.0.0.1')
+    @unittest.mock.patch('config.webserver_port', '8080')
+    def test_whitelisted_resource_on_cache_list_is_served_locally(self):
+        self.serve_files({'kitty.jpg': b'meow'})
+        self.server.whitelist = resource.ResourceList()
+        self.server.whitelist.build({'domain': ['example.com']})
+        request = proxy.HTTPRequest('GET', 'example.com', 80, '/cat.jpg', {}, 1)
+        verdict = (proxy.ProxyServer.WHITELISTED, 'http://127.0.0.1:8080/kitty.jpg')
+        self.assertEqual(self.server.classify(request), verdict)
+        self.assertEqual(self.server.verdicts.get('example.com', '/cat.jpg'), verdict)
+
+        written = self.handle(b'GET http://example.com/cat.jpg HTTP/1.0\r\n\r\n')
+        self.assertTrue(written[0].startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertEqual(written[1], b'meow')
+
+    def test_file_cache_stats_are_exported(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+                unittest.mock.patch('config.cache_root', tmp), \
+                unittest.mock.patch('resource.fetch_json', return_value={}), \
+                unittest.mock.patch('config.list_cache_dir', ''), \
+                unittest.mock.patch('proxy.ProxyServer.start_periodic_refresh'):
+            server = proxy.ProxyServer(self.loop)
+        text = metrics.render(server.registry.collect())
+        self.assertIn('kalamari_file_cache_files 0\n', text)
+
+    @unittest.mock.patch('config.webserver_ip', '127.0.0.1')
+    @unittest.mock.patch('config.webserver_port', '8080')
+    def test_missing_cached_resource_returns_404(self):
+        self.serve_files({})
+        written = self.handle(b'GET http://example.com/cat.jpg HTTP/1.0\r\n\r\n')
+        self.assertEqual(written, [b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n'
+                                   b'Connection: close\r\n\r\n'])
+
+    @unittest.mock.patch('config.webserver_ip', '127.0.0.1')
+    @unittest.mock.patch('config.webserver_port', '8080')
+    def test_large_cached_resource_is_sent_from_disk(self):
+        data = b'x' * 100000
+        self.serve_files({'kitty.jpg': data})
+        listener = self.loop.run_until_complete(
+            asyncio.start_server(self.server.handler, '127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        port = listener.sockets[0].getsockname()[1]
+
+        async def fetch():
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET http://example.com/cat.jpg HTTP/1.1\r\nConnection: close\r\n\r\n')
+            response = await reader.read()
+            writer.close()
+            return response
+
+        response = self.loop.run_until_complete(fetch())
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertIn(b'Content-Length: 100000', head)
+        self.assertEqual(body, data)
+
+    def start_origin(self, respond):
+        '''
+        Start a web server which answers each request with
+        respond(request_head) and return its port.
+        '''
+        async def handle(reader, writer):
+            try:
+                while True:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                    writer.write(respond(head))
+            except asyncio.IncompleteReadError:
+                writer.close()
+
+        origin = self.loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0))
+        self.addCleanup(origin.close)
+        return origin.sockets[0].getsockname()[1]
+
+    def fetch_twice(self, url):
+        listener = self.loop.run_until_complete(
+            asyncio.start_server(self.server.handler, '127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        port = listener.sockets[0].getsockname()[1]
+
+        async def fetch():
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = []
+            for i in range(2):
+                writer.write('GET {0} HTTP/1.1\r\n\r\n'.format(url).encode('ascii'))
+                head = await reader.readuntil(b'\r\n\r\n')
+                responses.append((head, await reader.readexactly(5)))
+            writer.close()
+            return responses
+
+        return self.loop.run_until_complete(fetch())
+
+    def test_cacheable_response_is_served_from_http_cache(self):
+        requests = []
+        def respond(head):
+            requests.append(head)
+            return (b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\n'
+                    b'Content-Length: 5\r\n\r\nhello')
+        origin = self.start_origin(respond)
+        self.server.http_cache = httpcache.HTTPCache(1000, 100)
+
+        responses = self.fetch_twice('http://127.0.0.1:%d/a' % origin)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual([body for head, body in responses], [b'hello', b'hello'])
+        self.assertIn(b'\r\nAge: 0\r\n', responses[1][0])
+        self.assertEqual(self.server.http_cache.stats()['hits'], 1)
+
+    def test_truncated_response_is_not_stored(self):
+        async def handle(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\n'
+                         b'Content-Length: 100\r\n\r\n0123456789')
+            writer.close()
+        origin = self.loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0))
+        self.addCleanup(origin.close)
+        self.server.http_cache = httpcache.HTTPCache(1000, 200)
+
+        request = 'GET http://127.0.0.1:{0}/a HTTP/1.1\r\n\r\n'.format(
+            origin.sockets[0].getsockname()[1]).encode('ascii')
+        self.handle(request)
+        self.assertEqual(self.server.http_cache.stats()['stores'], 0)
+        self.assertIsNone(self.server.http_cache.lookup(
+            proxy.HTTPRequest('GET', '127.0.0.1', origin.sockets[0].getsockname()[1], '/a',
+                              message.Headers([]), 2)))
+
+    def test_stale_response_is_revalidated(self):
+        requests = []
+        def respond(head):
+            requests.append(head)
+            if b'If-None-Match: "v1"' in head:
+                return b'HTTP/1.1 304 Not Modified\r\nETag: "v1"\r\n\r\n'
+            return (b'HTTP/1.1 200 OK\r\nCache-Control: max-age=0\r\nETag: "v1"\r\n'
+                    b'Content-Length: 5\r\n\r\nhello')
+        origin = self.start_origin(respond)
+        self.server.http_cache = httpcache.HTTPCache(1000, 100)
+
+        responses = self.fetch_twice('http://127.0.0.1:%d/a' % origin)
+        self.assertEqual(len(requests), 2)
+        self.assertIn(b'If-None-Match: "v1"', requests[1])
+        self.assertTrue(responses[1][0].startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertEqual(responses[1][1], b'hello')
+        self.assertEqual(self.server.http_cache.stats()['revalidations'], 1)
+
+    def test_requests_are_written_to_access_log(self):
+        origin = self.start_origin(lambda head: b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+        self.server.access_log = accesslog.AccessLog(self.loop, 100, 60)
+
+        with self.assertLogs(accesslog.ACCESS_LOGGER) as logs:
+            self.fetch_twice('http://127.0.0.1:%d/a' % origin)
+            self.server.access_log.flush()
+        records = [json.loads(line) for line in logs.records[0].getMessage().split('\n')]
+        self.assertEqual([record['session'] for record in records], [1, 2])
+        for record in records:
+            self.assertEqual(record['method'], 'GET')
+            self.assertEqual(record['path'], '/a')
+            self.assertEqual(record['verdict'], 'forwarded')
+            self.assertEqual(record['status'], 200)
+            self.assertEqual(record['bytes_sent'], 43)
+            self.assertIn('ttfb_ms', record)
+
+    def test_response_delimited_by_close_is_recorded(self):
+        async def handle(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.0 200 OK\r\n\r\nhello')
+            writer.close()
+        origin = self.loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0))
+        self.addCleanup(origin.close)
+        self.server.access_log = accesslog.AccessLog(self.loop, 100, 60)
+        land = unittest.mock.Mock(wraps=self.server.flights.land)
+
+        with self.assertLogs(accesslog.ACCESS_LOGGER) as logs, \
+                unittest.mock.patch.object(self.server.flights, 'land', land):
+            written = self.handle('GET http://127.0.0.1:{0}/a HTTP/1.1\r\n\r\n'.format(
+                origin.sockets[0].getsockname()[1]).encode('ascii'))
+            self.server.access_log.flush()
+        self.assertEqual(b''.join(written), b'HTTP/1.0 200 OK\r\n\r\nhello')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['status'], 200)
+        response = land.call_args[0][1]
+        self.assertTrue(response.complete)
+
+    def test_concurrent_identical_requests_are_collapsed(self):
+        requests = []
+        async def handle(reader, writer):
+            requests.append(await reader.readuntil(b'\r\n\r\n'))
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nhello')
+            await asyncio.sleep(0.1)
+            writer.write(b'world')
+            writer.close()
+        origin = self.loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0))
+        self.addCleanup(origin.close)
+        listener = self.loop.run_until_complete(
+            asyncio.start_server(self.server.handler, '127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        port = listener.sockets[0].getsockname()[1]
+        request = ('GET http://127.0.0.1:%d/update.bin HTTP/1.1\r\n'
+                   'Connection: close\r\n\r\n' % origin.sockets[0].getsockname()[1])
+
+        async def fetch(delay):
+            await asyncio.sleep(delay)
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request.encode('ascii'))
+            response = await reader.read()
+            writer.close()
+            return response
+
+        async def fetch_all():
+            return await asyncio.gather(fetch(0), fetch(0.05), fetch(0.05))
+
+        responses = self.loop.run_until_complete(fetch_all())
+        self.assertEqual(len(requests), 1)
+        for response in responses:
+            self.assertTrue(response.endswith(b'\r\n\r\nhelloworld'))
+        self.assertEqual(self.server.flights.stats()['followers'], 2)
+
+    def test_connect_tunnel_relays_raw_sockets(self):
+        async def echo(reader, writer):
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+            writer.close()
+        origin = self.loop.run_until_complete(asyncio.start_server(echo, '127.0.0.1', 0))
+        self.addCleanup(origin.close)
+        listener = self.loop.run_until_complete(
+            asyncio.start_server(self.server.handler, '127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        port = listener.sockets[0].getsockname()[1]
+        data = b'x' * 300000
 
-        request.time = time.time() - 1000
-        self.assertTrue(request.timed_out())
+        async def fetch():
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            # The first data is sent before the tunnel is established.
+            writer.write('CONNECT 127.0.0.1:{0} HTTP/1.1\r\n\r\nhello'.format(
+                origin.sockets[0].getsockname()[1]).encode('ascii'))
+            head = await reader.readuntil(b'\n\n')
+            writer.write(data)
+            writer.write_eof()
+            response = await reader.read()
+            writer.close()
+            return head, response
+
+        head, response = self.loop.run_until_complete(fetch())
+        self.assertEqual(head, b'HTTP/1.1 200 OK\n\n')
+        self.assertEqual(response, b'hello' + data)
+
+    def test_invalid_request_returns_400(self):
+        written = self.handle(b'GARBAGE\r\n\r\n')
+        self.assertEqual(written, [b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n'])
+
+    def test_disallowed_ip_returns_403(self):
+        self.writer.get_extra_info.return_value = ('10.1.1.1', 5000)
+        written = self.handle(b'GET http://blocked.com/a HTTP/1.1\r\n\r\n'
+                              b'GET http://blocked.com/b HTTP/1.1\r\n\r\n')
+        self.assertEqual(written, [b'HTTP/1.1 403 Forbidden\n\n'])
+        # Nothing was read or parsed
+        self.assertEqual(self.server.next_sess_id, 1)
+
+    def test_connections_per_ip_are_limited(self):
+        self.server.admission.max_per_ip = 1
+        self.server.admission.admit('127.0.0.1')
+        written = self.handle(b'GET http://blocked.com/a HTTP/1.1\r\n\r\n')
+        self.assertEqual(written, [b'HTTP/1.1 429 Too Many Requests\r\n'
+                                   b'Content-Length: 0\r\nConnection: close\r\n\r\n'])
+        self.assertTrue(self.writer.close.called)
+
+        self.server.admission.release('127.0.0.1')
+        self.writer.write.reset_mock()
+        written = self.handle(b'GET http://blocked.com/a HTTP/1.1\r\n\r\n')
+        self.assertEqual(written, [b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n'])
+        self.assertEqual(self.server.admission.active, {})
+
+    def test_connections_over_total_limit_get_503(self):
+        self.server.admission.max_total = 1
+        self.server.admission.admit('127.0.0.2')
+        written = self.handle(b'GET http://blocked.com/a HTTP/1.1\r\n\r\n')
+        self.assertEqual(written, [b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n'
+                                   b'Content-Length: 0\r\nConnection: close\r\n\r\n'])
+        self.assertEqual(self.server.next_sess_id, 1)
+
+    def test_saturated_connects_get_503(self):
+        connects = self.server.connects
+        connects.max_total = 1
+        connects.queue_size = 0
+        connects.take('busy.com')
+        written = self.handle(b'GET http://127.0.0.1:9/a HTTP/1.1\r\n\r\n')
+        self.assertEqual(written, [b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n'
+                                   b'Content-Length: 0\r\nConnection: close\r\n\r\n'])
+        self.assertEqual(connects.stats()['shed'], 1)
+        self.assertIn('kalamari_requests_shed_total 1\n',
+                      metrics.render(self.server.registry.collect()))
+
+    @unittest.mock.patch('config.header_timeout', 0.05)
+    def test_trickled_headers_time_out(self):
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(b'GET http://blocked.com/a HTTP/1.1\r\nHost: bl')
+        self.loop.run_until_complete(self.server.handler(reader, self.writer))
+        self.writer.write.assert_called_once_with(
+            b'HTTP/1.1 408 Request Timeout\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        self.assertTrue(self.writer.close.called)
+
+    @unittest.mock.patch('config.header_timeout', 0.05)
+    def test_idle_new_connection_times_out(self):
+        reader = asyncio.StreamReader(loop=self.loop)
+        self.loop.run_until_complete(
+            asyncio.wait_for(self.server.handler(reader, self.writer), 1))
+        self.assertFalse(self.writer.write.called)
+        self.assertTrue(self.writer.close.called)
+
+    @unittest.mock.patch('config.header_timeout', 0.05)
+    def test_keep_alive_connection_waits_for_next_request(self):
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(b'GET http://blocked.com/a HTTP/1.1\r\n\r\n')
+
+        async def pause():
+            await asyncio.sleep(0.1)
+            reader.feed_data(b'GET http://blocked.com/b HTTP/1.1\r\n\r\n')
+            reader.feed_eof()
+
+        async def handle():
+            await asyncio.gather(self.server.handler(reader, self.writer), pause())
+        self.loop.run_until_complete(handle())
+        self.assertEqual(self.writer.write.call_count, 2)
+
+
+class TestHTTPRequest(unittest.TestCase):
+    def test_persistent(self):
+        request = proxy.HTTPRequest('GET', 'example.com', 80, '/', {}, 1)
+        self.assertTrue(request.persistent())
+        request = proxy.HTTPRequest('GET', 'example.com', 80, '/',
+                                    {'proxy-connection': 'close'}, 1)
+        self.assertFalse(request.persistent())
+        request = proxy.HTTPRequest('GET', 'example.com', 80, '/', {}, 1, 'HTTP/1.0')
+        self.assertFalse(request.persistent())
+        request = proxy.HTTPRequest('GET', 'example.com', 80, '/',
+                                    {'connection': 'Keep-Alive'}, 1, 'HTTP/1.0')
+        self.assertTrue(request.persistent())
 
 
 class TestProxySessionOutput(unittest.TestCase):
     def setUp(self):
         self.mock_proxysession = unittest.mock.MagicMock()
         self.mock_request = unittest.mock.MagicMock()
-        
+        self.client_transport = self.mock_proxysession.writer.transport
+        self.client_transport.get_write_buffer_size.return_value = 0
+        self.mock_proxysession.lagging.return_value = False
+
         self.session = proxy.ProxySessionOutput(self.mock_proxysession,
                                                 self.mock_request)
 
@@ -129,3 +663,155 @@ class TestProxySessionOutput(unittest.TestCase):
     def test_connection_lost_closes_proxysession_writer(self):
         self.session.connection_lost(None)
         self.assertTrue(self.mock_proxysession.writer.close.called)
+
+    def test_connection_made_sets_write_buffer_limits(self):
+        self.mock_request.method = 'CONNECT'
+        transport = unittest.mock.MagicMock()
+        self.session.connection_made(transport)
+
+        transport.set_write_buffer_limits.assert_called_with(
+            high=config.buffer_high, low=config.buffer_low)
+
+    def test_data_received_pauses_reading_for_slow_client(self):
+        self.session.transport = unittest.mock.MagicMock()
+        self.mock_proxysession.lagging.return_value = True
+
+        self.session.data_received(b'data')
+        self.session.data_received(b'data')
+
+        self.assertTrue(self.session.reading_paused)
+        self.session.transport.pause_reading.assert_called_once_with()
+        create_task = self.mock_proxysession.loop.create_task
+        self.assertEqual(create_task.call_count, 1)
+        create_task.call_args[0][0].close()
+
+    def test_data_received_keeps_reading_for_fast_client(self):
+        self.session.transport = unittest.mock.MagicMock()
+        self.session.data_received(b'data')
+
+        self.assertFalse(self.session.reading_paused)
+        self.assertFalse(self.session.transport.pause_reading.called)
+
+    def test_complete_response_returns_connection_to_pool(self):
+        self.mock_request.method = 'GET'
+        self.mock_request.version = 'HTTP/1.1'
+        self.mock_proxysession.body_sent = True
+        self.mock_proxysession.pooling.return_value = True
+        transport = unittest.mock.MagicMock()
+        self.session.connection_made(transport)
+
+        self.session.data_received(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+
+        pool = self.mock_proxysession.server.pool
+        pool.release.assert_called_with(self.mock_request.host,
+                                        self.mock_request.port, self.session)
+        self.assertFalse(transport.close.called)
+        self.assertTrue(self.mock_proxysession.response_finished.called)
+        self.assertIsNone(self.session.proxysession)
+
+    def test_complete_response_closes_connection(self):
+        self.mock_request.method = 'GET'
+        self.mock_proxysession.body_sent = True
+        transport = unittest.mock.MagicMock()
+        self.session.connection_made(transport)
+
+        self.session.data_received(b'HTTP/1.1 200 OK\r\nConnection: close\r\n'
+                                   b'Content-Length: 2\r\n\r\nok')
+
+        self.assertFalse(self.mock_proxysession.server.pool.release.called)
+        self.assertTrue(transport.close.called)
+
+    def test_send_request_strips_hop_by_hop_headers(self):
+        self.mock_request.method = 'GET'
+        self.mock_request.version = 'HTTP/1.1'
+        self.mock_request.host = 'example.com'
+        self.mock_request.port = 8080
+        self.mock_request.path = '/x'
+        self.mock_request.headers = message.Headers([
+            ('Connection', 'keep-alive, X-Secret'), ('Proxy-Connection', 'close'),
+            ('X-Secret', '1'), ('Accept', '*/*')])
+        self.mock_proxysession.pooling.return_value = True
+        transport = unittest.mock.MagicMock()
+        self.session.connection_made(transport)
+
+        transport.write.assert_called_once_with(
+            b'GET /x HTTP/1.1\r\nHost: example.com:8080\r\nAccept: */*\r\n\r\n')
+
+    def test_drain_waits_for_resume_writing(self):
+        loop = asyncio.new_event_loop()
+        self.mock_proxysession.loop = loop
+        self.session.pause_writing()
+
+        drain = loop.create_task(self.session.drain())
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(drain.done())
+
+        self.session.resume_writing()
+        loop.run_until_complete(drain)
+        loop.close()
+
+
+class TestProxySession(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        self.writer = unittest.mock.MagicMock()
+        self.reader = unittest.mock.MagicMock()
+        self.request = proxy.HTTPRequest('GET', 'example.com', 80, '/', {}, 1)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_with_connection(self, coro):
+        server = unittest.mock.MagicMock(loop=self.loop, pool=None)
+        session = proxy.ProxySession(server, self.reader, self.writer,
+                                     self.request)
+        session.output = proxy.ProxySessionOutput(session, self.request)
+        session.task = self.loop.create_task(coro)
+        return self.loop.run_until_complete(session.run())
+
+    def test_run_connection_refused_returns_502(self):
+        async def refuse():
+            raise ConnectionRefusedError()
+
+        self.assertFalse(self.run_with_connection(refuse()))
+        self.writer.write.assert_called_with(
+            b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+
+    def open_socket(self, connects, resolve):
+        server = unittest.mock.MagicMock(loop=self.loop, pool=None, connects=connects)
+        server.resolver.resolve = resolve
+        session = proxy.ProxySession(server, self.reader, self.writer, self.request)
+        session.task = self.loop.create_task(session.create_socket())
+        return self.loop.run_until_complete(session.open())
+
+    @unittest.mock.patch('config.connect_timeout', 0.01)
+    def test_run_connection_timeout_returns_504(self):
+        async def resolve(host, port):
+            await asyncio.sleep(10)
+        connects = admission.ConnectLimiter(self.loop, 1, 1, 1, 5)
+
+        self.assertFalse(self.open_socket(connects, resolve))
+        self.writer.write.assert_called_with(
+            b'HTTP/1.1 504 Gateway Timeout\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        self.assertEqual(connects.connecting, 0)
+
+    @unittest.mock.patch('config.connect_timeout', 0.01)
+    def test_queued_connect_is_shed_with_503(self):
+        # The queue timeout is longer than CONNECT_TIMEOUT.
+        connects = admission.ConnectLimiter(self.loop, 1, 1, 1, 0.05)
+        connects.take('example.com')
+
+        self.assertFalse(self.open_socket(connects, None))
+        self.writer.write.assert_called_with(proxy.ProxyServer.unavailable())
+        self.assertEqual(connects.stats()['expired'], 1)
+
+    @unittest.mock.patch('config.tunnel_raw', True)
+    def test_raw_tunnel_needs_the_stream_buffer(self):
+        server = unittest.mock.MagicMock(loop=self.loop, pool=None)
+        reader = asyncio.StreamReader(loop=self.loop)
+        session = proxy.ProxySession(server, reader, self.writer, self.request)
+        self.assertTrue(session.raw_tunnel())
+
+        del reader._buffer
+        self.assertFalse(session.raw_tunnel())
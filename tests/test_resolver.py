@@ -0,0 +1,87 @@
+import unittest
+import unittest.mock
+
+import asyncio
+import socket
+import threading
+import resolver
+
+
+class StubResolver():
+    '''
+    Stands in for socket.getaddrinfo and counts the lookups per name.
+    '''
+    def __init__(self, answers):
+        self.answers = answers
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, host, port, family=0, type=0):
+        self.calls.append(host)
+        self.release.wait()
+        if host not in self.answers:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                 (self.answers[host], port))]
+
+
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.stub = StubResolver({'example.com': '93.184.216.34'})
+        self.resolver = resolver.Resolver(self.loop, ttl=300, negative_ttl=30,
+                                          workers=2, max_entries=2,
+                                          getaddrinfo=self.stub)
+        self.now = 1000.0
+        self.loop.time = lambda: self.now
+
+    def tearDown(self):
+        self.resolver.close()
+        self.loop.close()
+
+    def resolve(self, host, port=80):
+        return self.loop.run_until_complete(self.resolver.resolve(host, port))
+
+    def test_cached_until_ttl(self):
+        self.assertEqual(self.resolve('example.com')[0][4], ('93.184.216.34', 80))
+        self.resolve('example.com')
+        self.assertEqual(self.stub.calls, ['example.com'])
+
+        self.now += 301
+        self.resolve('example.com')
+        self.assertEqual(self.stub.calls, ['example.com'] * 2)
+        stats = self.resolver.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_negative_answers_are_cached(self):
+        for i in range(2):
+            self.assertRaises(socket.gaierror, self.resolve, 'missing.com')
+        self.assertEqual(self.stub.calls, ['missing.com'])
+        self.assertEqual(self.resolver.stats()['negative_hits'], 1)
+
+        self.now += 31
+        self.assertRaises(socket.gaierror, self.resolve, 'missing.com')
+        self.assertEqual(len(self.stub.calls), 2)
+
+    def test_concurrent_lookups_are_coalesced(self):
+        self.stub.release.clear()
+        futures = [asyncio.ensure_future(self.resolver.resolve('example.com', 80), loop=self.loop)
+                   for i in range(3)]
+        self.loop.call_soon(self.stub.release.set)
+        results = self.loop.run_until_complete(asyncio.gather(*futures))
+
+        self.assertEqual(self.stub.calls, ['example.com'])
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(self.resolver.stats()['coalesced'], 2)
+
+    def test_ip_literals_are_not_looked_up(self):
+        self.assertEqual(self.resolve('127.0.0.1')[0][4], ('127.0.0.1', 80))
+        self.assertEqual(self.resolve('::1')[0][0], socket.AF_INET6)
+        self.assertEqual(self.stub.calls, [])
+
+    def test_cache_is_bounded(self):
+        self.stub.answers.update({'a.com': '10.0.0.1', 'b.com': '10.0.0.2'})
+        for host in ('example.com', 'a.com', 'b.com'):
+            self.resolve(host)
+        self.assertEqual(list(self.resolver.cache), [('a.com', 80), ('b.com', 80)])
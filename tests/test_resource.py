@@ -1,6 +1,11 @@
 import unittest
 import unittest.mock
+import re
 import json
+import random
+import collections
+import tempfile
+import urllib.error
 
 import resource
 import config
@@ -38,6 +43,27 @@ class TestResource(unittest.TestCase):
         self.assertEqual(len(data['path']), 3)
         self.assertEqual(len(data['misc']), 1)
 
+    @unittest.mock.patch('urllib.request.urlopen')
+    def test_fetch_json_conditional(self, mock_urlopen):
+        mock_urlopen.return_value.read.return_value = b'{}'
+        mock_urlopen.return_value.headers = {'ETag': '"v2"', 'Last-Modified': 'today'}
+
+        validators = {'etag': '"v1"', 'last-modified': 'yesterday'}
+        resource.fetch_json(config.blacklist, validators, timeout=5)
+
+        request = mock_urlopen.call_args[0][0]
+        self.assertEqual(request.get_header('If-none-match'), '"v1"')
+        self.assertEqual(request.get_header('If-modified-since'), 'yesterday')
+        self.assertEqual(mock_urlopen.call_args[1]['timeout'], 5)
+        self.assertEqual(validators, {'etag': '"v2"', 'last-modified': 'today'})
+
+    @unittest.mock.patch('urllib.request.urlopen')
+    def test_fetch_json_not_modified(self, mock_urlopen):
+        mock_urlopen.side_effect = urllib.error.HTTPError(
+            config.blacklist, 304, 'Not Modified', {}, None)
+        with self.assertRaises(resource.NotModified):
+            resource.fetch_json(config.blacklist, {'etag': '"v1"'})
+
     @unittest.mock.patch('resource.fetch_json')
     def test_load_empty_ruleset(self, mock_fetch_json):
         mock_fetch_json.return_value = {}
@@ -45,7 +71,7 @@ class TestResource(unittest.TestCase):
         rl = resource.ResourceList()
         rl.load(config.blacklist)
 
-        self.assertEqual(rl.domains, set())
+        self.assertEqual(set(rl.domains), set())
         self.assertIsNone(rl.path_regex)
         self.assertIsNone(rl.full_regex)
 
@@ -57,7 +83,7 @@ class TestResource(unittest.TestCase):
         rl = resource.ResourceList()
         rl.load(config.whitelist)
 
-        self.assertEqual(rl.domains, set(DOMAINS))
+        self.assertEqual(set(rl.domains), set(DOMAINS))
 
     @unittest.mock.patch('resource.fetch_json')
     def test_check_domain(self, mock_fetch_json):
@@ -116,6 +142,112 @@ class TestResource(unittest.TestCase):
         self.assertFalse(rl.check(request))
 
 
+def suffix_match(domains, host):
+    parts = host.split('.')
+    return any('.'.join(parts[i:]) in domains for i in range(len(parts)))
+
+
+class TestDomainTable(unittest.TestCase):
+    def test_match(self):
+        table = resource.DomainTable.build(['example.com', 'ads.test.org'])
+        self.assertTrue(table.match('example.com'))
+        self.assertTrue(table.match('www.example.com'))
+        self.assertTrue(table.match('a.ads.test.org'))
+        self.assertFalse(table.match('com'))
+        self.assertFalse(table.match('test.org'))
+        self.assertFalse(table.match('badexample.com'))
+        self.assertFalse(table.match('example.com.evil.net'))
+
+    def test_matches_like_suffix_set(self):
+        domains = ['a.b.c', 'b.d', 'x.y.z.d', '', 'e.', 'com', 'f.g', 'h.f.g',
+                   'p.q.r', 'q.r', 's.t', 'u.t', 'a-b.c', 'a.b-c']
+        hosts = ['a.b.c', 'q.a.b.c', 'b.c', 'c', 'b.d', 'x.b.d', 'z.d',
+                 'x.y.z.d', 'host.', 'e.', 'q.e.', '', 'example.com', 'a..b.c',
+                 'f.g', 'h.f.g', 'g', 'q.r', 'p.q.r', 'r', 's.t', 'u.t', 'v.t', 't',
+                 'x.a-b.c', 'a-b.c', 'ab.c', 'a.b-c', 'b-c', 'b.b-c']
+        table = resource.DomainTable.build(domains)
+        for host in hosts:
+            self.assertEqual(table.match(host), suffix_match(domains, host), host)
+
+    def test_subdomains_of_listed_domains_are_pruned(self):
+        table = resource.DomainTable.build(['www.example.com', 'example.com', 'a.example.com'])
+        self.assertEqual(list(table), ['example.com'])
+        self.assertEqual(len(table), 1)
+
+    def test_single_subdomains(self):
+        table = resource.DomainTable.build(['ads.example.com', 'a.b.example.com',
+                                            'ads.other.com', 'x.ads.other.com'])
+        self.assertEqual(set(table), {'ads.example.com', 'a.b.example.com',
+                                      'ads.other.com'})
+        self.assertTrue(table.match('x.ads.example.com'))
+        self.assertTrue(table.match('a.b.example.com'))
+        self.assertFalse(table.match('b.example.com'))
+        self.assertFalse(table.match('example.com'))
+        self.assertFalse(table.match('other.com'))
+
+    def test_sizeof(self):
+        table = resource.DomainTable.build(['example.com'])
+        self.assertGreater(table.sizeof(), resource.DomainTable.build(()).sizeof())
+
+
+class TestCompiledResourceList(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name + '/list.rules'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def compile(self, ruleset):
+        resource.ResourceList.compile_to(ruleset, self.path)
+        return resource.ResourceList.open(self.path)
+
+    def test_matches_in_memory_table(self):
+        domains = ['a.b.c', 'b.d', 'x.y.z.d', '', 'e.', 'com', 'f.g', 'h.f.g',
+                   'p.q.r', 'q.r', 's.t', 'u.t', 'a-b.c', 'a.b-c']
+        hosts = ['a.b.c', 'q.a.b.c', 'b.c', 'c', 'b.d', 'x.b.d', 'z.d',
+                 'x.y.z.d', 'host.', 'e.', 'q.e.', '', 'example.com', 'a..b.c',
+                 'f.g', 'h.f.g', 'g', 'q.r', 'p.q.r', 'r', 's.t', 'u.t', 'v.t', 't',
+                 'x.a-b.c', 'a-b.c', 'ab.c', 'a.b-c', 'b-c', 'b.b-c']
+        built = resource.DomainTable.build(domains)
+        table = self.compile({'domain': domains}).domains
+        for host in hosts:
+            self.assertEqual(table.match(host), built.match(host), host)
+        self.assertEqual(list(table), list(built))
+
+    def test_random_domains_match_like_suffix_set(self):
+        random.seed(14)
+        labels = ['a', 'b', 'ab', 'a-b', 'com', 'x']
+        def domain():
+            return '.'.join(random.choice(labels) for i in range(random.randint(1, 4)))
+        domains = [domain() for i in range(200)]
+        table = self.compile({'domain': domains}).domains
+        for i in range(2000):
+            host = domain()
+            self.assertEqual(table.match(host), suffix_match(domains, host), host)
+
+    def test_check(self):
+        rl = self.compile({'domain': ['example.com'], 'path': ['/ads/'],
+                           'misc': ['.*\\.org/track']})
+        for host, path, expected in (('www.example.com', '/', True),
+                                     ('test.com', '/ads/x', True),
+                                     ('test.org', '/track', True),
+                                     ('test.org', '/', False)):
+            request = proxy.HTTPRequest('GET', host, 80, path, {}, 1)
+            self.assertEqual(rl.check(request), expected, (host, path))
+
+    def test_empty(self):
+        rl = self.compile({})
+        self.assertEqual(len(rl.domains), 0)
+        self.assertFalse(rl.domains.match('example.com'))
+        self.assertIsNone(rl.path_regex)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as invalid:
+            invalid.write(b'{"domain": []}')
+        self.assertRaises(ValueError, resource.ResourceList.open, self.path)
+
+
 class TestCacheList(unittest.TestCase):
     @unittest.mock.patch('resource.fetch_json')
     def test_check(self, mock_fetch_json):
@@ -140,3 +272,167 @@ class TestCacheList(unittest.TestCase):
 
         cl = resource.CacheList()
         cl.load(config.cachelist)
+
+
+class TestPatternSet(unittest.TestCase):
+    def assertEquivalent(self, patterns, texts):
+        regex = re.compile('|'.join(patterns))
+        patternset = resource.PatternSet(patterns)
+        for text in texts:
+            self.assertEqual(patternset.match(text), bool(regex.match(text)),
+                             '%r on %r' % (patterns, text))
+
+    def test_empty(self):
+        self.assertTrue(resource.PatternSet([]).match('anything'))
+        self.assertTrue(resource.PatternSet(['ads', '']).match('anything'))
+        self.assertTrue(resource.PatternSet(['.*']).match(''))
+
+    def test_kinds(self):
+        patternset = resource.PatternSet(['.*/ads/.*', '/banner', '.*/track\\d+\\.gif$', 'a+b'])
+        self.assertIsNotNone(patternset.automaton)
+        self.assertEqual(patternset.fallback.pattern, 'a+b')
+        self.assertTrue(patternset.match('/x/ads/y'))
+        self.assertFalse(patternset.match('/x\n/ads/y'))
+        self.assertTrue(patternset.match('/banner.png'))
+        self.assertFalse(patternset.match('/x/banner'))
+        self.assertTrue(patternset.match('/x/track12.gif'))
+        self.assertFalse(patternset.match('/x/track.gif'))
+        self.assertTrue(patternset.match('aab'))
+
+    def test_flags(self):
+        patterns = ['(?i)ads', 'banner']
+        patternset = resource.PatternSet(patterns)
+        self.assertIsNone(patternset.automaton)
+        self.assertEquivalent(patterns, ['ADS', 'BANNER', 'x'])
+
+    def test_invalid(self):
+        self.assertRaises(re.error, resource.PatternSet, ['exa(mple'])
+
+    def test_random_equivalence(self):
+        random.seed(8)
+        pieces = ['a', 'b', 'ab', 'ba', '/', '.', '.*', '.*?', '\\d', '[ab]',
+                  '(ab|b)', 'a+', '$', '^', '\\n', 'aba']
+        for _ in range(300):
+            patterns = [''.join(random.choice(pieces) for _ in range(random.randint(1, 5)))
+                        for _ in range(random.randint(1, 5))]
+            texts = [''.join(random.choice('ab/\n1') for _ in range(random.randint(0, 10)))
+                     for _ in range(30)]
+            self.assertEquivalent(patterns, texts)
+
+
+class TestVerdictCache(unittest.TestCase):
+    def test_lru(self):
+        cache = resource.VerdictCache(2)
+        cache.put('a.com', '/', 'blocked')
+        cache.put('b.com', '/', 'forwarded')
+        self.assertEqual(cache.get('a.com', '/'), 'blocked')
+        cache.put('c.com', '/', 'forwarded')
+        self.assertIsNone(cache.get('b.com', '/'))
+        self.assertEqual(cache.get('a.com', '/'), 'blocked')
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'evictions': 1,
+                                         'size': 2, 'hit_rate': 2 / 3})
+
+    def test_disabled(self):
+        cache = resource.VerdictCache(0)
+        cache.put('a.com', '/', 'blocked')
+        self.assertIsNone(cache.get('a.com', '/'))
+
+    def test_clear(self):
+        cache = resource.VerdictCache(2)
+        cache.put('a.com', '/', 'blocked')
+        cache.clear()
+        self.assertIsNone(cache.get('a.com', '/'))
+
+
+class TestListSource(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source = resource.ListSource(config.blacklist, self.tmpdir.name, 5)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @unittest.mock.patch('resource.fetch_json')
+    def test_fetch_not_modified(self, mock_fetch_json):
+        mock_fetch_json.side_effect = resource.NotModified()
+        self.assertIsNone(self.source.fetch())
+
+    @unittest.mock.patch('resource.fetch_json')
+    def test_load_falls_back_to_disk(self, mock_fetch_json):
+        mock_fetch_json.return_value = {'domain': ['example.com']}
+        self.assertEqual(self.source.load(), {'domain': ['example.com']})
+
+        mock_fetch_json.side_effect = OSError('timed out')
+        source = resource.ListSource(config.blacklist, self.tmpdir.name, 5)
+        self.assertEqual(source.load(), {'domain': ['example.com']})
+
+    @unittest.mock.patch('resource.fetch_json')
+    def test_load_uses_saved_validators(self, mock_fetch_json):
+        def fetch_json(url, validators, timeout):
+            validators['etag'] = '"v1"'
+            return {'domain': ['example.com']}
+        mock_fetch_json.side_effect = fetch_json
+        self.source.load()
+
+        mock_fetch_json.side_effect = resource.NotModified()
+        source = resource.ListSource(config.blacklist, self.tmpdir.name, 5)
+        self.assertEqual(source.load(), {'domain': ['example.com']})
+        self.assertEqual(mock_fetch_json.call_args[0][1]['etag'], '"v1"')
+
+    @unittest.mock.patch('resource.fetch_json')
+    def test_load_without_copy_raises(self, mock_fetch_json):
+        mock_fetch_json.side_effect = OSError('timed out')
+        with self.assertRaises(OSError):
+            self.source.load()
+
+    @unittest.mock.patch('resource.fetch_json')
+    def test_first_matching_rule_wins(self, mock_fetch_json):
+        RULES = collections.OrderedDict([
+            (r'cdn\.example\.com/lib/jquery-1\..*\.js', 'local/jquery1.js'),
+            (r'.*\.example\.com/lib/.*', 'local/lib'),
+            (r'cdn\.example\.com/lib/.*', 'local/cdn-lib'),
+            (r'(a|b)\.other\.com/(x)\2', 'local/backref'),
+            (r'(?i)UPPER\.com/', 'local/ignorecase'),
+            (r'(?P<name>named)\.com/', 'local/named'),
+        ])
+        mock_fetch_json.return_value = RULES
+
+        cl = resource.CacheList()
+        cl.load(config.cachelist)
+
+        def check(host, path):
+            return cl.check(proxy.HTTPRequest('GET', host, 80, path, {}, 1))
+
+        self.assertEqual(check('cdn.example.com', '/lib/jquery-1.12.js'), 'local/jquery1.js')
+        self.assertEqual(check('cdn.example.com', '/lib/other.js'), 'local/lib')
+        self.assertEqual(check('a.other.com', '/xx'), 'local/backref')
+        self.assertIsNone(check('a.other.com', '/xy'))
+        self.assertEqual(check('upper.com', '/'), 'local/ignorecase')
+        self.assertEqual(check('named.com', '/'), 'local/named')
+        self.assertIsNone(check('example.com', '/lib/x'))
+
+    @unittest.mock.patch('resource.fetch_json')
+    def test_check_matches_linear_scan(self, mock_fetch_json):
+        rng = random.Random(0)
+        hosts = ['a.com', 'b.com', 'cdn.a.com', 'c.net']
+        prefixes = [r'a\.com', r'b\.com', r'cdn\.a\.com', r'c\.net', '.*', r'cdn\..*', r'(a|b)\.com']
+        pieces = ['', '.*', 'x', '[0-9]+', '(js|css)', 'lib/', r'\.']
+        RULES = collections.OrderedDict()
+        for i in range(300):
+            rule = '%s/%s%s' % (rng.choice(prefixes), rng.choice(pieces), rng.choice(pieces))
+            RULES[rule] = 'redirect%d' % i
+        mock_fetch_json.return_value = RULES
+
+        cl = resource.CacheList()
+        cl.load(config.cachelist)
+        self.assertEqual(set(cl.by_host), set(hosts))
+        compiled = [(re.compile(rule), redirect) for rule, redirect in RULES.items()]
+
+        for i in range(2000):
+            host = rng.choice(hosts)
+            path = '/' + ''.join(rng.choice(['x', '1', 'lib/', '.', 'js', 'css'])
+                                 for j in range(rng.randint(0, 4)))
+            expected = next((redirect for rule, redirect in compiled
+                             if rule.match(host + path)), None)
+            request = proxy.HTTPRequest('GET', host, 80, path, {}, 1)
+            self.assertEqual(cl.check(request), expected, host + path)
@@ -0,0 +1,194 @@
+import unittest
+import unittest.mock
+
+import os
+import signal
+import socket
+import asyncio
+import tempfile
+import resource
+import supervisor
+
+
+class TestWorker(unittest.TestCase):
+    def test_feed_partial_lines(self):
+        worker = supervisor.Worker(10, None, now=0)
+        worker.feed(b'{"connections": 1}\n{"conn', now=5)
+        self.assertEqual(worker.health, {'connections': 1})
+        self.assertEqual(worker.last_heartbeat, 5)
+        worker.feed(b'ections": 2}\n', now=6)
+        self.assertEqual(worker.health, {'connections': 2})
+        self.assertEqual(worker.last_heartbeat, 6)
+
+    def test_feed_keeps_metrics_out_of_health(self):
+        worker = supervisor.Worker(10, None, now=0)
+        worker.feed(b'{"connections": 1, "metrics": [["a", "counter", "A.", []]]}\n', now=5)
+        self.assertEqual(worker.health, {'connections': 1})
+        self.assertEqual(worker.metrics, [['a', 'counter', 'A.', []]])
+        worker.feed(b'{"connections": 2}\n', now=6)
+        self.assertEqual(worker.metrics, [['a', 'counter', 'A.', []]])
+
+    def test_feed_invalid_line(self):
+        worker = supervisor.Worker(10, None, now=0)
+        worker.feed(b'garbage\n', now=5)
+        self.assertEqual(worker.health, {})
+        self.assertEqual(worker.last_heartbeat, 0)
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = supervisor.Supervisor(2)
+        self.supervisor.selector = unittest.mock.MagicMock()
+        self.supervisor.spawn = unittest.mock.MagicMock()
+        self.workers = {}
+        for pid in (10, 11):
+            rfd, wfd = os.pipe()
+            os.close(wfd)
+            worker = supervisor.Worker(pid, rfd, now=0)
+            self.supervisor.workers[pid] = worker
+            self.workers[pid] = worker
+
+    def tearDown(self):
+        for worker in self.supervisor.workers.values():
+            os.close(worker.fd)
+
+    def waitpid(self, *results):
+        results = list(results)
+        def waitpid(pid, options):
+            if results:
+                return results.pop(0)
+            return (0, 0)
+        return unittest.mock.patch('os.waitpid', waitpid)
+
+    def test_metrics_of_workers_are_added_up(self):
+        for pid, count in ((10, 1), (11, 2)):
+            self.workers[pid].metrics = [['requests_total', 'counter', 'Requests.',
+                                          [['', [['verdict', 'blocked']], count]]]]
+        self.assertEqual(self.supervisor.collect_metrics(), [
+            ['requests_total', 'counter', 'Requests.', [['', [('verdict', 'blocked')], 3]]],
+            ['kalamari_workers', 'gauge', 'Worker processes.', [['', [], 2]]]])
+
+    @unittest.mock.patch('config.worker_timeout', 30)
+    def test_dead_worker_is_replaced(self):
+        with self.waitpid((10, 9)):
+            self.supervisor.reap(now=100)
+        self.assertNotIn(10, self.supervisor.workers)
+
+        self.supervisor.respawn(now=100)
+        self.assertEqual(self.supervisor.spawn.call_count, 1)
+
+    def test_worker_that_fails_at_start_is_delayed(self):
+        with self.waitpid((10, 256)):
+            self.supervisor.reap(now=0.1)
+        self.supervisor.respawn(now=0.1)
+        self.assertFalse(self.supervisor.spawn.called)
+        self.supervisor.respawn(now=0.1 + supervisor.RESPAWN_DELAY)
+        self.assertTrue(self.supervisor.spawn.called)
+
+    @unittest.mock.patch('os.kill')
+    def test_retired_worker_is_not_replaced(self, kill):
+        self.supervisor.retire(self.workers[10], now=0)
+        kill.assert_called_with(10, signal.SIGTERM)
+        with self.waitpid((10, 0)):
+            self.supervisor.reap(now=100)
+        self.supervisor.respawn(now=100)
+        self.assertFalse(self.supervisor.spawn.called)
+
+    @unittest.mock.patch('config.worker_timeout', 30)
+    @unittest.mock.patch('os.kill')
+    def test_silent_worker_is_killed(self, kill):
+        self.workers[11].last_heartbeat = 80
+        self.supervisor.check_workers(now=100)
+        kill.assert_called_once_with(10, signal.SIGKILL)
+
+    @unittest.mock.patch('os.kill')
+    def test_changed_lists_are_reloaded_by_workers(self, kill):
+        self.supervisor.refresher = 20
+        with self.waitpid((20, supervisor.LISTS_CHANGED << 8)):
+            self.supervisor.reap(now=1)
+        self.assertIsNone(self.supervisor.refresher)
+        self.assertEqual(sorted(kill.call_args_list),
+                         [unittest.mock.call(10, signal.SIGUSR1),
+                          unittest.mock.call(11, signal.SIGUSR1)])
+
+    @unittest.mock.patch('os.kill')
+    def test_unchanged_lists_are_not_reloaded(self, kill):
+        self.supervisor.refresher = 20
+        with self.waitpid((20, 0)):
+            self.supervisor.reap(now=1)
+        self.assertFalse(kill.called)
+
+    @unittest.mock.patch('os.kill')
+    def test_restart_replaces_every_worker(self, kill):
+        self.supervisor.restart_requested = True
+        self.supervisor.handle_requests(now=1)
+        self.assertEqual(self.supervisor.spawn.call_count, 2)
+        self.assertTrue(all(worker.deadline is not None for worker in self.workers.values()))
+
+    @unittest.mock.patch('os.kill')
+    def test_stop_retires_every_worker(self, kill):
+        self.supervisor.stop_requested = True
+        self.supervisor.handle_requests(now=1)
+        self.assertTrue(self.supervisor.stopping)
+        self.assertEqual(kill.call_count, 2)
+        self.assertFalse(self.supervisor.spawn.called)
+
+    def test_client_connections_disable_nagle(self):
+        with unittest.mock.patch('config.listen_host', '127.0.0.1'), \
+                unittest.mock.patch('config.listen_port', 0):
+            sock = self.supervisor.listen()
+        self.addCleanup(sock.close)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        accepted = loop.create_future()
+
+        async def handle(reader, writer):
+            accepted.set_result(writer.get_extra_info('socket').getsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            writer.close()
+
+        async def connect():
+            server = await asyncio.start_server(handle, sock=sock)
+            reader, writer = await asyncio.open_connection(*sock.getsockname())
+            nodelay = await accepted
+            writer.close()
+            server.close()
+            return nodelay
+
+        self.assertTrue(loop.run_until_complete(connect()))
+
+    def test_listen_on_ipv6_address(self):
+        with unittest.mock.patch('config.listen_host', '::1'), \
+                unittest.mock.patch('config.listen_port', 0):
+            sock = self.supervisor.listen()
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.family, socket.AF_INET6)
+        self.assertEqual(sock.getsockname()[0], '::1')
+
+    @unittest.mock.patch('os.close')
+    @unittest.mock.patch('signal.signal')
+    def test_child_ignores_reload_signal_until_worker_starts(self, signal_, close):
+        self.supervisor.prepare_child()
+        signal_.assert_any_call(signal.SIGUSR1, signal.SIG_IGN)
+        self.assertEqual(close.call_count, 2)
+
+
+class TestPrepareLists(unittest.TestCase):
+    def test_unchanged_lists_are_not_compiled_again(self):
+        fetched = set()
+        def fetch_json(url, validators, timeout):
+            if url in fetched:
+                raise resource.NotModified()
+            fetched.add(url)
+            return {'domain': ['example.com']}
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                unittest.mock.patch('config.list_cache_dir', tmp), \
+                unittest.mock.patch('resource.fetch_json', fetch_json), \
+                unittest.mock.patch('resource.ResourceList.compile_to',
+                                    wraps=resource.ResourceList.compile_to) as compile_to:
+            supervisor.prepare_lists()
+            self.assertEqual(compile_to.call_count, 2)
+            compile_to.reset_mock()
+            supervisor.prepare_lists()
+            self.assertFalse(compile_to.called)
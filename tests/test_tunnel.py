@@ -0,0 +1,63 @@
+import unittest
+
+import asyncio
+import socket
+import tunnel
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+        # client <-> (proxy_client, proxy_remote) <-> remote
+        self.client, self.proxy_client = socket.socketpair()
+        self.proxy_remote, self.remote = socket.socketpair()
+        for sock in (self.client, self.proxy_client, self.proxy_remote, self.remote):
+            sock.setblocking(False)
+            self.addCleanup(sock.close)
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def exchange(self, use_splice):
+        relay = asyncio.ensure_future(
+            tunnel.relay(self.loop, self.proxy_client, self.proxy_remote, 4096, use_splice))
+        upload = b'u' * 100000
+        download = b'd' * 50000
+
+        await self.loop.sock_sendall(self.client, upload)
+        self.client.shutdown(socket.SHUT_WR)
+        await self.loop.sock_sendall(self.remote, download)
+        self.remote.shutdown(socket.SHUT_WR)
+
+        async def read_all(sock):
+            data = b''
+            while True:
+                chunk = await self.loop.sock_recv(sock, 65536)
+                if not chunk:
+                    return data
+                data += chunk
+
+        received, downloaded = await asyncio.gather(read_all(self.remote),
+                                                    read_all(self.client))
+        self.assertEqual(received, upload)
+        self.assertEqual(downloaded, download)
+        return await relay
+
+    def test_copy_relays_both_directions(self):
+        self.assertEqual(self.loop.run_until_complete(self.exchange(False)), (100000, 50000))
+
+    @unittest.skipUnless(tunnel.splice_supported(), 'os.splice() is not available')
+    def test_splice_relays_both_directions(self):
+        self.assertEqual(self.loop.run_until_complete(self.exchange(True)), (100000, 50000))
+
+    def test_error_on_one_side_ends_the_tunnel(self):
+        async def run():
+            relay = asyncio.ensure_future(
+                tunnel.relay(self.loop, self.proxy_client, self.proxy_remote, 4096, False))
+            await asyncio.sleep(0)
+            self.proxy_remote.close()
+            await self.loop.sock_sendall(self.client, b'data')
+            return await relay
+
+        self.assertEqual(self.loop.run_until_complete(run()), (0, 0))